@@ -4,4 +4,4 @@ import pytest
 
 @pytest.fixture(name="test_data_dir")
 def test_data_dir_fixture():
-    return abspath(join(dirname(__file__), 'test-data'))
+    return abspath(join(dirname(__file__), '..', 'test-data'))
@@ -0,0 +1,45 @@
+"""notify track queued
+
+Revision ID: 4e2b9d8f61a0
+Revises: c1e4a7f3b2d9
+Create Date: 2026-10-18 10:03:52.117640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "4e2b9d8f61a0"
+down_revision = "c1e4a7f3b2d9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The payload is empty on purpose: PostgreSQL folds identical
+    # notifications of one transaction into one, so requeueing many tracks at
+    # once only wakes the workers once.
+    op.execute(
+        """
+        CREATE OR REPLACE FUNCTION notify_track_queued() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('track_queued', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER track_queued_notify
+        AFTER INSERT OR UPDATE OF processing_status ON track
+        FOR EACH ROW WHEN (NEW.processing_status = 'queued')
+        EXECUTE FUNCTION notify_track_queued();
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS track_queued_notify ON track;")
+    op.execute("DROP FUNCTION IF EXISTS notify_track_queued();")
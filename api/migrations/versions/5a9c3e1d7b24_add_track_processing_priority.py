@@ -0,0 +1,39 @@
+"""add track processing priority
+
+Revision ID: 5a9c3e1d7b24
+Revises: 8f3d2c6b7a15
+Create Date: 2026-10-18 12:04:52.170394
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5a9c3e1d7b24"
+down_revision = "8f3d2c6b7a15"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "track",
+        sa.Column(
+            "processing_priority",
+            sa.SmallInteger,
+            nullable=False,
+            server_default=sa.text("0"),
+        ),
+    )
+    op.create_index(
+        "ix_track_processing_priority",
+        "track",
+        ["processing_priority", "processing_queued_at"],
+        postgresql_where=sa.text("processing_status = 'queued'"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_track_processing_priority", "track")
+    op.drop_column("track", "processing_priority")
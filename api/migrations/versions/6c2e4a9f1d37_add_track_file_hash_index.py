@@ -0,0 +1,28 @@
+"""add track file hash index
+
+Revision ID: 6c2e4a9f1d37
+Revises: b3d8e5f0a412
+Create Date: 2026-10-18 16:02:11.417205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "6c2e4a9f1d37"
+down_revision = "b3d8e5f0a412"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_track_author_id_original_file_hash",
+        "track",
+        ["author_id", "original_file_hash"],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_track_author_id_original_file_hash", "track")
@@ -0,0 +1,39 @@
+"""create table road_import
+
+Revision ID: 8f3d2c6b7a15
+Revises: 4e2b9d8f61a0
+Create Date: 2026-10-18 11:26:08.905317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8f3d2c6b7a15"
+down_revision = "4e2b9d8f61a0"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "road_import",
+        sa.Column("import_group", sa.String, primary_key=True),
+        sa.Column(
+            "imported_at",
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.text("NOW()"),
+        ),
+    )
+
+    # Record the existing import groups
+    op.execute(
+        "INSERT INTO road_import (import_group) "
+        "SELECT DISTINCT import_group FROM road WHERE import_group IS NOT NULL;"
+    )
+
+
+def downgrade():
+    op.drop_table("road_import")
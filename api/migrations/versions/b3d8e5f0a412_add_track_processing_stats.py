@@ -0,0 +1,27 @@
+"""add track processing stats
+
+Revision ID: b3d8e5f0a412
+Revises: 5a9c3e1d7b24
+Create Date: 2026-10-18 13:21:40.581337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+# revision identifiers, used by Alembic.
+revision = "b3d8e5f0a412"
+down_revision = "5a9c3e1d7b24"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("track", sa.Column("processing_stats", JSONB, nullable=True))
+    op.create_index("ix_track_processed_at", "track", ["processed_at"])
+
+
+def downgrade():
+    op.drop_index("ix_track_processed_at", "track")
+    op.drop_column("track", "processing_stats")
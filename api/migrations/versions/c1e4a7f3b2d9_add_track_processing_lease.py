@@ -0,0 +1,39 @@
+"""add track processing lease
+
+Revision ID: c1e4a7f3b2d9
+Revises: 21a1d1802b52
+Create Date: 2026-10-18 09:12:31.482113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c1e4a7f3b2d9"
+down_revision = "21a1d1802b52"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("track", sa.Column("processing_worker", sa.String, nullable=True))
+    op.add_column(
+        "track", sa.Column("processing_lease_until", sa.DateTime, nullable=True)
+    )
+    # Tracks that were being processed have no lease, let them be reclaimed
+    op.execute(
+        "UPDATE track SET processing_lease_until = now() AT TIME ZONE 'UTC' "
+        "WHERE processing_status = 'processing';"
+    )
+    op.create_index(
+        "ix_track_processing_queue",
+        "track",
+        ["processing_status", "processing_queued_at"],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_track_processing_queue", "track")
+    op.drop_column("track", "processing_lease_until")
+    op.drop_column("track", "processing_worker")
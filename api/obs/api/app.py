@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import re
+import time
 
 from json import JSONEncoder, dumps
 from functools import wraps, partial
@@ -23,6 +24,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from obs.api.db import User, make_session, connect_db
 from obs.api.cors import setup_options, add_cors_headers
+from obs.api.metrics import monitor_event_loop_lag, observe
 from obs.api.utils import get_single_arg
 
 log = logging.getLogger(__name__)
@@ -71,6 +73,16 @@ app.config.update(
         TILES_FILE=None,
         TILE_SEMAPHORE_SIZE=4,
         EXPORT_SEMAPHORE_SIZE=1,
+        PROCESSING_LEASE_DURATION=600,
+        PROCESSING_HEARTBEAT_INTERVAL=60,
+        PROCESSING_MAX_WAIT=6 * 3600,
+        PROCESSING_POOL_SIZE=1,
+        ROAD_CACHE_SIZE=256,
+        SNAPPING_BEAM_MARGIN=None,
+        SNAPPING_COST_CUTOFF=None,
+        SNAPPING_PROXIMITY_GRID=None,
+        TRACK_UPLOAD_MAX_SIZE=64 * 1024 * 1024,
+        METRICS_TOKEN=None,
     )
 )
 
@@ -163,6 +175,9 @@ def configure_paths(c):
     c.PROCESSING_OUTPUT_DIR = c.get("PROCESSING_OUTPUT_DIR") or join(
         c.DATA_DIR, "processing-output"
     )
+    c.PROCESSING_CACHE_DIR = c.get("PROCESSING_CACHE_DIR") or join(
+        c.DATA_DIR, "processing-cache"
+    )
     c.TRACKS_DIR = c.get("TRACKS_DIR") or join(c.DATA_DIR, "tracks")
     c.OBS_FACE_CACHE_DIR = c.get("OBS_FACE_CACHE_DIR") or join(
         c.DATA_DIR, "obs-face-cache"
@@ -194,6 +209,11 @@ async def app_connect_db(app, loop):
         app.ctx.export_semaphore = asyncio.Semaphore(app.config.EXPORT_SEMAPHORE_SIZE)
 
 
+@app.after_server_start
+async def app_monitor_event_loop(app, loop):
+    app.add_task(monitor_event_loop_lag())
+
+
 @app.after_server_stop
 async def app_disconnect_db(app, loop):
     if hasattr(app.ctx, "_db_engine_ctx"):
@@ -206,6 +226,19 @@ def remove_right(l, r):
     return l
 
 
+@app.middleware("request")
+async def start_request_timer(req):
+    req.ctx.request_started = time.perf_counter()
+
+
+@app.middleware("response")
+async def observe_request_duration(req, response):
+    if hasattr(req.ctx, "request_started"):
+        observe(
+            "request_duration_seconds", time.perf_counter() - req.ctx.request_started
+        )
+
+
 @app.middleware("request")
 async def inject_arg_getter(req):
     req.ctx.get_single_arg = partial(get_single_arg, req)
@@ -343,6 +376,7 @@ from .routes import (
     tracks,
     users,
     exports,
+    metrics,
 )
 
 from .routes import tiles, mapdetails
@@ -357,7 +391,16 @@ if not app.config.DEDICATED_WORKER:
     async def worker():
         from obs.api.process import process_tracks_loop
 
-        # run forever
-        await process_tracks_loop(10)
+        # run forever, polling only as a fallback to notifications
+        await process_tracks_loop(60)
+
+    # The CPU-bound work happens in the processing pool, so we can keep one
+    # track per pool process in flight.
+    for _ in range(app.config.PROCESSING_POOL_SIZE or 1):
+        app.add_task(worker())
+
+    @app.after_server_stop
+    async def app_shutdown_processing_pool(app, loop):
+        from obs.api.process.pool import shutdown_pool
 
-    app.add_task(worker())
+        shutdown_pool()
@@ -1,4 +1,3 @@
-import hashlib
 from contextvars import ContextVar
 from contextlib import asynccontextmanager
 from datetime import datetime
@@ -7,7 +6,6 @@ from os.path import exists, join, dirname
 from json import loads
 import re
 import math
-import aiofiles
 import random
 import string
 import secrets
@@ -20,6 +18,7 @@ from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker as SessionMaker, relationship
 from sqlalchemy.types import UserDefinedType, BIGINT, TEXT
 from sqlalchemy import (
+    and_,
     Boolean,
     Column,
     DateTime,
@@ -28,6 +27,7 @@ from sqlalchemy import (
     ForeignKey,
     Index,
     Integer,
+    SmallInteger,
     String,
     false,
     func,
@@ -36,7 +36,7 @@ from sqlalchemy import (
     literal,
     Text,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 
 
 log = logging.getLogger(__name__)
@@ -97,6 +97,8 @@ async def connect_db(url, pool_size=10, max_overflow=20):
     sessionmaker = None
 
 
+NOW = text("NOW()")
+
 ZoneType = SqlEnum("rural", "urban", "motorway", name="zone_type")
 ProcessingStatus = SqlEnum(
     "created", "queued", "processing", "complete", "error", name="processing_status"
@@ -198,6 +200,18 @@ class Road(Base):
         }
 
 
+class RoadImport(Base):
+    """
+    Records when the roads of each import group were last imported. Results
+    that depend on the road data, such as cached snapping results, are
+    invalidated by a newer import.
+    """
+
+    __tablename__ = "road_import"
+    import_group = Column(String, primary_key=True)
+    imported_at = Column(DateTime, nullable=False, server_default=NOW)
+
+
 class RoadUsage(Base):
     __tablename__ = "road_usage"
     __table_args__ = (Index("road_usage_segment", "way_id", "direction_reversed"),)
@@ -219,7 +233,22 @@ class RoadUsage(Base):
         return self.hex_hash == other.hex_hash
 
 
-NOW = text("NOW()")
+# Priorities of queued tracks. Workers process tracks with a lower value
+# first, so tracks the user is waiting for are not stuck behind bulk jobs.
+PROCESSING_PRIORITY_INTERACTIVE = 0
+PROCESSING_PRIORITY_BULK = 10
+PROCESSING_PRIORITY_BACKGROUND = 20
+
+
+# Channel on which the database notifies listeners whenever a track is queued
+# for processing (see the `track_queued_notify` trigger).
+TRACK_QUEUED_CHANNEL = "track_queued"
+
+
+# Name of the file in the processing output directory of a track that holds the
+# response of `/tracks/<slug>/data`. A gzip-compressed copy is stored next to
+# it, with the additional extension `.gz`.
+TRACK_DATA_FILE = "data.json"
 
 
 class DuplicateTrackFileError(ValueError):
@@ -238,10 +267,26 @@ class Track(Base):
 
     processing_status = Column(ProcessingStatus, server_default=literal("created"))
     processing_queued_at = Column(DateTime)
-    processed_at = Column(DateTime)
+    processing_priority = Column(
+        SmallInteger,
+        nullable=False,
+        server_default=literal(PROCESSING_PRIORITY_INTERACTIVE),
+    )
+    processed_at = Column(DateTime, index=True)
+
+    # The worker that claimed this track for processing, and until when its
+    # claim is valid. The worker extends the lease while it is working on the
+    # track. If the lease runs out, e.g. because the worker crashed, the track
+    # may be claimed by another worker.
+    processing_worker = Column(String)
+    processing_lease_until = Column(DateTime)
 
     processing_log = Column(TEXT)
 
+    # Durations of the processing stages and counts of processed items, see
+    # `obs.api.metrics.ProcessingStats`.
+    processing_stats = Column(JSONB)
+
     # Set to true if the user customized the title. Disables auto-generating
     # an updated title when the track is (re-)processed.
     customized_title = Column(Boolean, server_default=false(), nullable=False)
@@ -290,6 +335,19 @@ class Track(Base):
     num_valid = Column(Integer)
     geometry = Column(LineString)
 
+    __table_args__ = (
+        Index("ix_track_processing_queue", "processing_status", "processing_queued_at"),
+        Index(
+            "ix_track_processing_priority",
+            "processing_priority",
+            "processing_queued_at",
+            postgresql_where=text("processing_status = 'queued'"),
+        ),
+        Index(
+            "ix_track_author_id_original_file_hash", "author_id", "original_file_hash"
+        ),
+    )
+
     def to_dict(self, for_user_id=None):
         result = {
             "id": self.id,
@@ -337,35 +395,33 @@ class Track(Base):
         # make unique
         self.slug += random_string(8)
 
-    async def prevent_duplicates(self, session, file_body):
-        hex_hash = hashlib.sha512(file_body).hexdigest()
-
+    async def prevent_duplicates(self, session, file_hash):
         duplicate_count = await session.scalar(
             select(func.count())
             .select_from(Track)
             .where(
-                Track.original_file_hash == hex_hash
-                and Track.author_id == self.author_id
-                and Track.id != self.id
+                and_(
+                    Track.author_id == self.author_id,
+                    Track.original_file_hash == file_hash,
+                    Track.id != self.id,
+                )
             )
         )
 
         if duplicate_count:
             raise DuplicateTrackFileError()
 
-        self.original_file_hash = hex_hash
-
-    async def write_to_original_file(self, config, body):
-        mode = "wb" if isinstance(body, bytes) else "wt"
+        self.original_file_hash = file_hash
 
-        target = self.get_original_file_path(config)
-        os.makedirs(dirname(target), exist_ok=True)
-        async with aiofiles.open(target, mode=mode) as f:
-            await f.write(body)
+    def move_to_original_file(self, config, upload):
+        upload.move_to(self.get_original_file_path(config))
 
-    def queue_processing(self):
+    def queue_processing(self, priority=PROCESSING_PRIORITY_INTERACTIVE):
         self.processing_status = "queued"
+        self.processing_priority = priority
         self.processing_queued_at = datetime.utcnow()
+        self.processing_worker = None
+        self.processing_lease_until = None
 
     def auto_generate_title(self):
         if self.customized_title:
@@ -407,6 +463,9 @@ class Track(Base):
     def get_original_file_path(self, config):
         return join(config.TRACKS_DIR, self.file_path, "original.csv")
 
+    def get_processing_output_path(self, config, filename):
+        return join(config.PROCESSING_OUTPUT_DIR, self.file_path, filename)
+
 
 class User(Base):
     __tablename__ = "user"
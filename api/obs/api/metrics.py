@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+
+# The content type of the Prometheus text exposition format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """
+    A simple in-memory histogram of observed values, with fixed bucket
+    boundaries. Only counts are stored, so it does not grow over time.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.add(bisect_left(self.buckets, value), 1, value)
+
+    def add(self, bucket, count, total):
+        """
+        Adds `count` values with the sum `total` to the bucket of the given
+        index, e.g. as aggregated in the database.
+        """
+        self.counts[bucket] += count
+        self.count += count
+        self.sum += total
+
+    def format_samples(self, name, labels=()):
+        """
+        Returns the lines of the samples of this histogram in the Prometheus
+        text format, as metric `name` with the given `(label, value)` pairs.
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            bucket_labels = format_labels(tuple(labels) + (("le", str(bound)),))
+            lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+
+        lines.append(f"{name}_sum{format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+def format_labels(labels):
+    """
+    Formats `(label, value)` pairs as the label set of a sample in the
+    Prometheus text format, escaping the values.
+    """
+    if not labels:
+        return ""
+
+    items = []
+    for label, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        items.append(f'{label}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+_histograms = {}
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS):
+    """
+    Returns the histogram of the given name, creating it on first use.
+    """
+    if name not in _histograms:
+        _histograms[name] = Histogram(buckets)
+    return _histograms[name]
+
+
+def observe(name, value):
+    histogram(name).observe(value)
+
+
+def get_metrics():
+    """
+    Returns all histograms of this process, as lines of the Prometheus text
+    format.
+    """
+    lines = []
+    for name, h in sorted(_histograms.items()):
+        lines.append(f"# TYPE {name} histogram")
+        lines.extend(h.format_samples(name))
+    return lines
+
+
+class ProcessingStats:
+    """
+    Durations of the stages of processing a track, in seconds, and counts of
+    the processed items (points, roads, candidates, ...). Stages that run in
+    the processing pool return their own instance, which is merged into the
+    one of the track with `update()`, adding up timings and counts.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def set_count(self, name, value):
+        self.counts[name] = int(value)
+
+    def add_count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def update(self, other):
+        for name, seconds in other.timings.items():
+            self.add_time(name, seconds)
+        for name, value in other.counts.items():
+            self.add_count(name, value)
+
+    def to_dict(self):
+        return {
+            "timings": {name: round(t, 6) for name, t in self.timings.items()},
+            "counts": dict(self.counts),
+        }
+
+
+def get_bucket_thresholds(buckets=DEFAULT_BUCKETS):
+    """
+    Returns the thresholds for PostgreSQL's `width_bucket(-value, thresholds)`,
+    which counts the thresholds <= -value, i.e. the bucket bounds >= value.
+    The index of the bucket of the value is the number of bounds minus that,
+    as in `Histogram.observe`.
+    """
+    return sorted(-bound for bound in buckets)
+
+
+def get_stage_metrics(stage_buckets, count_totals):
+    """
+    Builds one histogram per processing stage from the stage timings of many
+    processed tracks, aggregated by stage and bucket index (see
+    `get_bucket_thresholds`) as `(stage, bucket, count, sum)` rows, and adds
+    the totals of their counts, given as `(name, total)` rows. Returns the
+    lines of the Prometheus text format.
+
+    These only cover the recently processed tracks, so they are not counters,
+    and may decrease: the counts are gauges, and the histograms are meant to
+    be used without `rate()`.
+    """
+    histograms = {}
+    for stage, bucket, count, total in stage_buckets:
+        if stage not in histograms:
+            histograms[stage] = Histogram()
+        histograms[stage].add(bucket, count, total)
+
+    lines = []
+    if histograms:
+        lines.append("# TYPE track_processing_stage_seconds histogram")
+    for name, h in sorted(histograms.items()):
+        lines.extend(
+            h.format_samples("track_processing_stage_seconds", [("stage", name)])
+        )
+
+    if count_totals:
+        lines.append("# TYPE track_processing_count gauge")
+    for name, total in sorted(count_totals):
+        labels = format_labels([("count", name)])
+        lines.append(f"track_processing_count{labels} {total}")
+    return lines
+
+
+async def monitor_event_loop_lag(interval=1.0):
+    """
+    Measures how late the event loop wakes up from a sleep, which is the time
+    that other (blocking) code kept the loop busy, and records it in the
+    `event_loop_lag_seconds` histogram.
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        observe("event_loop_lag_seconds", time.perf_counter() - started - interval)
@@ -0,0 +1,91 @@
+import pickle
+from bisect import bisect_left
+
+from obs.api.metrics import (
+    DEFAULT_BUCKETS,
+    Histogram,
+    ProcessingStats,
+    get_bucket_thresholds,
+    get_stage_metrics,
+)
+
+
+def test_processing_stats_merge():
+    stats = ProcessingStats()
+    with stats.stage("snap"):
+        pass
+    stats.set_count("points", 10)
+
+    pool_stats = pickle.loads(pickle.dumps(ProcessingStats()))
+    pool_stats.add_time("snap", 1.5)
+    pool_stats.add_time("snap.viterbi", 1.0)
+    pool_stats.set_count("candidates", 42)
+
+    stats.update(pool_stats)
+
+    result = stats.to_dict()
+    assert result["counts"] == {"points": 10, "candidates": 42}
+    assert result["timings"]["snap"] >= 1.5
+    assert result["timings"]["snap.viterbi"] == 1.0
+
+
+def width_bucket(operand, thresholds):
+    # PostgreSQL's `width_bucket(operand, thresholds)`
+    return sum(1 for threshold in thresholds if threshold <= operand)
+
+
+def test_bucket_thresholds():
+    thresholds = get_bucket_thresholds()
+    values = [0, 0.001, 0.25, 0.3, 1, 299, 300, 301] + list(DEFAULT_BUCKETS)
+
+    for value in values:
+        bucket = len(DEFAULT_BUCKETS) - width_bucket(-value, thresholds)
+        assert bucket == bisect_left(DEFAULT_BUCKETS, value)
+
+
+def test_stage_metrics():
+    thresholds = get_bucket_thresholds()
+
+    def bucket(value):
+        return len(DEFAULT_BUCKETS) - width_bucket(-value, thresholds)
+
+    metrics = get_stage_metrics(
+        [
+            ("snap", bucket(0.2), 1, 0.2),
+            ("import_csv", bucket(0.01), 1, 0.01),
+            ("snap", bucket(3), 1, 3),
+        ],
+        [("proximity_memo_hits", 7), ("proximity_memo_misses", 1)],
+    )
+
+    assert metrics[0] == "# TYPE track_processing_stage_seconds histogram"
+    assert 'track_processing_stage_seconds_count{stage="snap"} 2' in metrics
+    assert 'track_processing_stage_seconds_sum{stage="snap"} 3.2' in metrics
+    assert 'track_processing_stage_seconds_bucket{stage="snap",le="0.25"} 1' in metrics
+    assert 'track_processing_stage_seconds_bucket{stage="snap",le="2.5"} 1' in metrics
+    assert 'track_processing_stage_seconds_bucket{stage="snap",le="5"} 2' in metrics
+    assert 'track_processing_stage_seconds_bucket{stage="snap",le="+Inf"} 2' in metrics
+    import_csv = 'track_processing_stage_seconds_bucket{stage="import_csv",le="%s"} %d'
+    assert import_csv % ("0.005", 0) in metrics
+    assert import_csv % ("0.01", 1) in metrics
+
+    assert metrics[-3:] == [
+        "# TYPE track_processing_count gauge",
+        'track_processing_count{count="proximity_memo_hits"} 7',
+        'track_processing_count{count="proximity_memo_misses"} 1',
+    ]
+
+
+def test_histogram_samples():
+    histogram = Histogram(buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(0.5)
+
+    assert histogram.format_samples("duration_seconds", [("path", 'a"b')]) == [
+        'duration_seconds_bucket{path="a\\"b",le="0.1"} 1',
+        'duration_seconds_bucket{path="a\\"b",le="1"} 3',
+        'duration_seconds_bucket{path="a\\"b",le="+Inf"} 3',
+        'duration_seconds_sum{path="a\\"b"} 1.05',
+        'duration_seconds_count{path="a\\"b"} 3',
+    ]
@@ -3,60 +3,296 @@ import logging
 import os
 import json
 import asyncio
+import gzip
 import hashlib
+import secrets
+import socket
 import struct
+import tempfile
+import time
 import pytz
-from os.path import join
-from datetime import datetime
+from contextlib import asynccontextmanager, contextmanager
+from os.path import dirname, join
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape as xml_escape
 
 import numpy
-from shapely import Point
-from shapely.wkb import dumps as dump_wkb
-from sqlalchemy import delete, func, select, and_
+import pandas
+from sqlalchemy import delete, func, select, text, update, and_
 from sqlalchemy.orm import joinedload
 from haversine import Unit, haversine_vector
 from geopy import distance
 
-from .snapping import snap_to_roads, wsg84_to_mercator
+from .snapping import snap_to_roads, WSG84_TO_MERCATOR
 from .obs_csv import import_csv
-
-from obs.api.db import OvertakingEvent, RoadUsage, Track, UserDevice, make_session
+from .pool import configure_pool, run_in_pool
+from .road_cache import configure_road_cache, get_road_cache
+from .cache import (
+    get_cache_key,
+    get_road_version,
+    load_cached_track,
+    store_cached_track,
+)
+
+from obs.api import db
+from obs.api.db import (
+    OvertakingEvent,
+    RoadUsage,
+    Track,
+    UserDevice,
+    TRACK_QUEUED_CHANNEL,
+    TRACK_DATA_FILE,
+    make_session,
+)
 from obs.api.app import app
+from obs.api.metrics import ProcessingStats, observe
 
 log = logging.getLogger(__name__)
 
 
-async def process_tracks_loop(delay):
-    while True:
-        try:
-            async with make_session() as session:
-                track = (
-                    await session.execute(
-                        select(Track)
-                        .where(Track.processing_status == "queued")
-                        .order_by(Track.processing_queued_at)
-                        .with_for_update(of=Track)
-                        .options(joinedload(Track.author))
+def make_worker_id():
+    """
+    Generates an identifier for this worker that is unique across hosts and
+    processes, to mark tracks as claimed by this worker.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+
+async def _select_claimable_track(session, *conditions, order_by):
+    return (
+        await session.execute(
+            select(Track)
+            .where(*conditions)
+            .order_by(*order_by)
+            .limit(1)
+            .with_for_update(of=Track, skip_locked=True)
+            .options(joinedload(Track.author))
+        )
+    ).scalar()
+
+
+# Every this many claims of a worker, tracks that have waited for longer than
+# PROCESSING_MAX_WAIT are claimed first. The other claims go by priority, so
+# that after requeueing a large backlog, which all ages at once, new uploads
+# still do not wait behind all of it.
+AGED_CLAIM_INTERVAL = 4
+
+
+async def claim_track(
+    session, worker_id, lease_duration, max_wait=None, claim_number=0
+):
+    """
+    Claims the next queued track for this worker, and returns it, or `None`
+    if the queue is empty.
+
+    Tracks are claimed in this order, each step being a query backed by an
+    index on the track table:
+
+    * Tracks whose lease has run out (because the worker that processed them
+      died) are reclaimed first.
+    * Only for every `AGED_CLAIM_INTERVAL`th claim of the worker, counted by
+      `claim_number`: tracks that have waited for longer than `max_wait`
+      seconds, oldest first, so that a steady stream of high priority tracks
+      cannot starve the lower priorities.
+    * All other queued tracks by priority, and oldest first within the same
+      priority.
+
+    Rows locked by other workers, which are in the process of claiming them,
+    are skipped instead of waited for, so many workers can claim tracks
+    concurrently. The claim is committed before returning, so the row lock is
+    not held while processing.
+    """
+    now = datetime.utcnow()
+
+    track = await _select_claimable_track(
+        session,
+        Track.processing_status == "processing",
+        Track.processing_lease_until < now,
+        order_by=[Track.processing_queued_at],
+    )
+
+    if (
+        track is None
+        and max_wait is not None
+        and claim_number % AGED_CLAIM_INTERVAL == 0
+    ):
+        track = await _select_claimable_track(
+            session,
+            Track.processing_status == "queued",
+            Track.processing_queued_at < now - timedelta(seconds=max_wait),
+            order_by=[Track.processing_queued_at],
+        )
+
+    if track is None:
+        track = await _select_claimable_track(
+            session,
+            Track.processing_status == "queued",
+            order_by=[Track.processing_priority, Track.processing_queued_at],
+        )
+
+    if track is None:
+        await session.rollback()
+        return None
+
+    if track.processing_status == "processing":
+        log.warning(
+            "Lease of worker %s for track %s expired, reclaiming it.",
+            track.processing_worker,
+            track.slug,
+        )
+
+    track.processing_status = "processing"
+    track.processing_worker = worker_id
+    track.processing_lease_until = now + timedelta(seconds=lease_duration)
+    await session.commit()
+
+    return track
+
+
+@asynccontextmanager
+async def keep_lease(track, worker_id, lease_duration, interval):
+    """
+    Periodically extends the processing lease of the track while the context
+    is active. Uses its own session, as the processing session is busy.
+    """
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with make_session() as session:
+                    result = await session.execute(
+                        update(Track)
+                        .where(
+                            and_(
+                                Track.id == track.id,
+                                Track.processing_worker == worker_id,
+                            )
+                        )
+                        .values(
+                            processing_lease_until=datetime.utcnow()
+                            + timedelta(seconds=lease_duration),
+                            updated_at=Track.updated_at,
+                        )
+                    )
+                    await session.commit()
+
+                if result.rowcount == 0:
+                    log.warning(
+                        "Worker %s lost its lease on track %s.", worker_id, track.slug
                     )
-                ).scalar()
+                    return
+            except Exception:
+                log.exception("Failed to extend lease of track %s.", track.slug)
 
-                if track is None:
-                    await asyncio.sleep(delay)
-                    continue
+    task = asyncio.create_task(heartbeat())
+    try:
+        yield
+    finally:
+        task.cancel()
 
-                await process_track(session, track)
-        except Exception:
-            log.exception("Failed to process track. Will continue.")
-            await asyncio.sleep(1)
-            continue
+
+@asynccontextmanager
+async def track_queued_notifications():
+    """
+    Listens for notifications about newly queued tracks on a dedicated
+    database connection. Yields an :py:class:`asyncio.Event` that is set
+    whenever a track is queued.
+
+    If listening is not possible, e.g. because the database driver does not
+    support it, the event is never set, and callers have to rely on polling.
+    """
+    event = asyncio.Event()
+    connection = None
+
+    try:
+        connection = await db.engine.connect()
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.add_listener(
+            TRACK_QUEUED_CHANNEL, lambda *args: event.set()
+        )
+    except Exception:
+        log.warning(
+            "Cannot listen for queued tracks, falling back to polling.", exc_info=True
+        )
+
+    try:
+        yield event
+    finally:
+        if connection is not None:
+            await connection.close()
+
+
+async def wait_for_queued_track(event, timeout):
+    """
+    Waits until the event is set, or the timeout (in seconds) has passed.
+    """
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+
+async def process_tracks_loop(delay, worker_id=None):
+    """
+    Processes tracks from the queue forever. Any number of these loops can run
+    concurrently, in the same or in different processes or hosts, each one
+    processing a different track.
+
+    When the queue is empty, the loop waits for a notification from the
+    database, but checks the queue at least every `delay` seconds.
+    """
+    worker_id = worker_id or make_worker_id()
+    lease_duration = app.config.PROCESSING_LEASE_DURATION
+    max_wait = app.config.PROCESSING_MAX_WAIT
+    heartbeat_interval = app.config.PROCESSING_HEARTBEAT_INTERVAL
+    configure_pool(app.config.PROCESSING_POOL_SIZE)
+    configure_road_cache(app.config.ROAD_CACHE_SIZE * 1024 * 1024)
+
+    log.info("Worker %s started.", worker_id)
+    claim_number = 0
+
+    async with track_queued_notifications() as track_queued:
+        while True:
+            try:
+                async with make_session() as session:
+                    track = await claim_track(
+                        session, worker_id, lease_duration, max_wait, claim_number
+                    )
+
+                    if track is None:
+                        await wait_for_queued_track(track_queued, delay)
+                        continue
+
+                    claim_number += 1
+
+                    async with keep_lease(
+                        track, worker_id, lease_duration, heartbeat_interval
+                    ):
+                        await process_track(session, track)
+            except Exception:
+                log.exception("Failed to process track. Will continue.")
+                await asyncio.sleep(1)
+                continue
 
 
 async def process_tracks(tracks):
     """
     Processes the tracks and writes event data to the database.
 
+    The tracks are claimed with a lease, like in the
+    :py:func:`process_tracks_loop`, so if this process dies, a worker will
+    reclaim them.
+
     :param tracks: A list of strings which
     """
+    worker_id = make_worker_id()
+    lease_duration = app.config.PROCESSING_LEASE_DURATION
+    heartbeat_interval = app.config.PROCESSING_HEARTBEAT_INTERVAL
+    configure_pool(app.config.PROCESSING_POOL_SIZE)
+    configure_road_cache(app.config.ROAD_CACHE_SIZE * 1024 * 1024)
+
     async with make_session() as session:
         for track_id_or_slug in tracks:
             track = (
@@ -74,7 +310,15 @@ async def process_tracks(tracks):
             if not track:
                 raise ValueError(f"Track {track_id_or_slug!r} not found.")
 
-            await process_track(session, track)
+            track.processing_status = "processing"
+            track.processing_worker = worker_id
+            track.processing_lease_until = datetime.utcnow() + timedelta(
+                seconds=lease_duration
+            )
+            await session.commit()
+
+            async with keep_lease(track, worker_id, lease_duration, heartbeat_interval):
+                await process_track(session, track)
 
 
 def to_naive_utc(t):
@@ -83,42 +327,162 @@ def to_naive_utc(t):
     return t.astimezone(pytz.UTC).replace(tzinfo=None)
 
 
-async def export_gpx(df, filename, name):
-    import xml.etree.ElementTree as ET
+# Rows formatted at once when writing GPX files
+GPX_CHUNK_SIZE = 10000
+
+
+def export_gpx(df, filename, name):
+    """
+    Writes the raw track points of the dataframe as a GPX file. The file is
+    written in chunks, formatting the coordinates and timestamps of many
+    points at once, and replaced atomically.
+    """
+    name = xml_escape(name)
+    latitude = df["latitude"].to_numpy(numpy.float64)
+    longitude = df["longitude"].to_numpy(numpy.float64)
+
+    with open_atomic(filename, "wt", encoding="utf-8") as fp:
+        fp.write(
+            "<?xml version='1.0' encoding='utf-8'?>\n"
+            f"<gpx><metadata><name>{name}</name></metadata>"
+            f"<trk><name>{name}</name><type>Cycling</type><trkseg>"
+        )
+
+        for start in range(0, len(df), GPX_CHUNK_SIZE):
+            end = start + GPX_CHUNK_SIZE
+            times = to_isoformat_list(df["datetime"].iloc[start:end])
+            fp.write(
+                "".join(
+                    f'<trkpt lat="{lat}" lon="{lon}"><time>{time}+00:00</time></trkpt>'
+                    for lat, lon, time in zip(
+                        latitude[start:end].astype(str),
+                        longitude[start:end].astype(str),
+                        times,
+                    )
+                )
+            )
+
+        fp.write("</trkseg></trk></gpx>")
+
+
+def export_gpx_from_file(track_file, filename, name):
+    """
+    Parses the original track file and exports it as GPX. The GPX export is
+    only generated when it is first downloaded, see
+    :py:func:`obs.api.routes.tracks.download_track_gpx`.
+    """
+    df, _ = import_csv(track_file)
+    export_gpx(df, filename, name)
+
 
-    gpx = ET.Element("gpx")
-    metadata = ET.SubElement(gpx, "metadata")
-    ET.SubElement(metadata, "name").text = name
+# Files written by previous versions, replaced by the TRACK_DATA_FILE, and the
+# GPX export, which is generated again on the next download.
+STALE_OUTPUT_FILES = ["events.json", "track.json", "trackRaw.json", "track.gpx"]
 
-    trk = ET.SubElement(gpx, "trk")
 
-    ET.SubElement(trk, "name").text = name
-    ET.SubElement(trk, "type").text = "Cycling"
+# Holds the processing cache key of the result the track data was built from
+OUTPUT_KEY_FILE = "data.key"
 
-    trkseg = ET.SubElement(trk, "trkseg")
 
-    for _, point in df.iterrows():
-        trkpt = ET.SubElement(
-            trkseg, "trkpt", lat=str(point["latitude"]), lon=str(point["longitude"])
+def has_track_outputs(output_dir, cache_key):
+    """
+    Returns whether the track data in the output directory was written for
+    the processing result of the cache key, so it need not be written again.
+    """
+    try:
+        with open(join(output_dir, OUTPUT_KEY_FILE)) as f:
+            if f.read() != cache_key:
+                return False
+    except FileNotFoundError:
+        return False
+
+    return all(
+        os.path.exists(join(output_dir, filename))
+        for filename in (TRACK_DATA_FILE, f"{TRACK_DATA_FILE}.gz")
+    )
+
+
+def write_track_outputs(output_dir, data, cache_key=None):
+    """
+    Writes the track data (the events, the snapped and the raw track) of a
+    processed track into the output directory, and the cache key of the
+    processing result it was built from, if given. Returns the
+    `ProcessingStats` of writing them.
+
+    The track data is stored as compact JSON, exactly as it is served to the
+    frontend, so serving it requires no parsing, once as-is and once
+    gzip-compressed, for clients that accept that.
+    """
+    stats = ProcessingStats()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # The key is only valid again once all files are written
+    if os.path.exists(join(output_dir, OUTPUT_KEY_FILE)):
+        os.unlink(join(output_dir, OUTPUT_KEY_FILE))
+
+    with stats.stage("write_outputs.json"):
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        write_file_atomic(join(output_dir, TRACK_DATA_FILE), body)
+
+    with stats.stage("write_outputs.gzip"):
+        write_file_atomic(
+            join(output_dir, f"{TRACK_DATA_FILE}.gz"),
+            gzip.compress(body, compresslevel=9),
         )
-        ET.SubElement(trkpt, "time").text = point["datetime"].isoformat()
 
-    et = ET.ElementTree(gpx)
-    et.write(filename, encoding="utf-8", xml_declaration=True)
+    for filename in STALE_OUTPUT_FILES:
+        if os.path.exists(join(output_dir, filename)):
+            os.unlink(join(output_dir, filename))
 
+    if cache_key:
+        write_file_atomic(join(output_dir, OUTPUT_KEY_FILE), cache_key.encode())
 
-async def process_track(session, track):
+    return stats
+
+
+def write_file_atomic(target, content):
+    """
+    Writes the file such that readers see either the old or the new
+    content, never a partially written file.
+    """
+    with open_atomic(target, "wb") as fp:
+        fp.write(content)
+
+
+@contextmanager
+def open_atomic(target, mode, **kwargs):
+    """
+    Opens a new temporary file next to the target for writing, which replaces
+    the target once it is closed without an error. Every writer has its own
+    temporary file, so concurrent writers of the same target, e.g. two
+    downloads generating the same GPX export, do not interfere.
+    """
+    fd, tmp_target = tempfile.mkstemp(dir=dirname(target), suffix=".tmp")
     try:
-        track.processing_status = "complete"
-        track.processed_at = datetime.utcnow()
-        await session.commit()
+        with os.fdopen(fd, mode, **kwargs) as fp:
+            yield fp
+        os.replace(tmp_target, target)
+    except BaseException:
+        os.unlink(tmp_target)
+        raise
+
 
+async def process_track(session, track):
+    started = time.perf_counter()
+    stats = ProcessingStats()
+
+    try:
         original_file_path = track.get_original_file_path(app.config)
 
         output_dir = join(
             app.config.PROCESSING_OUTPUT_DIR, track.author.username, track.slug
         )
-        os.makedirs(output_dir, exist_ok=True)
+
+        with stats.stage("road_version"):
+            road_version = await get_road_version(session)
+        cache_key = get_cache_key(
+            track.original_file_hash, road_version, get_snapping_options()
+        )
 
         (
             df,
@@ -127,23 +491,31 @@ async def process_track(session, track):
             events,
             track_json,
             track_raw_json,
-        ) = await process_track_file(session, original_file_path)
-
-        for output_filename, data in [
-            ("events.json", events),
-            ("track.json", track_json),
-            ("trackRaw.json", track_raw_json),
-        ]:
-            target = join(output_dir, output_filename)
-            log.debug("Writing file %s", target)
-            with open(target, "wt", encoding="utf-8") as fp:
-                json.dump(data, fp, indent=4)
-
-        await export_gpx(df, join(output_dir, "track.gpx"), track.slug)
+        ) = await process_track_file(session, original_file_path, cache_key, stats)
+
+        # If the track data was written for the same result before, e.g. when
+        # only the visibility of the track changed, only the database rows are
+        # written again, and the track keeps its `processed_at` (the version
+        # of its track data).
+        outputs_written = not has_track_outputs(output_dir, cache_key)
+        if outputs_written:
+            with stats.stage("write_outputs"):
+                output_stats = await run_in_pool(
+                    write_track_outputs,
+                    output_dir,
+                    {
+                        "events": events,
+                        "track": track_json,
+                        "trackRaw": track_raw_json,
+                    },
+                    cache_key,
+                )
+            stats.update(output_stats)
 
         log.info("Clear old track data...")
-        await clear_track_data(session, track)
-        await session.commit()
+        with stats.stage("clear_track_data"):
+            await clear_track_data(session, track)
+            await session.commit()
 
         device_identifier = track_metadata.get("DeviceId")
         if device_identifier:
@@ -173,10 +545,13 @@ async def process_track(session, track):
             log.info("No DeviceId in track metadata.")
 
         log.info("Import events into database...")
-        await import_overtaking_events(session, track, event_rows)
+        with stats.stage("import_events"):
+            await import_overtaking_events(session, track, event_rows)
 
         log.info("Import road usages...")
-        await import_road_usages(session, track, df)
+        with stats.stage("import_road_usages"):
+            road_usage_count = await import_road_usages(session, track, df)
+        stats.set_count("road_usages", road_usage_count)
 
         # compute distance from previous point
         coordinates = numpy.dstack((df["latitude"], df["longitude"]))[0].tolist()
@@ -188,28 +563,43 @@ async def process_track(session, track):
             )
         )
 
+        # do not count the gaps between segments
+        df.loc[df["segment"].diff() != 0, "distance"] = numpy.nan
+
         log.info("Write track statistics and update status...")
         # statistics = compute_statistics(df)
         track.recorded_at = to_naive_utc(numpy.nanmin(df["datetime"]))
         track.recorded_until = to_naive_utc(numpy.nanmax(df["datetime"]))
         track.duration = (track.recorded_until - track.recorded_at).total_seconds()
         track.length = numpy.nansum(df["distance"])
-        track.segments = 1  # we don't do splitting yet
+        track.segments = int(df["segment"].nunique())
         track.num_events = len(event_rows)
         track.num_measurements = len(event_rows)  # not distinguished anymore
         track.num_valid = len(event_rows)  # not distinguished anymore
         track.processing_status = "complete"
-        track.processed_at = datetime.utcnow()
+        track.processing_worker = None
+        track.processing_lease_until = None
+        if outputs_written or track.processed_at is None:
+            track.processed_at = datetime.utcnow()
         track.geometry = func.ST_Transform(
             func.ST_GeomFromGeoJSON(json.dumps(track_raw_json["geometry"])),
             3857,
         )
+
+        duration = time.perf_counter() - started
+        stats.add_time("total", duration)
+        track.processing_stats = stats.to_dict()
+
         await session.commit()
 
-        log.info("Track %s imported.", track.slug)
+        observe("track_processing_seconds", duration)
+        log.info("Track %s imported in %.1fs.", track.slug, duration)
+        log.debug("Processing stats: %s", stats.to_dict())
     except BaseException as e:
         await clear_track_data(session, track)
         track.processing_status = "error"
+        track.processing_worker = None
+        track.processing_lease_until = None
         track.processing_log = str(e)
         track.processed_at = datetime.utcnow()
 
@@ -217,21 +607,145 @@ async def process_track(session, track):
         raise
 
 
-def fix_nan(v):
-    if numpy.isnan(v):
-        return None
-    return v
+def nan_to_none(values):
+    """
+    Converts an array of floats to a list, replacing NaN with None.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    return numpy.where(numpy.isnan(values), None, values).tolist()
+
+
+def to_isoformat_list(datetimes):
+    """
+    Formats a series of UTC datetimes as ISO 8601 strings without timezone,
+    like `datetime.isoformat()` does for naive datetimes.
+    """
+    values = datetimes.dt.tz_convert(pytz.utc).dt.tz_localize(None)
+    seconds = values.to_numpy().astype("datetime64[s]")
+    result = numpy.datetime_as_string(seconds, unit="s").tolist()
+
+    # Only timestamps with fractions of a second need special formatting
+    for i in numpy.flatnonzero(seconds != values.to_numpy()):
+        result[i] = values.iloc[i].isoformat()
+
+    return result
+
+
+# The layout of `struct.pack("ddQ", latitude, longitude, timestamp)`, which
+# is hashed to identify an event.
+EVENT_HASH_DTYPE = numpy.dtype(
+    [("latitude", "=f8"), ("longitude", "=f8"), ("time", "=u8")]
+)
+
+
+def to_hash_timestamps(datetimes):
+    """
+    Converts a series of timezone-aware datetimes into integer UNIX
+    timestamps exactly like `int(t.timestamp())`, which rounds to
+    microseconds before truncating.
+    """
+    seconds = to_timestamp_array(datetimes, unit="ns") / 1e9
+    whole = numpy.floor(seconds)
+    return (whole + (seconds - whole > 0.9999995)).astype(numpy.uint64)
+
+
+def hash_events(latitude, longitude, datetimes):
+    """
+    Computes the hex hash identifying each event, from arrays of its
+    location and a series of its times. All records are packed into one
+    buffer, and each fixed-width record is hashed from a view into it.
+    """
+    records = numpy.empty(len(latitude), dtype=EVENT_HASH_DTYPE)
+    records["latitude"] = latitude
+    records["longitude"] = longitude
+    records["time"] = to_hash_timestamps(datetimes)
+
+    buffer = memoryview(records.tobytes())
+    size = EVENT_HASH_DTYPE.itemsize
+    return [
+        hashlib.sha256(buffer[offset : offset + size]).hexdigest()
+        for offset in range(0, len(buffer), size)
+    ]
+
+
+def get_snapping_options():
+    """
+    Returns the configured options of :py:func:`snap_to_roads` that are not
+    the defaults.
+    """
+    options = {
+        "beam_margin": app.config.SNAPPING_BEAM_MARGIN,
+        "cost_cutoff": app.config.SNAPPING_COST_CUTOFF,
+        "proximity_grid": app.config.SNAPPING_PROXIMITY_GRID,
+    }
+    return {name: value for name, value in options.items() if value is not None}
 
 
-async def process_track_file(session, track_file):
-    log.info("Load CSV file at %s", track_file)
-    df, track_metadata = import_csv(track_file)
+async def process_track_file(session, track_file, cache_key=None, stats=None):
+    """
+    Parses the track file, snaps it to the roads, and extracts the events.
+    If a `cache_key` is given, the parsed and snapped track is taken from
+    the processing cache, or stored in it. Stage timings and counts are added
+    to `stats`, if given.
+    """
+    stats = stats if stats is not None else ProcessingStats()
+    cache_dir = app.config.PROCESSING_CACHE_DIR if cache_key else None
+    cached = None
+
+    if cache_dir:
+        with stats.stage("cache_load"):
+            cached = await run_in_pool(load_cached_track, cache_dir, cache_key)
+
+    if cached is not None:
+        log.info("Using cached snapping result for %s", track_file)
+        df, track_metadata = cached
+    else:
+        log.info("Load CSV file at %s", track_file)
+        with stats.stage("import_csv"):
+            df, track_metadata = await run_in_pool(import_csv, track_file)
+
+        # Snap track to roads from the database, adding latitude_snapped and longitude_snapped
+        df = await snap_to_roads(
+            session, df, get_road_cache(), stats=stats, **get_snapping_options()
+        )
+
+        if cache_dir:
+            with stats.stage("cache_store"):
+                try:
+                    await run_in_pool(
+                        store_cached_track, cache_dir, cache_key, df, track_metadata
+                    )
+                except OSError:
+                    # e.g. removed by a worker of a newer generation meanwhile
+                    log.warning("Failed to store processing cache entry", exc_info=True)
+
+    with stats.stage("build_json"):
+        event_rows, events, track_json, track_raw_json = await run_in_pool(
+            build_track_json, df
+        )
 
-    # Snap track to roads from the database, adding latitude_snapped and longitude_snapped
-    df = await snap_to_roads(session, df)
+    stats.set_count("points", len(df))
+    stats.set_count("events", len(event_rows))
 
+    return df, event_rows, track_metadata, events, track_json, track_raw_json
+
+
+def build_track_json(df):
+    """
+    Extracts the events from the snapped track, and builds the GeoJSON
+    representations of the events, the snapped and the raw track.
+    """
     # remove entries with missing data
-    event_rows = df[df["confirmed"] & ~numpy.isnan(df["distance_overtaker"])]
+    event_rows = df[df["confirmed"] & ~numpy.isnan(df["distance_overtaker"])].copy()
+
+    latitude = event_rows["latitude"].to_numpy(numpy.float64)
+    longitude = event_rows["longitude"].to_numpy(numpy.float64)
+    event_rows["hex_hash"] = hash_events(latitude, longitude, event_rows["datetime"])
+
+    if "direction_reversed" in event_rows:
+        direction_reversed = (event_rows["direction_reversed"] < 0).tolist()
+    else:
+        direction_reversed = [False] * len(event_rows)
 
     events = {
         "type": "FeatureCollection",
@@ -240,18 +754,36 @@ async def process_track_file(session, track_file):
                 "type": "Feature",
                 "geometry": {
                     "type": "Point",
-                    "coordinates": [row["longitude"], row["latitude"]],
+                    "coordinates": [lon, lat],
                 },
                 "properties": {
-                    "time": row["datetime"].replace(tzinfo=None).isoformat(),
-                    "distance_overtaker": fix_nan(row["distance_overtaker"]),
-                    "distance_stationary": fix_nan(row["distance_stationary"]),
-                    "course": fix_nan(row["course"]),
-                    "speed": fix_nan(row["speed"]),
-                    "direction_reversed": row.get("direction_reversed", 0) < 0,
+                    "time": time,
+                    "distance_overtaker": distance_overtaker,
+                    "distance_stationary": distance_stationary,
+                    "course": course,
+                    "speed": speed,
+                    "direction_reversed": reversed_,
                 },
             }
-            for _, row in event_rows.iterrows()
+            for (
+                lon,
+                lat,
+                time,
+                distance_overtaker,
+                distance_stationary,
+                course,
+                speed,
+                reversed_,
+            ) in zip(
+                longitude.tolist(),
+                latitude.tolist(),
+                to_isoformat_list(event_rows["datetime"]),
+                nan_to_none(event_rows["distance_overtaker"]),
+                nan_to_none(event_rows["distance_stationary"]),
+                nan_to_none(event_rows["course"]),
+                nan_to_none(event_rows["speed"]),
+                direction_reversed,
+            )
         ],
     }
 
@@ -273,7 +805,7 @@ async def process_track_file(session, track_file):
         },
     }
 
-    return df, event_rows, track_metadata, events, track_json, track_raw_json
+    return event_rows, events, track_json, track_raw_json
 
 
 async def clear_track_data(session, track):
@@ -292,90 +824,237 @@ async def clear_track_data(session, track):
     await session.execute(delete(RoadUsage).where(RoadUsage.track_id == track.id))
 
 
+def to_naive_utc_array(datetimes):
+    """
+    Converts a series of timezone-aware datetimes into a list of naive UTC
+    datetimes, as stored in the database.
+    """
+    return (
+        datetimes.dt.tz_convert(pytz.utc)
+        .dt.tz_localize(None)
+        .to_numpy()
+        .astype("datetime64[us]")
+        .tolist()
+    )
+
+
+def to_timestamp_array(datetimes, unit="s"):
+    """
+    Converts a series of timezone-aware datetimes into an array of integer
+    UNIX timestamps, in seconds or the given numpy datetime unit.
+    """
+    return (
+        datetimes.dt.tz_convert(pytz.utc)
+        .dt.tz_localize(None)
+        .to_numpy()
+        .astype(f"datetime64[{unit}]")
+        .astype(numpy.int64)
+    )
+
+
+INSERT_OVERTAKING_EVENTS = text(
+    """
+    INSERT INTO overtaking_event (
+        track_id, hex_hash, way_id, direction_reversed, geometry, latitude,
+        longitude, time, distance_overtaker, distance_stationary, course, speed
+    )
+    SELECT
+        CAST(:track_id AS integer), e.hex_hash, e.way_id, e.direction_reversed,
+        ST_SetSRID(ST_MakePoint(e.x, e.y), 3857), e.latitude, e.longitude,
+        e.time, e.distance_overtaker, e.distance_stationary, e.course, e.speed
+    FROM unnest(
+        CAST(:hex_hash AS varchar[]),
+        CAST(:way_id AS bigint[]),
+        CAST(:direction_reversed AS boolean[]),
+        CAST(:x AS float8[]),
+        CAST(:y AS float8[]),
+        CAST(:latitude AS float8[]),
+        CAST(:longitude AS float8[]),
+        CAST(:time AS timestamp[]),
+        CAST(:distance_overtaker AS float8[]),
+        CAST(:distance_stationary AS float8[]),
+        CAST(:course AS float8[]),
+        CAST(:speed AS float8[])
+    ) AS e(
+        hex_hash, way_id, direction_reversed, x, y, latitude, longitude, time,
+        distance_overtaker, distance_stationary, course, speed
+    )
+    ON CONFLICT (hex_hash) DO NOTHING
+    """
+)
+
+INSERT_ROAD_USAGES = text(
+    """
+    INSERT INTO road_usage (track_id, hex_hash, way_id, time, direction_reversed)
+    SELECT
+        CAST(:track_id AS integer), u.hex_hash, u.way_id, u.time,
+        u.direction_reversed
+    FROM unnest(
+        CAST(:hex_hash AS varchar[]),
+        CAST(:way_id AS bigint[]),
+        CAST(:time AS timestamp[]),
+        CAST(:direction_reversed AS boolean[])
+    ) AS u(hex_hash, way_id, time, direction_reversed)
+    ON CONFLICT (hex_hash) DO NOTHING
+    """
+)
+
+
 async def import_overtaking_events(session, track, event_rows):
-    # We use a dictionary to prevent per-track hash collisions, ignoring all
-    # but the first event of the same hash
-    event_models = {}
-
-    for _, row in event_rows.iterrows():
-        hex_hash = hashlib.sha256(
-            struct.pack(
-                "ddQ",
-                row["latitude"],
-                row["longitude"],
-                int(row["datetime"].timestamp()),
-            )
-        ).hexdigest()
-
-        event_models[hex_hash] = OvertakingEvent(
-            track_id=track.id,
-            hex_hash=hex_hash,
-            way_id=row["way_id"],
-            direction_reversed=row["direction_reversed"],
-            geometry=func.ST_GeomFromWKB(
-                dump_wkb(wsg84_to_mercator(Point(row["longitude"], row["latitude"])))
-            ),
-            latitude=row["latitude"],
-            longitude=row["longitude"],
-            time=row["datetime"].astimezone(pytz.utc).replace(tzinfo=None),
-            distance_overtaker=row["distance_overtaker"],
-            distance_stationary=row["distance_stationary"],
-            course=row["course"],
-            speed=row["speed"],
-        )
+    """
+    Inserts the events of the track in a single statement, passing each
+    column as an array. Events whose hash already exists, in this or another
+    track, are skipped. The `event_rows` are those returned by
+    :py:func:`build_track_json`, which include the `hex_hash` column.
+    """
+    if not len(event_rows):
+        return
 
-    session.add_all(event_models.values())
+    latitude = event_rows["latitude"].to_numpy(numpy.float64)
+    longitude = event_rows["longitude"].to_numpy(numpy.float64)
+    x, y = WSG84_TO_MERCATOR.transform(longitude, latitude)
+
+    await session.execute(
+        INSERT_OVERTAKING_EVENTS,
+        {
+            "track_id": track.id,
+            "hex_hash": event_rows["hex_hash"].tolist(),
+            "way_id": event_rows["way_id"].astype(numpy.int64).tolist(),
+            "direction_reversed": event_rows["direction_reversed"]
+            .astype(bool)
+            .tolist(),
+            "x": x.tolist(),
+            "y": y.tolist(),
+            "latitude": latitude.tolist(),
+            "longitude": longitude.tolist(),
+            "time": to_naive_utc_array(event_rows["datetime"]),
+            "distance_overtaker": event_rows["distance_overtaker"].tolist(),
+            "distance_stationary": event_rows["distance_stationary"].tolist(),
+            "course": event_rows["course"].tolist(),
+            "speed": event_rows["speed"].tolist(),
+        },
+    )
+
+
+# A road usage ends when consecutive points on the same way are further apart
+# than this, in meters or seconds.
+ROAD_USAGE_MAX_DISTANCE = 50
+ROAD_USAGE_MAX_TIME_DELTA = 30
 
 
 def get_road_usage_segments(df):
-    way_ids = set(df["way_id"]) - {0}
+    """
+    Splits the snapped points of the track into segments of usage of a
+    single way. Points are grouped by way, keeping the order of the track, and
+    a segment ends after a point that is more than 50 m or 30 s away from its
+    predecessor on the same way, or after the last point of that way. Ways
+    with a single point and points not on a way are ignored.
+
+    Returns a tuple `(order, starts, ends)` of arrays. `order` contains the
+    row positions in `df` of the used points, grouped by way. Each segment is
+    the range `order[start : end + 1]`.
+    """
+    way_ids = df["way_id"].to_numpy()
+
+    # Positions of the points on ways, grouped by way, in track order
+    order = numpy.argsort(way_ids, kind="stable")
+    order = order[way_ids[order] != 0]
+    grouped_way_ids = way_ids[order]
+
+    first_of_way = numpy.ones(len(order), dtype=bool)
+    first_of_way[1:] = grouped_way_ids[1:] != grouped_way_ids[:-1]
+    last_of_way = numpy.ones(len(order), dtype=bool)
+    last_of_way[:-1] = first_of_way[1:]
+
+    # Ways with a single point never produce a segment
+    keep = ~(first_of_way & last_of_way)
+    order = order[keep]
+    first_of_way = first_of_way[keep]
+    last_of_way = last_of_way[keep]
+
+    x, y = WSG84_TO_MERCATOR.transform(
+        df["longitude_snapped"].to_numpy(numpy.float64)[order],
+        df["latitude_snapped"].to_numpy(numpy.float64)[order],
+    )
+    times = to_timestamp_array(df["datetime"], unit="ns")[order]
+
+    # Distance and time to the previous point on the same way
+    dx = numpy.diff(x, prepend=numpy.nan)
+    dy = numpy.diff(y, prepend=numpy.nan)
+    distance = numpy.sqrt(dx * dx + dy * dy)
+    time_delta = numpy.diff(times, prepend=0)
+
+    with numpy.errstate(invalid="ignore"):
+        segment_end = ~first_of_way & (
+            last_of_way
+            | (distance > ROAD_USAGE_MAX_DISTANCE)
+            | (time_delta > ROAD_USAGE_MAX_TIME_DELTA * 10**9)
+        )
 
-    for way_id in way_ids:
-        rows = df[df["way_id"] == way_id]
-        prev_row = None
+    ends = numpy.flatnonzero(segment_end)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))[: len(ends)].astype(ends.dtype)
 
-        current_segment = []
+    return order, starts, ends
 
-        for i, (_, row) in enumerate(rows.iterrows()):
-            current_segment.append(row)
 
-            if prev_row is None:
-                prev_row = row
-                continue
+def get_road_usages(df):
+    """
+    Computes the road usages of the snapped track, returning a dataframe with
+    the columns `hex_hash`, `way_id`, `time` and `direction_reversed`. The
+    time of a usage is the middle of its segment.
+    """
+    order, starts, ends = get_road_usage_segments(df)
 
-            time_delta = (row["datetime"] - prev_row["datetime"]).total_seconds()
-            p0 = wsg84_to_mercator(
-                Point(prev_row["longitude_snapped"], prev_row["latitude_snapped"])
-            )
-            p1 = wsg84_to_mercator(
-                Point(row["longitude_snapped"], row["latitude_snapped"])
-            )
-            distance = p0.distance(p1)
+    way_ids = df["way_id"].to_numpy()[order[ends]]
 
-            if i == len(rows) - 1 or distance > 50 or time_delta > 30:
-                yield (way_id, current_segment)
-                current_segment = []
+    if len(ends):
+        reversed_count = numpy.add.reduceat(
+            df["direction_reversed"].to_numpy(numpy.float64)[order], starts
+        )
+    else:
+        reversed_count = numpy.zeros(0)
+    direction_reversed = reversed_count / (ends - starts + 1) > 0.5
+
+    times = to_timestamp_array(df["datetime"], unit="ns")
+    start_times = times[order[starts]]
+    duration = times[order[ends]] - start_times
+    # like `timedelta / 2`, rounding towards zero
+    middle_times = pandas.to_datetime(
+        start_times + numpy.sign(duration) * (numpy.abs(duration) // 2), utc=True
+    )
 
-            prev_row = row
+    # The hashes use the same timestamp conversion as before vectorization,
+    # to keep them stable.
+    hex_hashes = [
+        hashlib.sha256(struct.pack("dQ", way_id, int(time.timestamp()))).hexdigest()
+        for way_id, time in zip(way_ids.tolist(), middle_times)
+    ]
+
+    return pandas.DataFrame(
+        {
+            "hex_hash": hex_hashes,
+            "way_id": way_ids,
+            "time": middle_times.tz_localize(None),
+            "direction_reversed": direction_reversed,
+        }
+    )
 
 
 async def import_road_usages(session, track, df):
-    usages = {}
-    for way_id, rows in get_road_usage_segments(df):
-        direction_reversed = numpy.mean(list(r["direction_reversed"] for r in rows)) > 0.5
-        start_time = rows[0]["datetime"]
-        end_time = rows[-1]["datetime"]
-        time = start_time + (end_time - start_time) / 2
-
-        hex_hash = hashlib.sha256(
-            struct.pack("dQ", way_id, int(time.timestamp()))
-        ).hexdigest()
-
-        usages[hex_hash] = RoadUsage(
-            track_id=track.id,
-            hex_hash=hex_hash,
-            way_id=way_id,
-            time=time.astimezone(pytz.utc).replace(tzinfo=None),
-            direction_reversed=direction_reversed,
-        )
-    session.add_all(usages.values())
+    usages = get_road_usages(df)
+
+    if not len(usages):
+        return 0
+
+    await session.execute(
+        INSERT_ROAD_USAGES,
+        {
+            "track_id": track.id,
+            "hex_hash": usages["hex_hash"].tolist(),
+            "way_id": usages["way_id"].astype(numpy.int64).tolist(),
+            "time": usages["time"].to_numpy().astype("datetime64[us]").tolist(),
+            "direction_reversed": usages["direction_reversed"].tolist(),
+        },
+    )
+
+    return len(usages)
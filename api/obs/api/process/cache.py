@@ -0,0 +1,167 @@
+"""
+A content-addressed cache of parsed and snapped tracks. Parsing a track and
+snapping it to the roads only depends on the original file, the road data,
+and the algorithm, so when a track is reprocessed without changes to either
+(e.g. after changing its visibility), the snapped track can be reused.
+
+Entries are never invalidated, only superseded by entries with a different
+key, so the cache directory may be cleared at any time. The entries are
+grouped in one directory per generation, i.e. per processing version, road
+data and snapping options. Whenever an entry is stored, the directories of
+the other generations are removed, as their entries are never used again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from os.path import exists, join
+
+import numpy
+import pandas
+from sqlalchemy import select
+
+from obs.api.db import RoadImport
+
+log = logging.getLogger(__name__)
+
+# Increase this whenever a change to the parsing or snapping of tracks, or to
+# the track data built from them, changes their results, to ignore all cached
+# results of the previous version.
+PROCESSING_VERSION = 6
+
+_METADATA_KEY = "__metadata__"
+_INDEX_KEY = "__index__"
+
+
+async def get_road_imports(session):
+    """
+    Returns the time of the last import of each road import group, by group.
+    """
+    return dict(
+        (
+            await session.execute(
+                select(RoadImport.import_group, RoadImport.imported_at)
+            )
+        ).all()
+    )
+
+
+def format_road_version(imports):
+    """
+    Returns a string that identifies the road data of the imports, as
+    returned by :py:func:`get_road_imports`.
+    """
+    return hashlib.sha256(
+        ";".join(
+            f"{group}={at.isoformat()}" for group, at in sorted(imports.items())
+        ).encode()
+    ).hexdigest()
+
+
+async def get_road_version(session):
+    """
+    Returns a string that changes whenever any road import group is
+    (re-)imported.
+    """
+    return format_road_version(await get_road_imports(session))
+
+
+def get_cache_key(file_hash, road_version, options=None):
+    """
+    Returns the key of the processing result of a file, by its hash, for the
+    road data of the `road_version`. The `options` are the settings that
+    change the result, if they are not the defaults. The key is made of the
+    generation and the entry, as `<generation>/<entry>`.
+    """
+    generation = f"{PROCESSING_VERSION}:{road_version}"
+    if options:
+        generation += f":{json.dumps(options, sort_keys=True)}"
+    generation = hashlib.sha256(generation.encode()).hexdigest()[:16]
+    entry = hashlib.sha256(f"{generation}:{file_hash}".encode()).hexdigest()
+    return f"{generation}/{entry}"
+
+
+def _get_cache_path(cache_dir, key):
+    generation, entry = key.split("/")
+    return join(cache_dir, generation, entry[:2], f"{entry}.npz")
+
+
+def prune_cache(cache_dir, key):
+    """
+    Removes the entries of all generations other than the one of the key.
+    """
+    generation = key.split("/")[0]
+    for name in os.listdir(cache_dir):
+        if name != generation:
+            log.info("Removing stale processing cache entries in %s", name)
+            shutil.rmtree(join(cache_dir, name), ignore_errors=True)
+
+
+def load_cached_track(cache_dir, key):
+    """
+    Returns the `(df, metadata)` tuple stored under the key, or `None` if
+    there is no (readable) entry.
+    """
+    path = _get_cache_path(cache_dir, key)
+    if not exists(path):
+        return None
+
+    try:
+        with numpy.load(path, allow_pickle=False) as data:
+            metadata = json.loads(str(data[_METADATA_KEY]))
+            columns = {
+                name: data[name]
+                for name in data.files
+                if name not in (_METADATA_KEY, _INDEX_KEY)
+            }
+            index = data[_INDEX_KEY]
+    except Exception:
+        log.warning("Ignoring unreadable cache entry %s", path, exc_info=True)
+        return None
+
+    df = pandas.DataFrame(columns, index=index)
+    df["datetime"] = pandas.to_datetime(df["datetime"], unit="ns", utc=True)
+    return df, metadata
+
+
+def store_cached_track(cache_dir, key, df, metadata):
+    """
+    Stores the snapped dataframe and the file metadata under the key, and
+    removes the entries of other generations (see :py:func:`prune_cache`).
+    The file is written atomically, so concurrent workers never read partial
+    entries.
+    """
+    path = _get_cache_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    columns = {name: df[name].to_numpy() for name in df.columns}
+    columns["datetime"] = (
+        df["datetime"]
+        .dt.tz_convert("UTC")
+        .dt.tz_localize(None)
+        .to_numpy()
+        .astype("datetime64[ns]")
+        .astype(numpy.int64)
+    )
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            numpy.savez_compressed(
+                f,
+                **columns,
+                **{
+                    _METADATA_KEY: numpy.array(json.dumps(metadata)),
+                    _INDEX_KEY: df.index.to_numpy(),
+                },
+            )
+        os.replace(tmp_path, path)
+    except BaseException:
+        if exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    prune_cache(cache_dir, key)
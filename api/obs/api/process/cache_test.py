@@ -0,0 +1,76 @@
+import os
+
+import numpy
+import pandas
+import pytest
+
+from obs.api.process.cache import (
+    _get_cache_path,
+    get_cache_key,
+    load_cached_track,
+    store_cached_track,
+)
+
+
+@pytest.fixture
+def snapped_df():
+    n = 50
+    return pandas.DataFrame(
+        {
+            "datetime": pandas.date_range(
+                "2023-05-01 10:00:00.25", periods=n, freq="1s", tz="UTC"
+            ),
+            "latitude": numpy.linspace(48.7, 48.8, n),
+            "distance_overtaker": numpy.where(numpy.arange(n) % 7, numpy.nan, 1.5),
+            "confirmed": numpy.arange(n) % 7 == 0,
+            "way_id": numpy.arange(n, dtype=numpy.int64),
+        },
+        index=numpy.arange(3, n + 3),
+    )
+
+
+def test_round_trip(tmp_path, snapped_df):
+    metadata = {"DeviceId": "387c", "OBSDataFormat": "2"}
+    key = get_cache_key("file-hash", "road-version")
+
+    assert load_cached_track(tmp_path, key) is None
+
+    store_cached_track(tmp_path, key, snapped_df, metadata)
+    df, loaded_metadata = load_cached_track(tmp_path, key)
+
+    pandas.testing.assert_frame_equal(df, snapped_df)
+    assert loaded_metadata == metadata
+
+
+def test_unreadable_entry_is_a_miss(tmp_path):
+    key = get_cache_key("file-hash", "road-version")
+    path = _get_cache_path(tmp_path, key)
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(b"not a zip file")
+
+    assert load_cached_track(tmp_path, key) is None
+
+
+def test_key_depends_on_inputs():
+    assert get_cache_key("a", "1") != get_cache_key("b", "1")
+    assert get_cache_key("a", "1") != get_cache_key("a", "2")
+    assert get_cache_key("a", "1") != get_cache_key("a", "1", {"beam_margin": 30})
+    assert get_cache_key("a", "1") == get_cache_key("a", "1", {})
+
+
+def test_stale_generations_are_pruned(tmp_path, snapped_df):
+    old_key = get_cache_key("file-hash", "road-version")
+    other_key = get_cache_key("other-hash", "road-version")
+    new_key = get_cache_key("file-hash", "new-road-version")
+
+    store_cached_track(tmp_path, old_key, snapped_df, {})
+    store_cached_track(tmp_path, other_key, snapped_df, {})
+    assert load_cached_track(tmp_path, old_key) is not None
+    assert len(os.listdir(tmp_path)) == 1
+
+    store_cached_track(tmp_path, new_key, snapped_df, {})
+    assert load_cached_track(tmp_path, old_key) is None
+    assert load_cached_track(tmp_path, other_key) is None
+    assert load_cached_track(tmp_path, new_key) is not None
+    assert len(os.listdir(tmp_path)) == 1
@@ -19,6 +19,7 @@
 
 import csv
 import datetime
+from functools import lru_cache
 import gzip
 from itertools import chain
 import logging
@@ -44,6 +45,9 @@ GPS_UNIX_EPOCH_OFFSET = 315964800
 # A date before which no OBS existed, so any timestamp before this date can be
 # assumed invalid data.
 REJECT_MEASUREMENTS_BEFORE = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+REJECT_TIMESTAMPS_BEFORE = numpy.datetime64(
+    REJECT_MEASUREMENTS_BEFORE.replace(tzinfo=None), "ns"
+)
 
 MEASUREMENT_TEMPLATE = {
     "time": None,
@@ -64,6 +68,36 @@ def convert_gps_to_utc(dt):
     )
 
 
+@lru_cache(maxsize=1)
+def _get_leap_seconds():
+    """
+    Returns the times of the leap seconds, as nanoseconds since the unix epoch
+    in the GPS time scale, sorted, to count the leap seconds before a GPS time
+    the same way as `gpstime.gps2unix`.
+    """
+    leaps = numpy.array(gpstime.LEAPDATA.as_gps(), dtype=numpy.int64)
+    return (leaps + GPS_UNIX_EPOCH_OFFSET) * 1_000_000_000
+
+
+def gps_to_utc(datetimes):
+    """
+    Converts a series of datetimes in GPS time (read as if they were UTC) to
+    UTC, by subtracting the leap seconds before each of them, like
+    `convert_gps_to_utc` does for a single datetime. Missing values stay `NaT`.
+    """
+    timestamps = datetimes.dt.tz_localize(None).to_numpy("datetime64[ns]")
+    ns = timestamps.view(numpy.int64)
+    leaps = numpy.searchsorted(_get_leap_seconds(), ns, side="right")
+    corrected = numpy.where(
+        numpy.isnat(timestamps), ns, ns - leaps * 1_000_000_000
+    ).view("datetime64[ns]")
+    return pandas.Series(
+        pandas.DatetimeIndex(corrected, tz="UTC"),
+        index=datetimes.index,
+        name=datetimes.name,
+    )
+
+
 def import_csv(filename):
     """
     Imports a CSV file in OpenBikeSensor format [1] and returns a dataframe and
@@ -89,21 +123,37 @@ def import_csv(filename):
     return df, metadata
 
 
-IMPORTED_COLUMNS = (
-    "Date",
-    "Time",
-    "Latitude",
-    "Longitude",
-    "Course",
-    "Speed",
-    "Left",
-    "Right",
-    "Confirmed",
-    "Lid",
-    "Case",
-    "InsidePrivacyArea",
-    "insidePrivacyArea",
-)
+# The imported columns, with the type they are parsed as. Distances (in cm)
+# and flags are integers, which float32 holds exactly, and NaN where empty.
+COLUMN_DTYPES = {
+    "Date": str,
+    "Time": str,
+    "Latitude": numpy.float64,
+    "Longitude": numpy.float64,
+    "Course": numpy.float64,
+    "Speed": numpy.float64,
+    "Left": numpy.float32,
+    "Right": numpy.float32,
+    "Confirmed": numpy.float32,
+    "Lid": numpy.float32,
+    "Case": numpy.float32,
+    "InsidePrivacyArea": numpy.float32,
+    "insidePrivacyArea": numpy.float32,
+}
+
+# The name of each imported column in the dataframe. Old column names from the
+# 1.0 and 1.1 formats are renamed as well.
+COLUMN_NAMES = {
+    "Lid": "distance_stationary",
+    "Case": "distance_overtaker",
+    "Left": "distance_overtaker",
+    "Right": "distance_stationary",
+    "Confirmed": "confirmed",
+    "Latitude": "latitude",
+    "Longitude": "longitude",
+    "Course": "course",
+    "Speed": "speed",
+}
 
 # 1.0: Date;Time;Latitude;Longitude;Lid;Case;Confirmed
 # 1.1: Date;Time;Latitude;Longitude;Course;Speed;Lid;Case;Confirmed
@@ -117,10 +167,12 @@ def _read_csv(filename):
     try:
         opener = gzip.open if filename.endswith(".gz") else open
 
-        with opener(filename, "rt", encoding="utf-8") as file:
+        # The file is read as bytes, which pandas parses without decoding it
+        # into a string first.
+        with opener(filename, "rb") as file:
             # Try to parse the first line as metadata. If that doens't work,
             # prepend the
-            header_line: str = next(iter(file))
+            header_line: str = next(iter(file)).decode("utf-8").rstrip("\r\n")
             metadata = {}
 
             if "OBSDataFormat" in header_line:
@@ -140,98 +192,147 @@ def _read_csv(filename):
             format_id = identify_format(header_line, metadata)
             log.debug("File identified as format version %s", format_id)
 
-            # Let pandas do the heavy lifting :)
-            df = pandas.read_csv(
+            # Let pandas do the heavy lifting :) Only the imported columns are
+            # converted, with a fixed type each, all others are skipped.
+            raw = pandas.read_csv(
                 file,
                 sep=";",
-                usecols=lambda x: x in IMPORTED_COLUMNS,
+                encoding="utf-8",
+                usecols=lambda x: x in COLUMN_DTYPES,
+                dtype=COLUMN_DTYPES,
             )
 
-        log.debug("Read %s rows of CSV data", len(df))
-
-        # Rename old column names from 1.0 or 1.1 formats
-        df = df.rename(
-            columns={
-                "Lid": "distance_stationary",
-                "Case": "distance_overtaker",
-                "Left": "distance_overtaker",
-                "Right": "distance_stationary",
-                "insidePrivacyArea": "privacy",
-                "InsidePrivacyArea": "privacy",
-                "Confirmed": "confirmed",
-                "Latitude": "latitude",
-                "Longitude": "longitude",
-                "Course": "course",
-                "Speed": "speed",
-            }
-        )
+        log.debug("Read %s rows of CSV data", len(raw))
+
+        if len(raw) < 3:
+            raise ValueError("Can't process track with so few points.")
 
         # Parse the date and time together as a UTC timestamp (GPS is corrected later)
-        df["datetime"] = pandas.to_datetime(
-            df["Date"] + " " + df["Time"],
-            utc=True,
-            format="%d.%m.%Y %H:%M:%S",
-            errors="coerce",
+        timestamps = _parse_datetime(raw["Date"].to_numpy(), raw["Time"].to_numpy())
+        latitude = raw["Latitude"].to_numpy()
+        longitude = raw["Longitude"].to_numpy()
+
+        # Keep the rows that are useful, and not private
+        valid = (
+            (timestamps > REJECT_TIMESTAMPS_BEFORE)
+            & ~numpy.isnan(latitude)
+            & ~numpy.isnan(longitude)
+            & (latitude != 0)
+            & (longitude != 0)
         )
-
-        # Remove all data that we didn't need
-        df = df.drop(
-            columns=set(df.columns)
-            - {
-                "datetime",
-                "distance_overtaker",
-                "distance_stationary",
-                "privacy",
-                "confirmed",
-                "latitude",
-                "longitude",
-                "course",
-                "speed",
-            }
+        for privacy in ("InsidePrivacyArea", "insidePrivacyArea"):
+            if privacy in raw:
+                valid &= raw[privacy].to_numpy() == 0
+
+        columns = {}
+        for name in raw.columns:
+            if name not in COLUMN_NAMES:
+                continue
+
+            values = raw[name].to_numpy()[valid]
+            if name in ("Lid", "Case", "Left", "Right"):
+                values = numpy.where(
+                    (values == 255) | (values == 999), numpy.nan, values
+                ).astype(numpy.float64)
+                values *= 0.01  # convert cm to m
+            elif name == "Speed":
+                values = values / 3.6  # convert km/h to m/s
+            elif name == "Course":
+                # convert to radians
+                values = (math.pi / 180.0 * (90.0 - values)) % (2 * math.pi)
+            elif name == "Confirmed":
+                values = values != 0
+
+            columns[COLUMN_NAMES[name]] = values
+        columns["datetime"] = pandas.DatetimeIndex(timestamps[valid], tz="UTC")
+
+        df = pandas.DataFrame(
+            columns, index=raw.index if valid.all() else raw.index[valid]
         )
 
-        if len(df) < 3:
-            raise ValueError("Can't process track with so few points.")
+        log.debug("Kept %s rows of CSV data", len(df))
 
-        # Remove rows that are useless
-        df = df[
-            (df["datetime"] != pandas.NaT)
-            & (df["datetime"] > REJECT_MEASUREMENTS_BEFORE)
-            & ~numpy.isnan(df["latitude"])
-            & ~numpy.isnan(df["longitude"])
-            & df["latitude"].astype(numpy.bool_)
-            & df["longitude"].astype(numpy.bool_)
-        ]
-
-        for key in ("distance_stationary", "distance_overtaker"):
-            df[key] = numpy.where(
-                (df[key] == 255) | (df[key] == 999), numpy.nan, df[key]
-            )
-            df[key] = df[key] * 0.01  # convert cm to m
+        return df, metadata
 
-        if "speed" in df:
-            df["speed"] = df["speed"] / 3.6  # convert km/h to m/s
+    except Exception as e:
+        log.exception("Error while reading CSV file")
+        raise ValueError(f"Error while reading CSV: {e}") from e
 
-        if "course" in df:
-            df["course"] = (
-                math.pi / 180.0 * (90.0 - df["course"].astype(numpy.float64))
-            ) % (
-                2 * math.pi
-            )  # convert to radians
 
-        df["confirmed"] = df["confirmed"].astype(numpy.bool_)
+def _parse_datetime(dates, times):
+    """
+    Parses the dates (`DD.MM.YYYY`) and times (`HH:MM:SS`) of the rows, as
+    arrays of strings, into an array of timestamps, reading the digits of
+    each part from their fixed positions in the strings. Values in any other
+    format, such as without leading zeros, are parsed by pandas instead, and
+    values that cannot be parsed are `NaT`.
+    """
+    # The bytes of the strings, padded with zeros, so a string of the expected
+    # length is followed by a zero.
+    try:
+        date_chars = dates.astype("S11").view(numpy.uint8).reshape(-1, 11)
+        time_chars = times.astype("S9").view(numpy.uint8).reshape(-1, 9)
+    except UnicodeEncodeError:
+        # Not ASCII, so not in the expected format
+        return _parse_datetime_strings(dates, times)
+
+    valid = (
+        (date_chars[:, 2] == ord("."))
+        & (date_chars[:, 5] == ord("."))
+        & (date_chars[:, 10] == 0)
+        & (time_chars[:, 2] == ord(":"))
+        & (time_chars[:, 5] == ord(":"))
+        & (time_chars[:, 8] == 0)
+    )
+    parts = []
+    for chars, start, end in (
+        (date_chars, 6, 10),
+        (date_chars, 3, 5),
+        (date_chars, 0, 2),
+        (time_chars, 0, 2),
+        (time_chars, 3, 5),
+        (time_chars, 6, 8),
+    ):
+        value = numpy.zeros(len(chars), dtype=numpy.int64)
+        for i in range(start, end):
+            digit = chars[:, i].astype(numpy.int64) - ord("0")
+            valid &= (digit >= 0) & (digit <= 9)
+            value = value * 10 + digit
+        parts.append(value)
+
+    year, month, day, hour, minute, second = parts
+    valid &= (month >= 1) & (month <= 12) & (day >= 1)
+    year = numpy.where(valid, year, 1970)
+    month = numpy.where(valid, month, 1)
+
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    month_days = (months + 1).astype("datetime64[D]") - months.astype("datetime64[D]")
+    valid &= (
+        (day <= month_days.astype(numpy.int64))
+        & (hour < 24)
+        & (minute < 60)
+        & (second < 60)
+    )
+    seconds = numpy.where(
+        valid, ((day - 1) * 24 + hour) * 3600 + minute * 60 + second, 0
+    )
+    timestamps = months.astype("datetime64[D]").astype(
+        "datetime64[ns]"
+    ) + seconds.astype("timedelta64[s]")
 
-        if "privacy" in df:
-            df = df[~df["privacy"].astype(numpy.bool_)]
-            df = df.drop(columns="privacy")
+    other = numpy.flatnonzero(~valid)
+    if len(other):
+        timestamps[other] = _parse_datetime_strings(dates[other], times[other])
 
-        log.debug("Kept %s rows of CSV data", len(df))
+    return timestamps
 
-        return df, metadata
 
-    except Exception as e:
-        log.exception("Error while reading CSV file")
-        raise ValueError(f"Error while reading CSV: {e}") from e
+def _parse_datetime_strings(dates, times):
+    return pandas.to_datetime(
+        pandas.Series(dates, dtype=object) + " " + pandas.Series(times, dtype=object),
+        format="%d.%m.%Y %H:%M:%S",
+        errors="coerce",
+    ).to_numpy("datetime64[ns]")
 
 
 def identify_format(header, metadata):
@@ -263,4 +364,4 @@ def _correct_gps_time(df, metadata):
     if timezone != "GPS":
         return
 
-    df["datetime"] = df["datetime"].map(convert_gps_to_utc)
+    df["datetime"] = gps_to_utc(df["datetime"])
@@ -0,0 +1,146 @@
+import math
+
+import gpstime
+import numpy
+import pandas
+import pytest
+
+from obs.api.process.obs_csv import (
+    GPS_UNIX_EPOCH_OFFSET,
+    _parse_datetime,
+    convert_gps_to_utc,
+    gps_to_utc,
+    import_csv,
+)
+
+
+def test_parse_datetime_like_pandas():
+    values = [
+        ("26.06.2021", "14:39:39"),
+        ("01.01.2018", "00:00:00"),
+        ("29.02.2024", "23:59:59"),
+        ("1.6.2021", "9:5:3"),
+        ("31.02.2021", "10:00:00"),
+        ("26.06.2021", "23:59:60"),
+        ("26.13.2021", "10:00:00"),
+        ("26.06.2021", "24:00:00"),
+        ("2x.06.2021", "10:00:00"),
+        ("26.06.2021 ", "10:00:00"),
+        ("26-06-2021", "10:00:00"),
+        ("26.06.2021", "10:00"),
+        (numpy.nan, numpy.nan),
+        ("2ä.06.2021", "10:00:00"),
+    ]
+    dates = numpy.array([date for date, _ in values], dtype=object)
+    times = numpy.array([time for _, time in values], dtype=object)
+
+    expected = pandas.to_datetime(
+        pandas.Series(dates) + " " + pandas.Series(times),
+        format="%d.%m.%Y %H:%M:%S",
+        errors="coerce",
+    ).to_numpy()
+
+    numpy.testing.assert_array_equal(_parse_datetime(dates, times), expected)
+    numpy.testing.assert_array_equal(
+        _parse_datetime(dates[:-1], times[:-1]), expected[:-1]
+    )
+
+
+def test_gps_to_utc_like_convert_gps_to_utc():
+    # every second around each leap second, and a few ordinary times
+    leaps = numpy.array(gpstime.LEAPDATA.as_gps()) + GPS_UNIX_EPOCH_OFFSET
+    seconds = (leaps[:, None] + numpy.arange(-2, 3)).ravel()
+    datetimes = pandas.Series(
+        pandas.to_datetime(seconds, unit="s", utc=True).append(
+            pandas.DatetimeIndex(
+                ["2018-01-01 00:00:00", "2021-06-26 14:39:39"], tz="UTC"
+            )
+        ),
+        index=numpy.arange(len(seconds) + 2) * 2,
+        name="datetime",
+    )
+
+    expected = datetimes.map(convert_gps_to_utc)
+    result = gps_to_utc(datetimes)
+
+    pandas.testing.assert_series_equal(result, expected, check_dtype=False)
+    assert result.iloc[-1] == pandas.Timestamp("2021-06-26 14:39:21", tz="UTC")
+
+
+def test_gps_to_utc_keeps_missing():
+    datetimes = pandas.Series(
+        pandas.DatetimeIndex(["2021-06-26 14:39:39", None], tz="UTC")
+    )
+    assert gps_to_utc(datetimes).isna().tolist() == [False, True]
+
+
+def test_import_csv_gps_time(tmp_path):
+    filename = str(tmp_path / "track.csv")
+    with open(filename, "w") as f:
+        f.write("OBSDataFormat=2&TimeZone=GPS\n")
+        f.write("Date;Time;Latitude;Longitude;Left;Right;Confirmed\n")
+        for second in range(3):
+            f.write(f"26.06.2021;14:39:3{second};48.1;9.1;120;150;0\n")
+
+    df, metadata = import_csv(filename)
+
+    assert metadata == {"OBSDataFormat": "2", "TimeZone": "GPS"}
+    assert df["datetime"].tolist() == [
+        pandas.Timestamp(f"2021-06-26 14:39:1{2 + second}", tz="UTC")
+        for second in range(3)
+    ]
+
+
+def test_import_csv(tmp_path):
+    filename = str(tmp_path / "track.csv")
+    with open(filename, "w") as f:
+        f.write(
+            "Date;Time;Latitude;Longitude;Course;Speed;Right;Left;Confirmed;"
+            "insidePrivacyArea\n"
+            "26.06.2021;14:39:39;48.1;9.1;90;36;120;255;0;0\n"
+            "26.06.2021;14:39:40;48.2;9.2;0;18;999;150;1;0\n"
+            "26.06.2021;14:39:41;0;0;0;18;80;150;1;0\n"
+            "26.06.2017;14:39:42;48.3;9.3;0;18;80;150;1;0\n"
+            "26.06.2021;14:39:43;48.4;9.4;0;18;80;150;1;1\n"
+            "26.06.2021;14:39:44;48.5;9.5;0;18;;;1;0\n"
+        )
+
+    df, metadata = import_csv(filename)
+
+    assert metadata == {}
+    assert list(df.index) == [0, 1, 5]
+    assert list(df.columns) == [
+        "latitude",
+        "longitude",
+        "course",
+        "speed",
+        "distance_stationary",
+        "distance_overtaker",
+        "confirmed",
+        "datetime",
+    ]
+    assert df["latitude"].tolist() == [48.1, 48.2, 48.5]
+    assert df["course"].tolist() == [0, math.pi / 2, math.pi / 2]
+    assert df["speed"].tolist() == [10, 5, 5]
+    numpy.testing.assert_array_equal(
+        df["distance_stationary"], [1.2, numpy.nan, numpy.nan]
+    )
+    numpy.testing.assert_array_equal(
+        df["distance_overtaker"], [numpy.nan, 1.5, numpy.nan]
+    )
+    assert df["confirmed"].tolist() == [False, True, True]
+    assert df["datetime"].tolist() == [
+        pandas.Timestamp("2021-06-26 14:39:39", tz="UTC"),
+        pandas.Timestamp("2021-06-26 14:39:40", tz="UTC"),
+        pandas.Timestamp("2021-06-26 14:39:44", tz="UTC"),
+    ]
+
+
+def test_import_too_short(tmp_path):
+    filename = str(tmp_path / "track.csv")
+    with open(filename, "w") as f:
+        f.write("Date;Time;Latitude;Longitude;Lid;Case;Confirmed\n")
+        f.write("26.06.2021;14:39:39;48.1;9.1;120;255;0\n")
+
+    with pytest.raises(ValueError):
+        import_csv(filename)
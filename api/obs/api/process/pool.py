@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+log = logging.getLogger(__name__)
+
+_executor = None
+
+
+def configure_pool(size):
+    """
+    Creates the process pool for CPU-bound processing stages, with `size`
+    worker processes. If `size` is 0 or None, no pool is used, and the stages
+    run inline on the event loop's thread.
+    """
+    global _executor
+
+    if _executor is not None or not size:
+        return
+
+    log.info("Starting processing pool with %s processes.", size)
+
+    # Forking a process that runs an event loop (and threads, e.g. for
+    # aiofiles) is not safe, so we spawn fresh interpreters.
+    _executor = ProcessPoolExecutor(
+        max_workers=size, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def shutdown_pool():
+    """
+    Stops the processing pool, if one was started, cancelling pending stages.
+    """
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+def run_processes(target, args, count):
+    """
+    Runs `target(*args)` in `count` spawned processes and waits for them to
+    exit. The processes are not daemonic, because daemonic processes may not
+    start a processing pool of their own, so they are terminated here instead
+    if waiting is interrupted.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=args) for _ in range(count)]
+
+    try:
+        for process in processes:
+            process.start()
+
+        log.info("Started %s processes.", count)
+
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+        for process in processes:
+            if process.pid is not None:
+                process.join()
+
+
+async def run_in_pool(fn, *args, **kwargs):
+    """
+    Runs `fn(*args, **kwargs)` in the processing pool and returns its result,
+    or runs it inline if no pool is configured. The function and all arguments
+    must be picklable.
+    """
+    global _executor
+
+    if _executor is None:
+        return fn(*args, **kwargs)
+
+    executor = _executor
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+    except BrokenProcessPool:
+        # A pool process died, e.g. because it ran out of memory. The pool
+        # cannot be used anymore, so replace it for the next track.
+        log.error("Processing pool is broken, restarting it.")
+        if _executor is executor:
+            size = executor._max_workers
+            _executor = None
+            executor.shutdown(wait=False)
+            configure_pool(size)
+        raise
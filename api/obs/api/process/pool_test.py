@@ -0,0 +1,34 @@
+import asyncio
+import multiprocessing
+
+from obs.api.process.pool import (
+    configure_pool,
+    run_in_pool,
+    run_processes,
+    shutdown_pool,
+)
+
+
+def square(value):
+    return value * value
+
+
+async def use_pool(value):
+    configure_pool(1)
+    try:
+        return await run_in_pool(square, value)
+    finally:
+        shutdown_pool()
+
+
+def run_worker(results, value):
+    # like a queue worker of `tools/process_track.py --workers N`
+    results.put(asyncio.run(use_pool(value)))
+
+
+def test_run_processes_with_pools():
+    results = multiprocessing.get_context("spawn").Queue()
+
+    run_processes(run_worker, (results, 3), 2)
+
+    assert [results.get(timeout=10) for _ in range(2)] == [9, 9]
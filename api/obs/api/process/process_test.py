@@ -0,0 +1,339 @@
+import asyncio
+import hashlib
+import os
+import struct
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os.path import join
+
+import numpy
+import pandas
+import pytz
+from shapely import Point
+
+from obs.api import process
+from obs.api.db import (
+    PROCESSING_PRIORITY_BACKGROUND,
+    PROCESSING_PRIORITY_INTERACTIVE,
+    Track,
+)
+from obs.api.process import (
+    claim_track,
+    export_gpx,
+    get_road_usages,
+    has_track_outputs,
+    hash_events,
+    write_track_outputs,
+)
+from obs.api.process.snapping import wsg84_to_mercator
+
+
+def reference_road_usage_segments(df):
+    """
+    The original, row-by-row implementation of the road usage segmentation,
+    which the vectorized version must reproduce.
+    """
+    way_ids = set(df["way_id"]) - {0}
+
+    for way_id in way_ids:
+        rows = df[df["way_id"] == way_id]
+        prev_row = None
+
+        current_segment = []
+
+        for i, (_, row) in enumerate(rows.iterrows()):
+            current_segment.append(row)
+
+            if prev_row is None:
+                prev_row = row
+                continue
+
+            time_delta = (row["datetime"] - prev_row["datetime"]).total_seconds()
+            p0 = wsg84_to_mercator(
+                Point(prev_row["longitude_snapped"], prev_row["latitude_snapped"])
+            )
+            p1 = wsg84_to_mercator(
+                Point(row["longitude_snapped"], row["latitude_snapped"])
+            )
+            distance = p0.distance(p1)
+
+            if i == len(rows) - 1 or distance > 50 or time_delta > 30:
+                yield (way_id, current_segment)
+                current_segment = []
+
+            prev_row = row
+
+
+def reference_road_usages(df):
+    usages = set()
+    for way_id, rows in reference_road_usage_segments(df):
+        direction_reversed = (
+            numpy.mean(list(r["direction_reversed"] for r in rows)) > 0.5
+        )
+        start_time = rows[0]["datetime"]
+        end_time = rows[-1]["datetime"]
+        time = start_time + (end_time - start_time) / 2
+
+        hex_hash = hashlib.sha256(
+            struct.pack("dQ", way_id, int(time.timestamp()))
+        ).hexdigest()
+
+        usages.add(
+            (
+                hex_hash,
+                way_id,
+                time.astimezone(pytz.utc).replace(tzinfo=None),
+                direction_reversed,
+            )
+        )
+    return usages
+
+
+def read_snapped_track(test_data_dir):
+    df = pandas.read_csv(join(test_data_dir, "snapped-track.csv"))
+    df["datetime"] = pandas.to_datetime(df["datetime"], utc=True)
+    return df
+
+
+def test_road_usages_match_reference(test_data_dir):
+    df = read_snapped_track(test_data_dir)
+
+    usages = get_road_usages(df)
+    expected = reference_road_usages(df)
+
+    assert len(expected) > 10
+    assert len(usages) == len(expected)
+    assert set(usages.itertuples(index=False, name=None)) == expected
+
+
+def test_road_usages_with_sub_second_times(test_data_dir):
+    df = read_snapped_track(test_data_dir)
+    df["datetime"] += pandas.to_timedelta(
+        numpy.arange(len(df)) * 333_333_333 % 10**9, unit="ns"
+    )
+
+    assert set(get_road_usages(df).itertuples(index=False, name=None)) == (
+        reference_road_usages(df)
+    )
+
+
+def test_road_usages_without_ways(test_data_dir):
+    df = read_snapped_track(test_data_dir)
+    df["way_id"] = 0
+
+    assert len(get_road_usages(df)) == 0
+
+
+def test_event_hashes_match_struct_pack():
+    latitude = numpy.array([48.7, 48.70001, 52.5])
+    longitude = numpy.array([9.1, 9.10002, 13.4])
+    datetimes = pandas.Series(
+        pandas.to_datetime(
+            [
+                "2023-05-01 10:00:00",
+                "2023-05-01 10:00:01.250",
+                "2023-05-01 10:00:02.999999700",
+            ],
+            utc=True,
+            format="ISO8601",
+        )
+    )
+
+    expected = [
+        hashlib.sha256(struct.pack("ddQ", lat, lon, int(time.timestamp()))).hexdigest()
+        for lat, lon, time in zip(latitude, longitude, datetimes)
+    ]
+
+    assert hash_events(latitude, longitude, datetimes) == expected
+
+
+def reference_export_gpx(df, filename, name):
+    gpx = ET.Element("gpx")
+    metadata = ET.SubElement(gpx, "metadata")
+    ET.SubElement(metadata, "name").text = name
+
+    trk = ET.SubElement(gpx, "trk")
+
+    ET.SubElement(trk, "name").text = name
+    ET.SubElement(trk, "type").text = "Cycling"
+
+    trkseg = ET.SubElement(trk, "trkseg")
+
+    for _, point in df.iterrows():
+        trkpt = ET.SubElement(
+            trkseg, "trkpt", lat=str(point["latitude"]), lon=str(point["longitude"])
+        )
+        ET.SubElement(trkpt, "time").text = point["datetime"].isoformat()
+
+    et = ET.ElementTree(gpx)
+    et.write(filename, encoding="utf-8", xml_declaration=True)
+
+
+def test_export_gpx_matches_reference(test_data_dir, tmp_path, monkeypatch):
+    df = read_snapped_track(test_data_dir).rename(
+        columns={"latitude_snapped": "latitude", "longitude_snapped": "longitude"}
+    )
+    df["datetime"] += pandas.to_timedelta(numpy.arange(len(df)) % 3 * 250, unit="ms")
+    name = "track <1> & more"
+
+    # write in several chunks
+    monkeypatch.setattr("obs.api.process.GPX_CHUNK_SIZE", 500)
+    export_gpx(df, tmp_path / "track.gpx", name)
+    reference_export_gpx(df, tmp_path / "reference.gpx", name)
+
+    assert (tmp_path / "track.gpx").read_bytes() == (
+        tmp_path / "reference.gpx"
+    ).read_bytes()
+
+
+def test_export_gpx_concurrently(test_data_dir, tmp_path):
+    df = read_snapped_track(test_data_dir).rename(
+        columns={"latitude_snapped": "latitude", "longitude_snapped": "longitude"}
+    )
+    filename = tmp_path / "track.gpx"
+
+    # like concurrent downloads of the same track in the API's thread executor
+    with ThreadPoolExecutor(8) as executor:
+        for future in [
+            executor.submit(export_gpx, df, filename, "track") for _ in range(16)
+        ]:
+            future.result()
+
+    assert os.listdir(tmp_path) == ["track.gpx"]
+    assert len(ET.parse(filename).getroot().findall(".//trkpt")) == len(df)
+
+
+def test_track_outputs_for_cache_key(tmp_path):
+    output_dir = str(tmp_path / "user" / "track")
+    data = {"events": [], "track": None, "trackRaw": None}
+
+    assert not has_track_outputs(output_dir, "key-1")
+
+    write_track_outputs(output_dir, data, "key-1")
+    assert has_track_outputs(output_dir, "key-1")
+    assert not has_track_outputs(output_dir, "key-2")
+
+    # the key is removed while other track data is written
+    write_track_outputs(output_dir, data)
+    assert not has_track_outputs(output_dir, "key-1")
+
+    write_track_outputs(output_dir, data, "key-2")
+    os.unlink(join(output_dir, "data.json.gz"))
+    assert not has_track_outputs(output_dir, "key-2")
+
+
+class FakeQueueSession:
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+def select_from_list(tracks):
+    """
+    Replaces the claim queries with a selection from `tracks`, by the simple
+    column comparisons the queries are made of.
+    """
+
+    async def select(session, *conditions, order_by):
+        matching = [
+            track
+            for track in tracks
+            if all(
+                c.operator(getattr(track, c.left.key), c.right.value)
+                for c in conditions
+            )
+        ]
+        matching.sort(key=lambda t: [getattr(t, column.key) for column in order_by])
+        return matching[0] if matching else None
+
+    return select
+
+
+def test_claim_upload_before_aged_backlog(monkeypatch):
+    now = datetime.utcnow()
+    max_wait = 6 * 3600
+
+    # a reprocessing of all tracks that has been queued for a day
+    tracks = [
+        Track(
+            id=i,
+            slug=f"bulk-{i}",
+            processing_status="queued",
+            processing_priority=PROCESSING_PRIORITY_BACKGROUND,
+            processing_queued_at=now - timedelta(days=1, seconds=-i),
+        )
+        for i in range(20)
+    ]
+    upload = Track(
+        id=100,
+        slug="upload",
+        processing_status="queued",
+        processing_priority=PROCESSING_PRIORITY_INTERACTIVE,
+        processing_queued_at=now,
+    )
+    tracks.append(upload)
+    monkeypatch.setattr(process, "_select_claimable_track", select_from_list(tracks))
+
+    claimed = []
+    for claim_number in range(len(tracks)):
+        track = asyncio.run(
+            claim_track(FakeQueueSession(), "worker", 600, max_wait, claim_number)
+        )
+        claimed.append(track.slug)
+
+    # the aged tracks are not starved, but the upload does not wait for all
+    assert claimed.index("upload") < process.AGED_CLAIM_INTERVAL
+    assert claimed[0] == "bulk-0"
+    assert sorted(claimed) == sorted(t.slug for t in tracks)
+
+
+class FakeTrackSession(FakeQueueSession):
+    def __init__(self, track):
+        self.track = track
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, statement):
+        return self
+
+    def scalar(self):
+        return self.track
+
+
+def test_manual_processing_lease_expires(monkeypatch):
+    track = Track(id=1, slug="manual", processing_status="complete")
+    processed = []
+
+    async def process_track(session, track):
+        processed.append((track.processing_worker, track.processing_lease_until))
+
+    monkeypatch.setattr(process, "make_session", lambda: FakeTrackSession(track))
+    monkeypatch.setattr(process, "process_track", process_track)
+    monkeypatch.setattr(process, "configure_pool", lambda size: None)
+    monkeypatch.setattr(process, "configure_road_cache", lambda size: None)
+
+    asyncio.run(process.process_tracks(["manual"]))
+
+    # if the process died while processing the track, a worker would reclaim
+    # it once its lease has run out
+    [(worker_id, lease_until)] = processed
+    assert worker_id is not None
+    assert lease_until > datetime.utcnow()
+    monkeypatch.setattr(process, "_select_claimable_track", select_from_list([track]))
+
+    class LeaseExpired:
+        @staticmethod
+        def utcnow():
+            return lease_until + timedelta(seconds=1)
+
+    monkeypatch.setattr(process, "datetime", LeaseExpired)
+    reclaimed = asyncio.run(claim_track(FakeQueueSession(), "worker", 600))
+    assert reclaimed is track
+    assert reclaimed.processing_worker == "worker"
@@ -0,0 +1,273 @@
+"""
+A cache of the roads used for snapping, in the memory of each API or worker
+process. Roads are loaded from the database by square tile of the mercator
+projection, as WKB in the stored projection, so tracks in the same area (e.g.
+when reprocessing many tracks) do not load the same roads again, nor project
+them.
+
+The missing tiles of a track segment are loaded in one query, which only sends
+their keys instead of the track points, and only uses the spatial index of the
+roads. The roads are kept as WKB, and only decoded in the processing pool,
+where the exact distance to the points is checked, in the `RoadTree` (see
+:py:func:`obs.api.process.snapping.snap_to_road_wkb`). So the event loop does
+no CPU-heavy work on the roads, and the size of the cache is the size of the
+WKB it holds.
+
+The least recently used tiles are dropped when the cache grows beyond its
+size. Tiles are also dropped when `tools/import_osm.py` (re-)imports an import
+group that has roads in them, which is noticed by the change of its time in
+the `road_import` table.
+"""
+
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import shapely
+from sqlalchemy import func, select, text
+
+from obs.api.db import Road
+from obs.api.metrics import ProcessingStats
+from obs.api.process.cache import format_road_version, get_road_imports
+from obs.api.process.snapping import RoadWKB
+
+log = logging.getLogger(__name__)
+
+LOAD_TILE_ROADS = text(
+    """
+    SELECT
+        road.way_id, road.directionality, road.import_group,
+        ST_AsBinary(road.geometry), array_agg(t.x), array_agg(t.y)
+    FROM unnest(CAST(:x AS integer[]), CAST(:y AS integer[])) AS t(x, y)
+    JOIN road ON road.geometry && ST_MakeEnvelope(
+        t.x * :tile_size, t.y * :tile_size,
+        (t.x + 1) * :tile_size, (t.y + 1) * :tile_size,
+        3857
+    )
+    GROUP BY road.way_id
+    """
+)
+
+# Maximum size of the WKB of the cached roads, in bytes. The cache uses a little
+# more memory, for the arrays of the roads and their way ids.
+DEFAULT_ROAD_CACHE_SIZE = 256 * 1024 * 1024
+
+# Width and height of the tiles, in meters (of the mercator projection)
+DEFAULT_ROAD_CACHE_TILE_SIZE = 2000
+
+
+@dataclass
+class RoadTile:
+    """
+    The roads that intersect one tile, and the import groups they belong to.
+    """
+
+    roads: RoadWKB
+    import_groups: frozenset
+    size: int
+
+
+class RoadCache:
+    def __init__(
+        self, max_size=DEFAULT_ROAD_CACHE_SIZE, tile_size=DEFAULT_ROAD_CACHE_TILE_SIZE
+    ):
+        self.max_size = max_size
+        self.tile_size = tile_size
+        self.tiles = OrderedDict()
+        self.size = 0
+
+        self.imports = None
+        self.version = None
+
+    async def get_roads(self, session, points, buffer, stats=None):
+        """
+        Returns the `RoadWKB` of the roads in the tiles within `buffer` meters
+        of any of the points (an array of points in mercator projection),
+        each road once. The tiles found in the cache and loaded from the
+        database, and the time and bytes of the database query, are counted
+        in `stats`, if given.
+        """
+        stats = stats if stats is not None else ProcessingStats()
+        await self.update_imports(session)
+
+        keys = self.get_tile_keys(points, buffer)
+        tiles = {key: self.tiles[key] for key in keys if key in self.tiles}
+        missing = [key for key in keys if key not in tiles]
+        stats.add_count("road_cache_hits", len(tiles))
+        stats.add_count("road_cache_misses", len(missing))
+
+        for key in tiles:
+            self.tiles.move_to_end(key)
+
+        if missing:
+            loaded = await self.load_tiles(session, missing, stats)
+            for key, tile in loaded.items():
+                self.add_tile(key, tile)
+            tiles.update(loaded)
+
+        # Roads crossing a tile border are in both tiles
+        tiles = [tiles[key] for key in keys]
+        way_ids = np.concatenate([tile.roads.way_ids for tile in tiles])
+        first = np.sort(np.unique(way_ids, return_index=True)[1])
+        roads = RoadWKB(
+            way_ids=way_ids,
+            directionality=np.concatenate([t.roads.directionality for t in tiles]),
+            wkb=np.concatenate([t.roads.wkb for t in tiles]),
+        )
+        return roads.take(first)
+
+    def get_tile_keys(self, points, buffer):
+        """
+        Returns the keys `(x, y)` of the tiles within `buffer` meters of any
+        of the points.
+        """
+        coordinates = shapely.get_coordinates(points)
+        low = np.floor((coordinates - buffer) / self.tile_size).astype(int)
+        high = np.floor((coordinates + buffer) / self.tile_size).astype(int)
+
+        keys = set()
+        width, height = (high - low).max(axis=0, initial=0) + 1
+        for dx in range(width):
+            for dy in range(height):
+                tiles = np.minimum(low + [dx, dy], high)
+                keys.update(map(tuple, tiles.tolist()))
+        return sorted(keys)
+
+    def get_tile_envelope(self, key):
+        x, y = key
+        return (
+            x * self.tile_size,
+            y * self.tile_size,
+            (x + 1) * self.tile_size,
+            (y + 1) * self.tile_size,
+        )
+
+    async def load_tiles(self, session, keys, stats):
+        """
+        Loads the roads of the tiles from the database, in one query, and
+        returns the `RoadTile` of each key. Only the tile keys are sent, and
+        each road is received once, with the keys of all of these tiles its
+        bounding box intersects.
+        """
+        with stats.stage("load_roads.query"):
+            rows = await self.query_tiles(session, keys)
+
+        way_ids, directionality, import_groups, wkb, tile_x, tile_y = (
+            zip(*rows) if rows else [()] * 6
+        )
+        stats.add_count("road_queries", 1)
+        stats.add_count("road_query_bytes_sent", 8 * len(keys))
+        stats.add_count("road_query_bytes_received", sum(map(len, wkb)))
+
+        roads = RoadWKB(
+            way_ids=np.array(way_ids, dtype=np.int64),
+            directionality=np.array(directionality, dtype=int),
+            wkb=np.array(wkb, dtype=object),
+        )
+        import_groups = np.array(import_groups, dtype=object)
+        sizes = np.array([len(road_wkb) for road_wkb in wkb], dtype=int)
+
+        tile_roads = {key: [] for key in keys}
+        for index, road_keys in enumerate(zip(tile_x, tile_y)):
+            for key in zip(*road_keys):
+                tile_roads[key].append(index)
+
+        return {
+            key: RoadTile(
+                roads=roads.take(index),
+                import_groups=frozenset(import_groups[index]),
+                size=int(sizes[index].sum()),
+            )
+            for key, index in tile_roads.items()
+        }
+
+    async def query_tiles(self, session, keys):
+        """
+        Returns the rows `(way_id, directionality, import_group, wkb, x, y)`
+        of the roads whose bounding box intersects any of the tiles, where
+        `x` and `y` are the lists of the keys of these tiles.
+        """
+        x, y = np.array(keys).T.tolist()
+        return (
+            await session.execute(
+                LOAD_TILE_ROADS, {"x": x, "y": y, "tile_size": self.tile_size}
+            )
+        ).all()
+
+    def add_tile(self, key, tile):
+        self.tiles[key] = tile
+        self.size += tile.size
+
+        while self.size > self.max_size and self.tiles:
+            _key, evicted = self.tiles.popitem(last=False)
+            self.size -= evicted.size
+
+    def drop_tiles(self, import_groups, extents=()):
+        """
+        Drops the tiles that contain roads of the import groups, or intersect
+        any of the extents `(xmin, ymin, xmax, ymax)`.
+        """
+        import_groups = set(import_groups)
+        for key in list(self.tiles):
+            xmin, ymin, xmax, ymax = self.get_tile_envelope(key)
+            if self.tiles[key].import_groups & import_groups or any(
+                xmin <= e_xmax and e_xmin <= xmax and ymin <= e_ymax and e_ymin <= ymax
+                for e_xmin, e_ymin, e_xmax, e_ymax in extents
+            ):
+                self.size -= self.tiles.pop(key).size
+
+    async def update_imports(self, session):
+        """
+        Drops the tiles with roads of the import groups that were imported
+        since the last check, including the tiles where these import groups
+        have roads now.
+        """
+        imports = await get_road_imports(session)
+
+        if self.imports is not None and imports != self.imports:
+            changed = {
+                group
+                for group in imports.keys() | self.imports.keys()
+                if imports.get(group) != self.imports.get(group)
+            }
+            log.info("Road import groups %s changed, updating road cache.", changed)
+
+            extents = (
+                await session.execute(
+                    select(
+                        func.ST_XMin(func.ST_Extent(Road.geometry)),
+                        func.ST_YMin(func.ST_Extent(Road.geometry)),
+                        func.ST_XMax(func.ST_Extent(Road.geometry)),
+                        func.ST_YMax(func.ST_Extent(Road.geometry)),
+                    )
+                    .where(Road.import_group.in_(changed))
+                    .group_by(Road.import_group)
+                )
+            ).all()
+            self.drop_tiles(changed, extents)
+
+        self.imports = imports
+        self.version = format_road_version(imports)
+
+
+_road_cache = None
+
+
+def configure_road_cache(max_size, tile_size=DEFAULT_ROAD_CACHE_TILE_SIZE):
+    """
+    Sets up the road cache of this process, with a maximum size in bytes.
+    """
+    global _road_cache
+
+    if _road_cache is None:
+        _road_cache = RoadCache(max_size, tile_size)
+
+
+def get_road_cache():
+    """
+    Returns the road cache of this process, creating one with the default
+    size if it was not configured.
+    """
+    configure_road_cache(DEFAULT_ROAD_CACHE_SIZE)
+    return _road_cache
@@ -0,0 +1,154 @@
+import asyncio
+
+import numpy
+import shapely
+
+from obs.api.metrics import ProcessingStats
+from obs.api.process.road_cache import RoadCache, RoadTile
+from obs.api.process.snapping import RoadTree, RoadWKB
+
+
+class FakeRoadCache(RoadCache):
+    """A road cache that loads its roads from a list instead of the database."""
+
+    def __init__(self, roads, **kwargs):
+        super().__init__(**kwargs)
+        self.roads = roads
+        self.loaded = []
+
+    async def update_imports(self, session):
+        self.version = "test"
+
+    async def query_tiles(self, session, keys):
+        self.loaded.extend(keys)
+        rows = []
+        for i, geometry in enumerate(self.roads.geometries):
+            road_keys = [
+                key
+                for key in keys
+                if shapely.intersects(
+                    geometry, shapely.box(*self.get_tile_envelope(key))
+                )
+            ]
+            if road_keys:
+                x, y = zip(*road_keys)
+                rows.append(
+                    (
+                        int(self.roads.way_ids[i]),
+                        int(self.roads.directionality[i]),
+                        "test",
+                        shapely.to_wkb(geometry),
+                        list(x),
+                        list(y),
+                    )
+                )
+        return rows
+
+
+def make_roads():
+    # two horizontal roads crossing a tile border, and a short vertical one
+    return RoadTree(
+        way_ids=numpy.array([1, 2, 3]),
+        directionality=numpy.array([0, 1, 0]),
+        geometries=shapely.linestrings(
+            [
+                [[500, 500], [3500, 500]],
+                [[500, 1500], [3500, 1500]],
+                [[2350, 0], [2350, 900]],
+            ]
+        ),
+    )
+
+
+def make_tile(roads, index, groups=("test",), size=100):
+    return RoadTile(
+        roads=RoadWKB(
+            way_ids=roads.way_ids[index],
+            directionality=roads.directionality[index],
+            wkb=shapely.to_wkb(roads.geometries[index]),
+        ),
+        import_groups=frozenset(groups),
+        size=size,
+    )
+
+
+def test_tile_keys():
+    cache = RoadCache(tile_size=1000)
+    points = shapely.points([[100, 500], [1500, 500], [1950, 1950]])
+
+    assert cache.get_tile_keys(points, 120) == [
+        (-1, 0),
+        (0, 0),
+        (1, 0),
+        (1, 1),
+        (1, 2),
+        (2, 1),
+        (2, 2),
+    ]
+
+
+def test_get_roads():
+    cache = FakeRoadCache(make_roads(), tile_size=2000)
+    points = shapely.points([[1900, 520], [2100, 520], [2300, 520]])
+
+    stats = ProcessingStats()
+    roads = asyncio.run(cache.get_roads(None, points, 120, stats))
+
+    # road 1 is in two tiles, but only returned once
+    assert roads.way_ids.tolist() == [1, 2, 3]
+    assert roads.directionality.tolist() == [0, 1, 0]
+    # road 2 is too far away, which is only checked when decoded
+    assert roads.decode().within(points, 120).way_ids.tolist() == [1, 3]
+    assert cache.loaded == [(0, 0), (1, 0)]
+    # both tiles in one query, roads in both of them received once
+    expected = {
+        "road_cache_hits": 0,
+        "road_cache_misses": 2,
+        "road_queries": 1,
+        "road_query_bytes_sent": 16,
+        "road_query_bytes_received": 3 * 41,
+    }
+    assert stats.counts == expected
+    assert list(stats.timings) == ["load_roads.query"]
+    assert cache.tiles[(0, 0)].roads.way_ids.tolist() == [1, 2]
+    assert cache.tiles[(1, 0)].roads.way_ids.tolist() == [1, 2, 3]
+
+    asyncio.run(cache.get_roads(None, points, 120, stats))
+    assert len(cache.loaded) == 2
+    assert stats.counts == {**expected, "road_cache_hits": 2}
+
+
+def test_load_empty_tiles():
+    cache = FakeRoadCache(make_roads(), tile_size=2000)
+    points = shapely.points([[11000, 11000]])
+
+    roads = asyncio.run(cache.get_roads(None, points, 120))
+
+    assert len(roads) == 0
+    assert list(cache.tiles) == [(5, 5)]
+    assert cache.tiles[(5, 5)].size == 0
+
+
+def test_evicts_least_recently_used():
+    roads = make_roads()
+    cache = RoadCache(max_size=250)
+    cache.add_tile((0, 0), make_tile(roads, [0]))
+    cache.add_tile((1, 0), make_tile(roads, [1]))
+    cache.tiles.move_to_end((0, 0))
+    cache.add_tile((2, 0), make_tile(roads, [2]))
+
+    assert list(cache.tiles) == [(0, 0), (2, 0)]
+    assert cache.size == 200
+
+
+def test_drop_tiles_of_import_group():
+    roads = make_roads()
+    cache = RoadCache(tile_size=1000)
+    cache.add_tile((0, 0), make_tile(roads, [0], groups=["a"]))
+    cache.add_tile((5, 5), make_tile(roads, [1], groups=["b"]))
+    cache.add_tile((9, 9), make_tile(roads, [], groups=[]))
+
+    cache.drop_tiles(["a"], extents=[(9500, 9500, 12000, 12000)])
+
+    assert list(cache.tiles) == [(5, 5)]
+    assert cache.size == 100
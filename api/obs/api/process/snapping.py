@@ -17,21 +17,26 @@
 # along with the OpenBikeSensor Portal Software.  If not, see
 # <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict
+import asyncio
+import logging
+import time
+from collections import deque
 from dataclasses import dataclass
 from functools import cached_property, partial
-from typing import Optional
 
+from haversine import Unit, haversine_vector
 import numpy as np
+import pandas as pd
 from pyproj import Transformer
 import shapely
 from shapely.geometry import MultiPoint
 from shapely.ops import transform
-from shapely.wkb import dumps as dump_wkb
-from sqlalchemy import func, select
 from transformations import unit_vector
 
-from obs.api.db import Road
+from obs.api.metrics import ProcessingStats
+from obs.api.process.pool import run_in_pool
+
+log = logging.getLogger(__name__)
 
 # https://epsg.io/4326 -- World Geodetic System 1984, used in GPS
 WSG84 = "EPSG:4326"  # degrees lat/lng WSG84
@@ -39,9 +44,9 @@ WSG84 = "EPSG:4326"  # degrees lat/lng WSG84
 # https://epsg.io/3857 -- WGS 84 / Pseudo-Mercator (e. g. OpenStreetMap)
 WEB_MERCATOR = "EPSG:3857"
 
-wsg84_to_mercator = partial(
-    transform, Transformer.from_crs(WSG84, WEB_MERCATOR, always_xy=True).transform
-)
+WSG84_TO_MERCATOR = Transformer.from_crs(WSG84, WEB_MERCATOR, always_xy=True)
+
+wsg84_to_mercator = partial(transform, WSG84_TO_MERCATOR.transform)
 mercator_to_wsg84 = partial(
     transform, Transformer.from_crs(WEB_MERCATOR, WSG84, always_xy=True).transform
 )
@@ -57,50 +62,94 @@ def point_feature_collection(df) -> MultiPoint:
     return MultiPoint(coordinates)
 
 
-async def load_roads(session, track_points: MultiPoint, buffer):
+@dataclass
+class RoadTree:
     """
-    Loads all those roads from the database that are in the vicinity of the
-    provided track. The distance to the track is given in meters via `buffer`.
-
-    Road.geometry and track_points are both in mercator projection, and the
-    unit for distance in that projection is meters, so the buffer is in
-    meters.
+    The roads to snap a track to, with their geometries in mercator projection
+    and a spatial index of them, all in the same order.
     """
-    query = select(Road).where(
-        func.ST_DWithin(
-            Road.geometry,
-            func.ST_GeomFromEWKB(dump_wkb(track_points, srid=3857)),
-            buffer,
-        )
-    )
 
-    return list((await session.execute(query)).scalars())
+    way_ids: np.ndarray
+    directionality: np.ndarray
+    geometries: np.ndarray
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    def __getstate__(self):
+        # The spatial index is built again where it is needed, instead of
+        # being pickled for the processing pool.
+        state = self.__dict__.copy()
+        state.pop("tree", None)
+        return state
+
+    @cached_property
+    def tree(self):
+        return shapely.STRtree(self.geometries)
+
+    def within(self, points, buffer) -> "RoadTree":
+        """
+        Returns the roads within `buffer` meters of any of the points.
+        """
+        return self.take(np.unique(self.tree.query(points, "dwithin", buffer)[1]))
+
+    def take(self, index) -> "RoadTree":
+        """
+        Returns the roads at the given indices.
+        """
+        return RoadTree(
+            way_ids=self.way_ids[index],
+            directionality=self.directionality[index],
+            geometries=self.geometries[index],
+        )
 
 
-def create_road_lookup(roads, track: MultiPoint, buffer: float):
+@dataclass
+class RoadWKB:
     """
-    Produces a lookup table for each point on the track (by index)
-    that contains a list of roads in its buffer radius. Each entry
-    in the list is a tuple of (distance, road, road_geometry).
+    Roads as loaded from the database, with their geometries as WKB in
+    mercator projection. They are kept and passed to the processing pool in
+    this form, which is compact and cheap to pickle, and only decoded into a
+    `RoadTree` where a track is snapped to them.
     """
-    points = track.geoms
 
-    roads_by_index, road_geometries = zip(
-        *[
-            (road, wsg84_to_mercator(shapely.from_geojson(road.geometry)))
-            for road in roads
-        ]
-    )
+    way_ids: np.ndarray
+    directionality: np.ndarray
+    wkb: np.ndarray
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    def take(self, index) -> "RoadWKB":
+        """
+        Returns the roads at the given indices.
+        """
+        return RoadWKB(
+            way_ids=self.way_ids[index],
+            directionality=self.directionality[index],
+            wkb=self.wkb[index],
+        )
+
+    def decode(self) -> RoadTree:
+        return RoadTree(
+            way_ids=self.way_ids,
+            directionality=self.directionality,
+            geometries=shapely.from_wkb(self.wkb),
+        )
 
-    tree = shapely.STRtree(road_geometries)
-    lookup = defaultdict(list)
-    for point_index, road_index in tree.query(points, "dwithin", buffer).T:
-        road_geometry = road_geometries[road_index]
-        distance = road_geometry.distance(points[point_index])
-        road = roads_by_index[road_index]
-        lookup[point_index].append((distance, road, road_geometry))
 
-    return lookup
+def create_road_tree(roads) -> RoadTree:
+    """
+    Creates the `RoadTree` of `Road` objects, projecting their geometries to
+    mercator.
+    """
+    return RoadTree(
+        way_ids=np.array([road.way_id for road in roads]),
+        directionality=np.array([road.directionality for road in roads]),
+        geometries=np.array(
+            [wsg84_to_mercator(shapely.from_geojson(road.geometry)) for road in roads]
+        ),
+    )
 
 
 def line_directions(line: MultiPoint, offset=1):
@@ -110,33 +159,33 @@ def line_directions(line: MultiPoint, offset=1):
     return dirs
 
 
-def project_on_line(line, point, d=10):
+def project_on_lines(lines, points, d=10):
     """
-    Projects the point onto the line and determines the tangent direction of
-    that point. Returns a tuple `(projected_point, tangent_vector)`.
+    Projects each point onto the respective line and determines the tangent
+    direction of the line at that point. Returns a tuple `(projected_points,
+    tangent_vectors)` of arrays.
     """
-    loc = shapely.line_locate_point(line, point)
-    target = shapely.line_interpolate_point(line, loc)
+    loc = shapely.line_locate_point(lines, points)
+    targets = shapely.line_interpolate_point(lines, loc)
 
-    a = shapely.line_interpolate_point(line, loc - d)
-    b = shapely.line_interpolate_point(line, loc + d)
-    diff = np.array([b.x - a.x, b.y - a.y])
+    a = shapely.get_coordinates(shapely.line_interpolate_point(lines, loc - d))
+    b = shapely.get_coordinates(shapely.line_interpolate_point(lines, loc + d))
 
-    return target, unit_vector(diff)
+    return targets, unit_vector(b - a, axis=1)
 
 
 def cost_by_direction_dot(dot, directionality):
-    if directionality == 0:
-        # normal two-way
-        return 2 - abs(dot)
+    """
+    Works on arrays of direction dot products and the directionality of the
+    respective roads, as well as on single values.
+    """
+    # normal two-way
+    two_way = 2 - np.abs(dot)
 
-    if directionality < 0:
-        dot *= -1
+    dot = np.where(directionality < 0, -dot, dot)
+    one_way = np.where(dot < 0, (2 + dot) ** 2 * 0.7 + 0.3, (2 - dot) ** 2)
 
-    if dot < 0:
-        return (2 + dot) ** 2 * 0.7 + 0.3
-    else:
-        return (2 - dot) ** 2
+    return np.where(directionality == 0, two_way, one_way)
 
 
 def cost_by_angle(direction, road_direction, directionality):
@@ -154,6 +203,10 @@ def cost_by_angle(direction, road_direction, directionality):
 
 
 def get_factor_for_changing_way(a, b, road_distance):
+    """
+    Works on arrays of the way ids `a` and `b` (0 for off-road) and the
+    distance between the respective roads, as well as on single values.
+    """
     factor_go_offroad = 20
     factor_snap_back_onto_road = 0.5
     factor_stay_on_road = 1.0
@@ -161,19 +214,16 @@ def get_factor_for_changing_way(a, b, road_distance):
     factor_switch_roads = 1
     factor_switch_roads_per_meter_jump = 10
 
-    if a == 0 and b == 0:
-        return factor_stay_off_road
-    if a == b:
-        return factor_stay_on_road
-    if b == 0:
-        return factor_go_offroad
-    if a == 0:
-        return factor_snap_back_onto_road
-
-    if road_distance < 0.5:  # threshold
-        return factor_switch_roads
-    else:
-        return road_distance * factor_switch_roads_per_meter_jump
+    # The first matching rule applies, so they are applied in reverse order
+    factor = np.where(
+        road_distance < 0.5,  # threshold
+        factor_switch_roads,
+        road_distance * factor_switch_roads_per_meter_jump,
+    )
+    factor = np.where(a == 0, factor_snap_back_onto_road, factor)
+    factor = np.where(b == 0, factor_go_offroad, factor)
+    factor = np.where(a == b, factor_stay_on_road, factor)
+    return np.where((a == 0) & (b == 0), factor_stay_off_road, factor)
 
 
 def angle_between(v1, v2):
@@ -193,158 +243,661 @@ def candidate_cost(distance_to_gps, road_direction_dot, directionality):
 
 
 @dataclass
-class Candidate:
-    cost: float
-    distance_to_gps: float
-    road_direction_dot: float
-    road: Optional[Road]
-    road_point: shapely.Point
-    road_direction: np.ndarray
-    road_geometry: shapely.Geometry
-    direction: np.ndarray
-
-    total_cost: float = 0
-    chosen_previous: Optional["Candidate"] = None
-
-    _road_point_buffered = None
-
-    @property
-    def road_point_buffered(self):
-        if self._road_point_buffered is None:
-            buffer = 30
-            x, y = self.road_point.x, self.road_point.y
-            self._road_point_buffered = shapely.box(
-                x - buffer, y - buffer, x + buffer, y + buffer
+class Candidates:
+    """
+    The candidates for snapping one track point to a road, as arrays with one
+    entry per candidate, ordered by cost. A candidate that is not on a road
+    has the way id 0 and no road geometry.
+    """
+
+    cost: np.ndarray
+    road_direction_dot: np.ndarray
+    way_id: np.ndarray
+    road_points: np.ndarray
+    road_geometries: np.ndarray
+
+    # The part of each road geometry in the vicinity of the road point
+    local_roads: np.ndarray
+
+    def take(self, index) -> "Candidates":
+        """
+        Returns the candidates at the given indices.
+        """
+        return Candidates(
+            cost=self.cost[index],
+            road_direction_dot=self.road_direction_dot[index],
+            way_id=self.way_id[index],
+            road_points=self.road_points[index],
+            road_geometries=self.road_geometries[index],
+            local_roads=self.local_roads[index],
+        )
+
+
+# A suggested size of the grid cells (in meters) by which the road point
+# locations are rounded for looking up road distances in the
+# `RoadProximityMemo`, if it is enabled (`SNAPPING_PROXIMITY_GRID`). The local
+# road around a road point moves by at most about this much within a cell, and
+# so does its distance to the other road.
+PROXIMITY_GRID = 5.0
+
+# Maximum number of remembered road distances, before they are dropped.
+PROXIMITY_MEMO_SIZE = 200000
+
+
+class RoadProximityMemo:
+    """
+    Remembers the distance between the part of a road around a road point
+    (the local road of a candidate) and another road, by the way ids of both
+    roads and the location of the road point, rounded to the cells of a grid
+    of `grid` meters. Consecutive points of a track keep switching between the
+    same few roads at the same places, so the same distances are needed again
+    and again.
+
+    The remembered distance may have been computed for a different road point
+    in the same cell, so snapping with the memo is faster, but approximate,
+    and it is only used if enabled.
+    """
+
+    def __init__(self, grid, max_size=PROXIMITY_MEMO_SIZE):
+        self.grid = grid
+        self.max_size = max_size
+        self.distances = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_distances(self, prev: Candidates, candidates: Candidates, rows, columns):
+        """
+        Returns the distances between the local roads of the candidates and
+        the roads of the previous candidates, for each pair of indices in
+        `rows` and `columns`.
+        """
+        cells = np.floor(shapely.get_coordinates(candidates.road_points) / self.grid)
+        keys = list(
+            zip(
+                prev.way_id[rows].tolist(),
+                candidates.way_id[columns].tolist(),
+                *cells[columns].T.tolist(),
+            )
+        )
+
+        get = self.distances.get
+        distances = np.array([get(key, np.nan) for key in keys])
+        missing = np.flatnonzero(np.isnan(distances))
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing):
+            distances[missing] = shapely.distance(
+                candidates.local_roads[columns[missing]],
+                prev.road_geometries[rows[missing]],
+            )
+            if len(self.distances) + len(missing) > self.max_size:
+                self.distances.clear()
+            self.distances.update(
+                zip([keys[i] for i in missing], distances[missing].tolist())
             )
-        return self._road_point_buffered
 
+        return distances
 
-def edge_cost(c1: Candidate, c2: Candidate):
+
+def transition_costs(
+    prev: Candidates, candidates: Candidates, proximity: RoadProximityMemo = None
+):
+    """
+    Returns the matrix of costs for going from each of the previous candidates
+    (rows) to each of the candidates (columns), including the cost of the
+    candidate itself. The road distances are looked up in the `proximity`
+    memo, if given.
+    """
     cost_per_meter_travel_distance = 1
-    distance_traveled = c1.road_point.distance(c2.road_point)
+    distance_traveled = shapely.distance(
+        prev.road_points[:, np.newaxis], candidates.road_points[np.newaxis, :]
+    )
 
-    # Remove all parts of the road geometry not in proximity to the snapping
-    # point. Check how close the local road segment is to the other road, i. e
+    way_a = prev.way_id[:, np.newaxis]
+    way_b = candidates.way_id[np.newaxis, :]
+
+    # Check how close the local road segment is to the other road, i. e
     # whether there is an intersection between those roads in the vicinity of
-    # the current location (not somewhere unrelated)
-    if not c2.road_geometry:
-        road_distance = distance_traveled
+    # the current location (not somewhere unrelated). This only matters when
+    # switching from one road to another.
+    rows, columns = np.nonzero((way_a != way_b) & (way_a != 0) & (way_b != 0))
+    road_distance = np.full(distance_traveled.shape, np.nan)
+    if proximity is None:
+        road_distance[rows, columns] = shapely.distance(
+            candidates.local_roads[columns], prev.road_geometries[rows]
+        )
     else:
-        local_road = c2.road_point_buffered.intersection(c2.road_geometry)
-        road_distance = local_road.distance(c1.road_geometry)
+        road_distance[rows, columns] = proximity.get_distances(
+            prev, candidates, rows, columns
+        )
 
-    change_way_factor = get_factor_for_changing_way(
-        c1.road.way_id if c1.road else 0,
-        c2.road.way_id if c2.road else 0,
-        road_distance,
-    )
+    change_way_factor = get_factor_for_changing_way(way_a, way_b, road_distance)
     cost = distance_traveled * cost_per_meter_travel_distance * change_way_factor
-    return c2.cost + cost
+    return candidates.cost[np.newaxis, :] + cost
+
+
+DIRECTION_OFFSET = 5
+
+
+# Tracks are split into segments where the recording has a gap of more than
+# this many seconds, or the position jumps by more than this many meters from
+# one point to the next (e.g. when the recording was paused on a train ride).
+SEGMENT_MAX_TIME_GAP = 60
+SEGMENT_MAX_DISTANCE_GAP = 250
+
+
+def get_track_segments(
+    df, max_time_gap=SEGMENT_MAX_TIME_GAP, max_distance_gap=SEGMENT_MAX_DISTANCE_GAP
+):
+    """
+    Splits the track in the dataframe at gaps in time or position. Returns a
+    list of `(start, end)` row ranges, one for each segment.
+    """
+    coordinates = np.dstack((df["latitude"], df["longitude"]))[0]
+    distance = haversine_vector(coordinates[:-1], coordinates[1:], unit=Unit.METERS)
+    time_delta = df["datetime"].diff().dt.total_seconds().to_numpy()[1:]
+
+    gaps = np.flatnonzero((time_delta > max_time_gap) | (distance > max_distance_gap))
+    bounds = [0, *(gaps + 1).tolist(), len(df)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def not_snapped(df):
+    """
+    Returns a copy of the dataframe with the columns added by
+    :py:func:`snap_to_loaded_roads`, for points that could not be snapped.
+    """
+    df = df.copy()
+    df["longitude_snapped"] = df["longitude"]
+    df["latitude_snapped"] = df["latitude"]
+    df["way_id"] = 0
+    df["direction_reversed"] = False
+    return df
 
 
-async def snap_to_roads(session, df, buffer=120.0, choice_count=10):
+async def snap_to_roads(
+    session,
+    df,
+    road_cache,
+    buffer=120.0,
+    choice_count=10,
+    beam_margin=None,
+    cost_cutoff=None,
+    proximity_grid=None,
+    stats=None,
+):
+    """
+    Snaps the track in the dataframe to the roads from the database, which
+    are taken from the `road_cache`, if possible. The track is split into
+    segments at gaps (see :py:func:`get_track_segments`), and each segment is
+    snapped on its own, to the roads along that segment. The roads are loaded
+    on the event loop, as WKB, and decoded and snapped to in the processing
+    pool (see :py:func:`snap_to_road_wkb`), for all segments in parallel. The
+    candidates are pruned by `beam_margin` and `cost_cutoff`, if given (see
+    `ViterbiDecoder`), and road distances are approximated with a
+    `RoadProximityMemo` of `proximity_grid`, if given.
+    Stage timings and counts are added to `stats`, if given.
+
+    Adds the columns of :py:func:`snap_to_loaded_roads` and the `segment`
+    column, the index of the segment each point belongs to. Segments too
+    short to be snapped are kept, but not snapped to any road.
+    """
+    stats = stats if stats is not None else ProcessingStats()
     point_count = len(df)
-    direction_offset = 5
-    min_points = 2 * direction_offset + 1
+    min_points = 2 * DIRECTION_OFFSET + 1
 
     if point_count < min_points:
         raise ValueError("Too few points to process track.")
 
-    # Create a raw point collection, and change it to the mercator projection,
-    # in which we do all our computations
-    track_points = wsg84_to_mercator(point_feature_collection(df))
+    segments = [df.iloc[start:end] for start, end in get_track_segments(df)]
+    stats.set_count("segments", len(segments))
+
+    # Load roads that are within `buffer` meters to any point of each segment.
+    # The segments are in the mercator projection, in which we do all our
+    # computations.
+    segment_roads = []
+    with stats.stage("load_roads"):
+        for segment in segments:
+            roads = None
+            if len(segment) >= min_points:
+                segment_points = wsg84_to_mercator(point_feature_collection(segment))
+                roads = await road_cache.get_roads(
+                    session, shapely.get_parts(segment_points), buffer, stats
+                )
+            segment_roads.append(roads)
 
-    # Load roads that are within `buffer` meters to any point of the track.
-    roads = await load_roads(session, track_points, buffer)
+    if not any(segment_roads):
+        raise ValueError("No roads found in the import area.")
+
+    async def snap_segment(segment, roads):
+        if not roads:
+            return not_snapped(segment), 0
+
+        segment, snap_stats = await run_in_pool(
+            snap_to_road_wkb,
+            segment,
+            roads,
+            buffer,
+            choice_count,
+            beam_margin,
+            cost_cutoff,
+            proximity_grid,
+        )
+        stats.update(snap_stats)
+        return segment, snap_stats.counts["roads"]
 
-    if not roads:
+    with stats.stage("snap"):
+        segments, road_counts = zip(
+            *await asyncio.gather(
+                *(snap_segment(s, roads) for s, roads in zip(segments, segment_roads))
+            )
+        )
+
+    if not any(road_counts):
         raise ValueError("No roads found in the import area.")
 
-    # Figure out the roads in range of each point on the raw track, sorted by
-    # bounding box distance.
-    road_lookup = create_road_lookup(roads, track_points, buffer)
+    df = pd.concat(segments)
+    df["segment"] = np.repeat(np.arange(len(segments)), [len(s) for s in segments])
+    return df
 
-    # Compute the track directions (we ignore the "course" for now). We will use
-    # this for snapping based on the direction of the line segment.
-    track_directions = line_directions(track_points, offset=direction_offset)
 
-    candidates_list = []
+def snap_to_road_wkb(df, roads: RoadWKB, buffer=120.0, *args):
+    """
+    Decodes the roads, keeps those within `buffer` meters of any of the track
+    points, and snaps the track to them with :py:func:`snap_to_loaded_roads`,
+    which gets the other arguments. This runs in the processing pool, so the
+    event loop neither decodes the roads nor builds their spatial index.
+    """
+    started = time.perf_counter()
+    points = shapely.get_parts(wsg84_to_mercator(point_feature_collection(df)))
+    road_tree = roads.decode().within(points, buffer)
+    decode_time = time.perf_counter() - started
+
+    if len(road_tree):
+        df, stats = snap_to_loaded_roads(df, road_tree, buffer, *args)
+    else:
+        df, stats = not_snapped(df), ProcessingStats()
+        stats.set_count("roads", 0)
+
+    stats.add_time("snap.decode_roads", decode_time)
+    return df, stats
+
+
+# Number of track points for which the candidates are generated at once.
+CANDIDATES_CHUNK_SIZE = 1000
+
+
+def get_candidates(road_tree, points, directions, buffer, choice_count):
+    """
+    Finds the candidates for snapping the points (an array) to the roads of
+    the `road_tree` in their buffer radius: each point projected onto each of
+    these roads, with a cost by distance and by how well the road matches the
+    track direction at that point. All pairs of points and roads are handled
+    at once, as arrays. Returns a list of the `choice_count` cheapest
+    candidates of each point, or of only the point itself, if there is no
+    road in range.
+    """
+    point_index, road_index = road_tree.tree.query(points, "dwithin", buffer)
+    road_geometries = road_tree.geometries[road_index]
+    pair_points = points[point_index]
+    pair_directions = directions[point_index]
+
+    distance_to_gps = shapely.distance(road_geometries, pair_points)
+    road_points, road_directions = project_on_lines(road_geometries, pair_points)
+    road_direction_dot = np.sum(pair_directions * road_directions, axis=1)
+    road_direction_dot[np.isnan(road_direction_dot)] = 0
+
+    cost = candidate_cost(
+        distance_to_gps, road_direction_dot, road_tree.directionality[road_index]
+    )
+
+    # Order the pairs by point and cost, keeping the order of the query for
+    # equal costs, and only keep the cheapest `choice_count` of each point.
+    order = np.lexsort((cost, point_index))
+    sorted_point_index = point_index[order]
+    rank = np.arange(len(order)) - np.searchsorted(
+        sorted_point_index, sorted_point_index
+    )
+    order = order[rank < choice_count]
 
-    for point_index, point in enumerate(track_points.geoms):
-        direction = track_directions[point_index]
+    point_index = point_index[order]
+    road_points = road_points[order]
+    road_geometries = road_geometries[order]
 
-        # get road candidates
-        candidates: list[Candidate] = []
-        for distance_to_gps, road, road_geometry in road_lookup[point_index]:
-            road_point, road_direction = project_on_line(road_geometry, point)
-            road_direction_dot = np.dot(direction, road_direction)
-            if np.isnan(road_direction_dot):
-                road_direction_dot = 0
+    # Remove all parts of the road geometry not in proximity to the snapping
+    # point.
+    local_buffer = 30
+    x, y = shapely.get_coordinates(road_points).T
+    local_roads = shapely.intersection(
+        shapely.box(
+            x - local_buffer, y - local_buffer, x + local_buffer, y + local_buffer
+        ),
+        road_geometries,
+    )
 
-            cost = candidate_cost(
-                distance_to_gps, road_direction_dot, road.directionality
+    # Points without any road in range are their own only candidate.
+    missing = np.setdiff1d(np.arange(len(points)), point_index)
+    if len(missing):
+        log.debug("No road in range of %s of %s points", len(missing), len(points))
+    no_road = np.full(len(missing), None)
+
+    columns = [
+        (cost[order], np.zeros(len(missing))),
+        (road_direction_dot[order], np.ones(len(missing))),
+        (road_tree.way_ids[road_index[order]], np.zeros(len(missing), dtype=int)),
+        (road_points, points[missing]),
+        (road_geometries, no_road),
+        (local_roads, no_road),
+    ]
+    point_index = np.concatenate([point_index, missing])
+    order = np.argsort(point_index, kind="stable")
+    splits = np.cumsum(np.bincount(point_index, minlength=len(points)))[:-1]
+
+    return [
+        Candidates(*point_columns)
+        for point_columns in zip(
+            *(np.split(np.concatenate(column)[order], splits) for column in columns)
+        )
+    ]
+
+
+def choose_previous(
+    prev: Candidates,
+    prev_total_cost,
+    candidates: Candidates,
+    proximity: RoadProximityMemo = None,
+):
+    """
+    Finds the cheapest way to reach each of the candidates from one of the
+    previous candidates, given the total cost of reaching those. Returns the
+    total cost of reaching each candidate, and the index of the chosen
+    previous candidate for each.
+    """
+    total_cost = prev_total_cost[:, np.newaxis] + transition_costs(
+        prev, candidates, proximity
+    )
+    chosen_previous = np.argmin(total_cost, axis=0)
+    return total_cost[chosen_previous, np.arange(len(chosen_previous))], chosen_previous
+
+
+# Number of candidates kept by the beam pruning of the `ViterbiDecoder`, when
+# the cheapest path is ahead of all others by more than the beam margin.
+BEAM_MIN_WIDTH = 2
+
+# Distance (in meters) from the end of its way within which the best candidate
+# is considered to be at a junction, where the beam is not narrowed. Otherwise,
+# a path that waits at the end of a way (which costs nothing for the distance
+# traveled) can push out the candidates on the way that continues.
+BEAM_JUNCTION_DISTANCE = 20.0
+
+
+def is_near_way_end(road_geometry, road_point, distance):
+    """
+    Returns whether the road point is within `distance` meters (along the
+    road) from either end of the road geometry, or not on a road at all.
+    """
+    if road_geometry is None:
+        return True
+    location = shapely.line_locate_point(road_geometry, road_point)
+    return location < distance or location > shapely.length(road_geometry) - distance
+
+
+# Number of points after which the `ViterbiDecoder` decides the path, even if
+# the track is still ambiguous, to bound its memory and run time.
+VITERBI_MAX_WINDOW = 500
+
+
+class ViterbiDecoder:
+    """
+    Finds the cheapest path through the candidates of all track points, which
+    are added one point at a time. The candidates are only kept until the
+    path up to them is decided, i.e. until the chosen previous candidates of
+    all paths that are still possible lead back to the same candidate. So the
+    memory used depends on how long the track stays ambiguous, not on its
+    length. The result is the same as if the whole path was decoded at the
+    end, as long as it does not stay ambiguous for more than `max_window`
+    points (e.g. along a cycleway right next to a road). Then the path is
+    decided for the older half of the window, following the currently
+    cheapest path, and only the candidates of the newest point that continue
+    it are kept.
+
+    Optionally, candidates that are unlikely to be on the cheapest path are
+    pruned (beam search), which makes the transitions to the next point
+    cheaper to compute, but may miss the cheapest path:
+
+    * If the cheapest path to a candidate of the point is cheaper than the
+      path to any other candidate by more than `beam_margin`, only the
+      `BEAM_MIN_WIDTH` cheapest candidates are kept. Near parallel roads,
+      where several candidates are about as cheap, and near junctions (the
+      end of the way of the cheapest candidate), all of them are kept.
+    * Candidates whose path costs more than `cost_cutoff` above the
+      cheapest one are dropped.
+    """
+
+    def __init__(
+        self,
+        proximity: RoadProximityMemo = None,
+        beam_margin: float = None,
+        cost_cutoff: float = None,
+        max_window: int = VITERBI_MAX_WINDOW,
+    ):
+        self.proximity = proximity
+        self.beam_margin = beam_margin
+        self.cost_cutoff = cost_cutoff
+        self.max_window = max_window
+        self.pruned = 0
+        self.forced_decisions = 0
+
+        # (candidates, their total cost, index of the chosen previous
+        # candidate for each) of the track points that are not decided yet
+        self.steps = deque()
+        self.max_steps = 0
+
+        # For each of these steps, the indices of the candidates that are on
+        # a path to a candidate of the newest point. These sets only shrink,
+        # so they are updated from the newest point back only as far as they
+        # change.
+        self.alive = deque()
+
+        self.road_points = []
+        self.way_ids = []
+        self.direction_reversed = []
+
+    def add(self, candidates: Candidates):
+        if self.steps:
+            prev, prev_total_cost, _ = self.steps[-1]
+            total_cost, chosen_previous = choose_previous(
+                prev, prev_total_cost, candidates, self.proximity
             )
-            candidates.append(
-                Candidate(
-                    cost,
-                    distance_to_gps,
-                    road_direction_dot,
-                    road,
-                    road_point,
-                    road_direction,
-                    road_geometry,
-                    direction,
-                )
+            chosen_previous = chosen_previous.tolist()
+        else:
+            total_cost, chosen_previous = np.zeros(len(candidates.cost)), []
+
+        keep = self._prune(candidates, total_cost)
+        if keep is not None:
+            self.pruned += len(total_cost) - len(keep)
+            candidates = candidates.take(keep)
+            total_cost = total_cost[keep]
+            if chosen_previous:
+                chosen_previous = [chosen_previous[index] for index in keep]
+
+        self.steps.append((candidates, total_cost, chosen_previous))
+        self.alive.append(set(range(len(total_cost))))
+        self.max_steps = max(self.max_steps, len(self.steps))
+        if len(self.steps) > self.max_window:
+            self._force_decision()
+        self._decide_converged()
+
+    def _prune(self, candidates: Candidates, total_cost):
+        # Returns the indices of the candidates to keep, in their order, or
+        # None to keep all of them.
+        if len(total_cost) <= 1:
+            return None
+
+        order = np.argsort(total_cost, kind="stable")
+        best = total_cost[order[0]]
+        keep = order
+
+        if self.cost_cutoff is not None:
+            keep = keep[total_cost[keep] <= best + self.cost_cutoff]
+
+        if (
+            self.beam_margin is not None
+            and total_cost[order[1]] - best > self.beam_margin
+            and not is_near_way_end(
+                candidates.road_geometries[order[0]],
+                candidates.road_points[order[0]],
+                BEAM_JUNCTION_DISTANCE,
             )
+        ):
+            keep = keep[:BEAM_MIN_WIDTH]
+
+        if len(keep) == len(total_cost):
+            return None
+        return np.sort(keep)
+
+    def _decide_converged(self):
+        # Follow the chosen previous candidates back from the candidates of
+        # the newest point, as long as fewer of them stay alive, and decide
+        # the path up to the newest point where they meet.
+        converged = None
+        for step in range(len(self.steps) - 1, 0, -1):
+            chosen_previous = self.steps[step][2]
+            alive = {chosen_previous[index] for index in self.alive[step]}
+            if converged is None and len(alive) == 1:
+                converged = step - 1
+            if len(alive) == len(self.alive[step - 1]):
+                # the older steps do not change either
+                break
+            self.alive[step - 1] = alive
+
+        if converged is not None:
+            (index,) = self.alive[converged]
+            self._decide(converged, index)
+
+    def _force_decision(self):
+        # Keeps only the candidates of the newest point whose paths go through
+        # the candidate of the cheapest path, half of the window back, so that
+        # the path up to there is decided.
+        newest = len(self.steps) - 1
+        boundary = newest - self.max_window // 2
+        ancestors = list(range(len(self.steps[newest][1])))
+        for step in range(newest, boundary, -1):
+            chosen_previous = self.steps[step][2]
+            ancestors = [chosen_previous[index] for index in ancestors]
+
+        candidates, total_cost, chosen_previous = self.steps[newest]
+        best = ancestors[np.argmin(total_cost)]
+        keep = [index for index, a in enumerate(ancestors) if a == best]
+        if len(keep) < len(total_cost):
+            self.steps[newest] = (
+                candidates.take(keep),
+                total_cost[keep],
+                [chosen_previous[index] for index in keep],
+            )
+            self.alive[newest] = set(range(len(keep)))
+        self.forced_decisions += 1
+
+    def finish(self):
+        """
+        Decides the remaining points, choosing the cheapest path to a
+        candidate of the last point.
+        """
+        if self.steps:
+            best_end_index = np.argmin(self.steps[-1][1])
+            self._decide(len(self.steps) - 1, best_end_index)
+
+    def _decide(self, last_step, index):
+        backwards_path = []
+        for step in range(last_step, -1, -1):
+            candidates, _, chosen_previous = self.steps[step]
+            backwards_path.append((candidates, index))
+            if step:
+                index = chosen_previous[index]
+
+        for candidates, index in reversed(backwards_path):
+            self.road_points.append(candidates.road_points[index])
+            self.way_ids.append(candidates.way_id[index])
+            self.direction_reversed.append(candidates.road_direction_dot[index] < 0)
+
+        for _ in range(last_step + 1):
+            self.steps.popleft()
+            self.alive.popleft()
+
+
+def snap_to_loaded_roads(
+    df,
+    road_tree: RoadTree,
+    buffer=120.0,
+    choice_count=10,
+    beam_margin=None,
+    cost_cutoff=None,
+    proximity_grid=None,
+):
+    """
+    The CPU-bound part of :py:func:`snap_to_roads`, matching the track points
+    to the given roads. Returns a copy of the dataframe with the additional
+    columns `longitude_snapped`, `latitude_snapped`, `way_id` and
+    `direction_reversed`, and the `ProcessingStats` of the snapping stages.
+    The candidates are pruned by `beam_margin` and `cost_cutoff`, if given
+    (see `ViterbiDecoder`). With a `proximity_grid`, distances between roads
+    are approximated with a `RoadProximityMemo`, which lives for this track
+    only, so the result does not depend on the tracks snapped before.
+    """
+    stats = ProcessingStats()
+    stats.set_count("points", len(df))
+    stats.set_count("roads", len(road_tree))
+
+    direction_offset = DIRECTION_OFFSET
+    track_points = wsg84_to_mercator(point_feature_collection(df))
+    points = shapely.get_parts(track_points)
+
+    # Compute the track directions (we ignore the "course" for now). We will use
+    # this for snapping based on the direction of the line segment.
+    track_directions = line_directions(track_points, offset=direction_offset)
 
-        candidates.sort(key=lambda c: c.cost)
-        candidates = candidates[:choice_count]
-
-        if not candidates:
-            print("no candidate for point", point_index, point)
-            candidates = [Candidate(0, 0, 1, None, point, direction, None, direction)]
-
-        if candidates_list:
-            prev_candidates = candidates_list[-1]
-            for candidate in candidates:
-                for prev_candidate in prev_candidates:
-                    cost = edge_cost(
-                        prev_candidate,
-                        candidate,
-                    )
-
-                    if not isinstance(cost, float) and cost > 0:
-                        raise ValueError(f"invalid cost: {cost}")
-
-                    total_cost = prev_candidate.total_cost + cost
-                    if (
-                        candidate.chosen_previous is None
-                        or total_cost < candidate.total_cost
-                    ):
-                        candidate.chosen_previous = prev_candidate
-                        candidate.total_cost = total_cost
-
-        candidates_list.append(candidates)
-
-    backwards_path: list[Candidate] = []
-    # find the best target candidate
-    best_end_index = np.argmin([c.total_cost for c in candidates_list[-1]])
-    c = candidates_list[-1][best_end_index]
-    while c:
-        backwards_path.append(c)
-        c = c.chosen_previous
-
-    result_candidates = list(reversed(backwards_path))
+    proximity = RoadProximityMemo(proximity_grid) if proximity_grid else None
+    decoder = ViterbiDecoder(proximity, beam_margin, cost_cutoff)
+    candidate_count = 0
+    candidates_time = 0.0
+    viterbi_time = 0.0
+
+    for chunk_start in range(0, len(points), CANDIDATES_CHUNK_SIZE):
+        started = time.perf_counter()
+        chunk = slice(chunk_start, chunk_start + CANDIDATES_CHUNK_SIZE)
+        chunk_candidates = get_candidates(
+            road_tree, points[chunk], track_directions[chunk], buffer, choice_count
+        )
+        candidates_done = time.perf_counter()
+        candidates_time += candidates_done - started
+
+        for candidates in chunk_candidates:
+            candidate_count += len(candidates.cost)
+            decoder.add(candidates)
+        viterbi_time += time.perf_counter() - candidates_done
+
+    started = time.perf_counter()
+    decoder.finish()
+    viterbi_time += time.perf_counter() - started
+
+    stats.add_time("snap.candidates", candidates_time)
+    stats.add_time("snap.viterbi", viterbi_time)
+    stats.set_count("candidates", candidate_count)
+    stats.set_count("viterbi_max_window", decoder.max_steps)
+    stats.set_count("pruned_candidates", decoder.pruned)
+    stats.set_count("viterbi_forced_decisions", decoder.forced_decisions)
+    if proximity is not None:
+        stats.set_count("proximity_memo_hits", proximity.hits)
+        stats.set_count("proximity_memo_misses", proximity.misses)
 
     # Extract information
     df = df.copy()
 
-    coordinates_wsg80 = mercator_to_wsg84(
-        MultiPoint([c.road_point for c in result_candidates])
-    )
+    coordinates_wsg80 = mercator_to_wsg84(MultiPoint(decoder.road_points))
 
     df["longitude_snapped"] = [p.x for p in coordinates_wsg80.geoms]
     df["latitude_snapped"] = [p.y for p in coordinates_wsg80.geoms]
-    df["way_id"] = [c.road.way_id if c.road else 0 for c in result_candidates]
-    df["direction_reversed"] = [c.road_direction_dot < 0 for c in result_candidates]
-    return df
+    df["way_id"] = decoder.way_ids
+    df["direction_reversed"] = decoder.direction_reversed
+    return df, stats
@@ -0,0 +1,297 @@
+"""
+A benchmark of snapping tracks to roads, on synthetic road networks and
+tracks, without a database. Each scenario is a road network with the route of
+a ride through it, which is sampled at a fixed interval with random GPS noise,
+so the true way id of every point is known. Snapping such a track measures
+both the speed (points per second) and the quality (share of points snapped
+to their true way) of the snapping code.
+
+The networks, routes and noise only depend on the parameters and the random
+seed, so results of different versions of the code can be compared, see
+`tools/benchmark_snapping.py`.
+"""
+
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from pyproj import Transformer
+import shapely
+
+from obs.api.process.snapping import (
+    WEB_MERCATOR,
+    WSG84,
+    RoadTree,
+    snap_to_loaded_roads,
+)
+
+MERCATOR_TO_WSG84 = Transformer.from_crs(WEB_MERCATOR, WSG84, always_xy=True)
+
+# Where the synthetic networks are placed, in mercator projection (Stuttgart)
+ORIGIN = (1013000.0, 6215000.0)
+
+# Length of the ways the long roads are split into, like in OSM
+WAY_LENGTH = 200.0
+
+
+@dataclass
+class Scenario:
+    """
+    A road network, as WKB in mercator projection like in the road cache, and
+    a sampled ride through it, with the true way id of each point.
+    """
+
+    name: str
+    way_ids: np.ndarray
+    directionality: np.ndarray
+    wkb: np.ndarray
+    track: pd.DataFrame
+    true_way_ids: np.ndarray
+
+
+class NetworkBuilder:
+    """
+    Collects the ways of a synthetic network, in meters relative to the
+    `ORIGIN`, and the legs of the route along them.
+    """
+
+    def __init__(self):
+        self.ways = {}
+        self.route = []
+
+    def add_way(self, coordinates, directionality=0):
+        way_id = len(self.ways) + 1
+        self.ways[way_id] = (np.array(coordinates, dtype=float), directionality)
+        return way_id
+
+    def add_road(self, start, end, directionality=0):
+        """
+        Adds a straight road, split into ways of about `WAY_LENGTH`. Returns
+        their way ids, from `start` to `end`.
+        """
+        start, end = np.array(start, dtype=float), np.array(end, dtype=float)
+        count = max(1, int(round(np.linalg.norm(end - start) / WAY_LENGTH)))
+        bounds = start + np.linspace(0, 1, count + 1)[:, np.newaxis] * (end - start)
+        return [
+            self.add_way([a, b], directionality) for a, b in zip(bounds, bounds[1:])
+        ]
+
+    def ride(self, way_ids, reverse=False):
+        """
+        Adds the ways to the route, in the given order, against their
+        direction if `reverse` is set.
+        """
+        self.route.extend((way_id, reverse) for way_id in way_ids)
+
+    def build(self, name, noise, interval, speed, seed):
+        """
+        Creates the `Scenario`, sampling the route every `interval` seconds at
+        `speed` meters per second, with normally distributed GPS noise of a
+        standard deviation of `noise` meters in each direction.
+        """
+        rng = np.random.default_rng(seed)
+
+        legs = []
+        for way_id, reverse in self.route:
+            coordinates = self.ways[way_id][0]
+            legs.append(coordinates[::-1] if reverse else coordinates)
+        leg_lengths = [shapely.length(shapely.linestrings(leg)) for leg in legs]
+        leg_ends = np.cumsum(leg_lengths)
+        route = shapely.linestrings(np.concatenate(legs))
+
+        distance = np.arange(0, leg_ends[-1], speed * interval)
+        leg = np.minimum(
+            np.searchsorted(leg_ends, distance, side="right"), len(legs) - 1
+        )
+        true_way_ids = np.array([way_id for way_id, _ in self.route])[leg]
+
+        xy = shapely.get_coordinates(shapely.line_interpolate_point(route, distance))
+        xy += rng.normal(0, noise, xy.shape) + ORIGIN
+        longitude, latitude = MERCATOR_TO_WSG84.transform(xy[:, 0], xy[:, 1])
+        track = pd.DataFrame(
+            {
+                "latitude": latitude,
+                "longitude": longitude,
+                "datetime": pd.Timestamp("2023-05-01 10:00:00", tz="UTC")
+                + pd.to_timedelta(np.arange(len(distance)) * interval, unit="s"),
+            }
+        )
+
+        way_ids = np.array(list(self.ways))
+        geometries = shapely.linestrings(
+            [coordinates + ORIGIN for coordinates, _ in self.ways.values()]
+        )
+        return Scenario(
+            name=name,
+            way_ids=way_ids,
+            directionality=np.array([d for _, d in self.ways.values()]),
+            wkb=shapely.to_wkb(geometries),
+            track=track,
+            true_way_ids=true_way_ids,
+        )
+
+
+def grid_network(length, rng, block=100.0, size=12):
+    """
+    A grid of streets, with a way between each pair of neighbouring
+    junctions, and every fourth east-west street one-way (eastbound). The
+    route is a random walk of the given length through the junctions,
+    following the one-way streets and not turning back.
+    """
+    builder = NetworkBuilder()
+    edges = {}
+    for i in range(size):
+        for j in range(size):
+            if i + 1 < size:
+                oneway = 1 if j % 4 == 1 else 0
+                way_id = builder.add_way(
+                    [(i * block, j * block), ((i + 1) * block, j * block)], oneway
+                )
+                edges[(i, j), (i + 1, j)] = (way_id, False)
+                if not oneway:
+                    edges[(i + 1, j), (i, j)] = (way_id, True)
+            if j + 1 < size:
+                way_id = builder.add_way(
+                    [(i * block, j * block), (i * block, (j + 1) * block)]
+                )
+                edges[(i, j), (i, j + 1)] = (way_id, False)
+                edges[(i, j + 1), (i, j)] = (way_id, True)
+
+    neighbours = {}
+    for a, b in edges:
+        neighbours.setdefault(a, []).append(b)
+
+    previous, junction = None, (size // 2, size // 2)
+    for _ in range(int(length // block)):
+        choices = [n for n in neighbours[junction] if n != previous] or [previous]
+        following = choices[rng.integers(len(choices))]
+        way_id, reverse = edges[junction, following]
+        builder.ride([way_id], reverse)
+        previous, junction = junction, following
+    return builder
+
+
+def parallel_network(length, rng, offset=6.0):
+    """
+    A road with a cycleway next to it, `offset` meters apart, and a service
+    road further away. The route goes along the cycleway and back on the
+    road, connected at both ends.
+    """
+    builder = NetworkBuilder()
+    half = max(WAY_LENGTH, length / 2)
+    road = builder.add_road((0, 0), (half, 0))
+    cycleway = builder.add_road((0, offset), (half, offset))
+    builder.add_road((0, 40), (half, 40))
+    start = builder.add_way([(0, 0), (0, offset)])
+    end = builder.add_way([(half, offset), (half, 0)])
+
+    builder.ride([start])
+    builder.ride(cycleway)
+    builder.ride([end])
+    builder.ride(road[::-1], reverse=True)
+    return builder
+
+
+def dual_carriageway_network(length, rng, offset=12.0):
+    """
+    Two one-way carriageways, `offset` meters apart, with junctions of two-way
+    side streets every 300 meters. The route goes along one carriageway and
+    back on the other one, turning at the ends.
+    """
+    builder = NetworkBuilder()
+    half = max(WAY_LENGTH, length / 2)
+    eastbound = builder.add_road((0, 0), (half, 0), directionality=1)
+    westbound = builder.add_road((half, offset), (0, offset), directionality=1)
+    for x in np.arange(0, half, 300.0):
+        builder.add_road((x, -150), (x, 0))
+        builder.add_road((x, offset), (x, offset + 150))
+    start = builder.add_way([(0, offset), (0, 0)])
+    end = builder.add_way([(half, 0), (half, offset)])
+
+    builder.ride(eastbound)
+    builder.ride([end])
+    builder.ride(westbound)
+    builder.ride([start])
+    return builder
+
+
+SCENARIOS = {
+    "grid": grid_network,
+    "parallel": parallel_network,
+    "dual_carriageway": dual_carriageway_network,
+}
+
+
+def make_scenario(name, length=10000.0, noise=5.0, interval=1.0, speed=5.0, seed=1):
+    """
+    Creates the scenario of the given name (see `SCENARIOS`), with a route of
+    about `length` meters.
+    """
+    rng = np.random.default_rng(seed)
+    builder = SCENARIOS[name](length, rng)
+    return builder.build(name, noise, interval, speed, seed)
+
+
+def load_roads(scenario):
+    """
+    Decodes the roads of the scenario and builds their spatial index, like the
+    road cache and the snapping do.
+    """
+    roads = RoadTree(
+        way_ids=scenario.way_ids,
+        directionality=scenario.directionality,
+        geometries=shapely.from_wkb(scenario.wkb),
+    )
+    roads.tree
+    return roads
+
+
+def snap_scenario(scenario, **options):
+    """
+    Snaps the track of the scenario once. Returns the time to load the
+    roads, the snapped dataframe and the `ProcessingStats` of the snapping.
+    """
+    started = time.perf_counter()
+    roads = load_roads(scenario)
+    load_time = time.perf_counter() - started
+    df, stats = snap_to_loaded_roads(scenario.track, roads, **options)
+    return load_time, df, stats
+
+
+def run_scenario(scenario, repeat=3, **options):
+    """
+    Snaps the track of the scenario `repeat` times, with the `options` of
+    :py:func:`snap_to_loaded_roads`, and once more while tracing memory
+    allocations. Returns a dictionary of the results, with the fastest of the
+    timings.
+    """
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        load_time, df, stats = snap_scenario(scenario, **options)
+        runs.append((time.perf_counter() - started, load_time, stats))
+    seconds, load_time, stats = min(runs, key=lambda run: run[0])
+
+    tracemalloc.start()
+    try:
+        snap_scenario(scenario, **options)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    points = len(scenario.track)
+    return {
+        "points": points,
+        "roads": len(scenario.way_ids),
+        "seconds": round(seconds, 6),
+        "points_per_second": round(points / seconds, 1),
+        "peak_memory": peak_memory,
+        "accuracy": round(float(np.mean(df["way_id"] == scenario.true_way_ids)), 4),
+        "timings": {
+            "load_roads": round(load_time, 6),
+            **{name: round(t, 6) for name, t in stats.timings.items()},
+        },
+        "counts": stats.counts,
+    }
@@ -0,0 +1,48 @@
+import numpy
+import shapely
+
+from obs.api.process.snapping import WSG84_TO_MERCATOR
+from obs.api.process.snapping_benchmark import (
+    SCENARIOS,
+    load_roads,
+    make_scenario,
+    run_scenario,
+)
+
+
+def test_scenarios_are_reproducible():
+    for name in SCENARIOS:
+        a = make_scenario(name, length=1000, seed=3)
+        b = make_scenario(name, length=1000, seed=3)
+
+        assert len(a.track) == len(a.true_way_ids) >= 200
+        assert numpy.array_equal(a.true_way_ids, b.true_way_ids)
+        assert a.track.equals(b.track)
+        assert set(a.true_way_ids) <= set(a.way_ids)
+
+
+def test_track_follows_route():
+    for name in SCENARIOS:
+        scenario = make_scenario(name, length=1000, noise=0)
+        roads = load_roads(scenario)
+        points = shapely.points(
+            *WSG84_TO_MERCATOR.transform(
+                scenario.track["longitude"], scenario.track["latitude"]
+            )
+        )
+        way_index = numpy.searchsorted(roads.way_ids, scenario.true_way_ids)
+
+        # without noise, every point is on its true way
+        distance = shapely.distance(points, roads.geometries[way_index])
+        assert distance.max() < 0.01
+
+
+def test_run_scenario():
+    scenario = make_scenario("dual_carriageway", length=1000, noise=2)
+    result = run_scenario(scenario, repeat=1)
+
+    assert result["points"] == len(scenario.track)
+    assert result["points_per_second"] > 0
+    assert result["peak_memory"] > 0
+    assert result["accuracy"] > 0.8
+    assert set(result["timings"]) == {"load_roads", "snap.candidates", "snap.viterbi"}
@@ -0,0 +1,367 @@
+import json
+
+import numpy
+import pandas
+import shapely
+from transformations import unit_vector
+
+from obs.api.db import Road
+from obs.api.process.snapping import (
+    PROXIMITY_GRID,
+    VITERBI_MAX_WINDOW,
+    Candidates,
+    RoadProximityMemo,
+    ViterbiDecoder,
+    candidate_cost,
+    create_road_tree,
+    get_candidates,
+    transition_costs,
+    get_track_segments,
+    point_feature_collection,
+    snap_to_loaded_roads,
+    wsg84_to_mercator,
+)
+from obs.api.process.snapping_benchmark import make_scenario, snap_scenario
+
+
+def make_track(n=100):
+    return pandas.DataFrame(
+        {
+            "latitude": 48.7 + numpy.arange(n) * 0.00005,
+            "longitude": numpy.full(n, 9.1),
+            "datetime": pandas.date_range(
+                "2023-05-01 10:00:00", periods=n, freq="1s", tz="UTC"
+            ),
+        }
+    )
+
+
+def test_continuous_track_is_one_segment():
+    assert get_track_segments(make_track()) == [(0, 100)]
+
+
+def test_split_at_time_gap():
+    df = make_track()
+    df.loc[40:, "datetime"] += pandas.Timedelta(minutes=30)
+
+    assert get_track_segments(df) == [(0, 40), (40, 100)]
+
+
+def test_split_at_position_jump():
+    df = make_track()
+    df.loc[70:, "latitude"] += 0.01  # about 1.1 km
+
+    assert get_track_segments(df) == [(0, 70), (70, 100)]
+    assert get_track_segments(df, max_distance_gap=2000) == [(0, 100)]
+
+
+def make_roads():
+    """A grid of east-west and north-south roads, some of them one-way."""
+    roads = []
+    for i in range(12):
+        coordinates = [
+            [9.1 + j * 0.0005, 48.7 + i * 0.001 + 0.00002 * (j % 3)] for j in range(40)
+        ]
+        roads.append((1 if i % 4 == 1 else 0, coordinates))
+    for j in range(12):
+        coordinates = [
+            [9.1 + j * 0.0015 + 0.00001 * (k % 2), 48.7 + k * 0.0004] for k in range(30)
+        ]
+        roads.append((-1 if j % 5 == 2 else 0, coordinates))
+
+    return [
+        Road(
+            way_id=way_id,
+            directionality=directionality,
+            geometry=json.dumps({"type": "LineString", "coordinates": coordinates}),
+        )
+        for way_id, (directionality, coordinates) in enumerate(roads, 1)
+    ]
+
+
+def make_noisy_track(n, seed=1):
+    """A noisy zig-zag ride through the grid, partly leaving it."""
+    rng = numpy.random.default_rng(seed)
+    steps = numpy.zeros((n, 2))
+    leg = (numpy.arange(n) // 150) % 4
+    steps[leg == 0, 1] = 0.00005
+    steps[leg == 1, 0] = 0.00004
+    steps[leg == 2, 1] = 0.00005
+    steps[leg == 3, 0] = -0.00004
+    positions = numpy.array([48.703, 9.1005]) + numpy.cumsum(steps, axis=0)
+    positions += rng.normal(0, 0.00005, (n, 2))
+
+    df = make_track(n)
+    df["latitude"] = positions[:, 0]
+    df["longitude"] = positions[:, 1]
+    return df
+
+
+def test_get_candidates():
+    road_tree = create_road_tree(make_roads())
+    points = shapely.points([[1013174.0, 6224700.0], [1000000.0, 6000000.0]])
+    directions = numpy.array([[1.0, 0.0], [1.0, 0.0]])
+
+    near, far = get_candidates(road_tree, points, directions, 120.0, 3)
+
+    assert len(near.cost) == 3
+    assert list(near.cost) == sorted(near.cost)
+    assert (near.way_id != 0).all()
+    assert list(far.way_id) == [0]
+    assert far.road_points[0] == points[1]
+    assert far.road_geometries[0] is None
+
+
+def reference_candidates(road_tree, point, direction, buffer, choice_count):
+    """The candidates of a single point, projected onto one road at a time."""
+    candidates = []
+    for road_index in road_tree.tree.query(point, "dwithin", buffer):
+        road_geometry = road_tree.geometries[road_index]
+        distance_to_gps = road_geometry.distance(point)
+
+        loc = shapely.line_locate_point(road_geometry, point)
+        road_point = shapely.line_interpolate_point(road_geometry, loc)
+        a = shapely.line_interpolate_point(road_geometry, loc - 10)
+        b = shapely.line_interpolate_point(road_geometry, loc + 10)
+        road_direction = unit_vector(numpy.array([b.x - a.x, b.y - a.y]))
+
+        road_direction_dot = numpy.dot(direction, road_direction)
+        if numpy.isnan(road_direction_dot):
+            road_direction_dot = 0
+
+        directionality = road_tree.directionality[road_index]
+        cost = candidate_cost(distance_to_gps, road_direction_dot, directionality)
+        candidates.append(
+            (cost, road_point, road_tree.way_ids[road_index], road_direction_dot)
+        )
+
+    candidates.sort(key=lambda c: c[0])
+    return candidates[:choice_count] or [(0, point, 0, 1)]
+
+
+def test_get_candidates_match_per_road():
+    road_tree = create_road_tree(make_roads())
+    df = make_noisy_track(600)
+    points = shapely.get_parts(wsg84_to_mercator(point_feature_collection(df)))
+    # all directions, against and along the one-way roads, and one point far
+    # away from all roads
+    angles = numpy.random.default_rng(2).uniform(0, 2 * numpy.pi, len(points))
+    directions = numpy.stack([numpy.cos(angles), numpy.sin(angles)], axis=1)
+    points = numpy.append(points, shapely.Point(1000000.0, 6000000.0))
+    directions = numpy.append(directions, [[1.0, 0.0]], axis=0)
+
+    steps = get_candidates(road_tree, points, directions, 120.0, 4)
+
+    for point, direction, candidates in zip(points, directions, steps):
+        expected = reference_candidates(road_tree, point, direction, 120.0, 4)
+        assert len(candidates.cost) == len(expected)
+        for i, (cost, road_point, way_id, road_direction_dot) in enumerate(expected):
+            assert numpy.isclose(candidates.cost[i], cost, rtol=1e-12)
+            assert candidates.road_points[i].equals_exact(road_point, 1e-6)
+            assert candidates.way_id[i] == way_id
+            assert numpy.isclose(
+                candidates.road_direction_dot[i], road_direction_dot, rtol=1e-12
+            )
+
+
+def reference_edge_cost(c1, c2):
+    """The transition cost of a single pair of candidates, as it used to be."""
+    distance_traveled = c1["road_point"].distance(c2["road_point"])
+    if not c2["road_geometry"]:
+        road_distance = distance_traveled
+    else:
+        x, y = c2["road_point"].x, c2["road_point"].y
+        local_road = shapely.box(x - 30, y - 30, x + 30, y + 30).intersection(
+            c2["road_geometry"]
+        )
+        road_distance = local_road.distance(c1["road_geometry"])
+
+    a, b = c1["way_id"], c2["way_id"]
+    if a == 0 and b == 0:
+        factor = 40
+    elif a == b:
+        factor = 1.0
+    elif b == 0:
+        factor = 20
+    elif a == 0:
+        factor = 0.5
+    elif road_distance < 0.5:
+        factor = 1
+    else:
+        factor = road_distance * 10
+
+    return c2["cost"] + distance_traveled * 1 * factor
+
+
+def test_transition_costs_match_pairwise():
+    road_tree = create_road_tree(make_roads())
+    # crossing an intersection, and leaving the roads
+    points = shapely.points(
+        [[1013174.0, 6224700.0], [1013185.0, 6224720.0], [1000000.0, 6000000.0]]
+    )
+    directions = numpy.array([[0.6, 0.8]] * 3)
+    steps = get_candidates(road_tree, points, directions, 120.0, 10)
+
+    for prev, candidates in [steps[:2], steps[1:], steps[::-1][:2]]:
+        matrix = transition_costs(prev, candidates)
+
+        def rows(c):
+            return [
+                dict(
+                    cost=c.cost[i],
+                    way_id=c.way_id[i],
+                    road_point=c.road_points[i],
+                    road_geometry=c.road_geometries[i],
+                )
+                for i in range(len(c.cost))
+            ]
+
+        expected = [
+            [reference_edge_cost(c1, c2) for c2 in rows(candidates)]
+            for c1 in rows(prev)
+        ]
+        assert matrix.tolist() == expected
+
+
+def test_road_proximity_memo():
+    road_tree = create_road_tree(make_roads())
+    points = shapely.points([[1013174.0, 6224700.0], [1013185.0, 6224720.0]])
+    directions = numpy.array([[0.6, 0.8]] * 2)
+    prev, candidates = get_candidates(road_tree, points, directions, 120.0, 10)
+    memo = RoadProximityMemo(PROXIMITY_GRID)
+
+    expected = transition_costs(prev, candidates)
+    numpy.testing.assert_array_equal(transition_costs(prev, candidates, memo), expected)
+    assert memo.hits == 0
+    assert memo.misses > 0
+
+    misses = memo.misses
+    numpy.testing.assert_array_equal(transition_costs(prev, candidates, memo), expected)
+    assert memo.hits == misses
+    assert memo.misses == misses
+
+
+class FullChainDecoder(ViterbiDecoder):
+    """Keeps all candidates and decodes the whole path at the end."""
+
+    def __init__(self, *args):
+        super().__init__(*args, max_window=float("inf"))
+
+    def _decide_converged(self):
+        pass
+
+
+def test_sliding_window_matches_full_chain(monkeypatch):
+    roads = make_roads()
+    df = make_noisy_track(1000)
+
+    result, stats = snap_to_loaded_roads(df, create_road_tree(roads))
+    assert stats.counts["viterbi_max_window"] < len(df) / 4
+    assert (result["way_id"] != 0).any()
+    assert (result["way_id"] == 0).any()
+
+    monkeypatch.setattr("obs.api.process.snapping.ViterbiDecoder", FullChainDecoder)
+    expected, _stats = snap_to_loaded_roads(df, create_road_tree(roads))
+
+    pandas.testing.assert_frame_equal(result, expected)
+
+
+def test_sliding_window_is_bounded():
+    # along a cycleway next to a road, the track stays ambiguous
+    scenario = make_scenario("parallel", length=20000)
+    _load_time, result, stats = snap_scenario(scenario)
+
+    assert len(result) > 4 * VITERBI_MAX_WINDOW
+    assert stats.counts["viterbi_max_window"] <= VITERBI_MAX_WINDOW + 1
+    assert stats.counts["viterbi_forced_decisions"] > 0
+    assert (result["way_id"] == scenario.true_way_ids).mean() > 0.8
+
+    # deciding the path takes time linear in the number of points, like
+    # finding the candidates (it was quadratic in the window length)
+    assert stats.timings["snap.viterbi"] < 3 * stats.timings["snap.candidates"]
+
+
+class ExactDecoder(ViterbiDecoder):
+    """Computes every road distance, whatever the proximity memo."""
+
+    def __init__(self, proximity=None, *args):
+        super().__init__(None, *args)
+
+
+def test_snapping_is_exact_by_default(monkeypatch):
+    roads = make_roads()
+    results = []
+    for seed in range(1, 7):
+        df = make_noisy_track(1000, seed=seed)
+        result, stats = snap_to_loaded_roads(df, create_road_tree(roads))
+        assert "proximity_memo_hits" not in stats.counts
+        results.append(result)
+
+    monkeypatch.setattr("obs.api.process.snapping.ViterbiDecoder", ExactDecoder)
+    for seed, result in enumerate(results, 1):
+        df = make_noisy_track(1000, seed=seed)
+        expected, _stats = snap_to_loaded_roads(
+            df, create_road_tree(roads), proximity_grid=PROXIMITY_GRID
+        )
+        pandas.testing.assert_frame_equal(result, expected)
+
+
+def test_snapping_with_proximity_memo():
+    road_tree = create_road_tree(make_roads())
+    df = make_noisy_track(1000, seed=3)
+    result, stats = snap_to_loaded_roads(df, road_tree, proximity_grid=PROXIMITY_GRID)
+    assert stats.counts["proximity_memo_hits"] > 0
+
+    # the memo is not shared, so other tracks snapped before do not matter
+    snap_to_loaded_roads(
+        make_noisy_track(1000, seed=5), road_tree, proximity_grid=PROXIMITY_GRID
+    )
+    again, _stats = snap_to_loaded_roads(df, road_tree, proximity_grid=PROXIMITY_GRID)
+    pandas.testing.assert_frame_equal(result, again)
+
+
+def test_prune_candidates():
+    decoder = ViterbiDecoder(beam_margin=10, cost_cutoff=25)
+    road = shapely.linestrings([[0, 0], [100, 0]])
+    candidates = Candidates(
+        cost=numpy.zeros(4),
+        road_direction_dot=numpy.ones(4),
+        way_id=numpy.arange(1, 5),
+        road_points=shapely.points([[50, 0], [50, 0], [98, 0], [50, 0]]),
+        road_geometries=numpy.array([road] * 4),
+        local_roads=numpy.array([road] * 4),
+    )
+
+    # several candidates are about as cheap: only the cutoff applies
+    keep = decoder._prune(candidates, numpy.array([5.0, 1.0, 8.0, 27.0]))
+    assert keep.tolist() == [0, 1, 2]
+
+    # the cheapest one is far ahead: only the two cheapest are kept
+    keep = decoder._prune(candidates, numpy.array([20.0, 1.0, 40.0, 12.0]))
+    assert keep.tolist() == [1, 3]
+
+    # ... unless it is near a junction
+    keep = decoder._prune(candidates, numpy.array([20.0, 40.0, 1.0, 12.0]))
+    assert keep.tolist() == [0, 2, 3]
+
+    assert (
+        ViterbiDecoder()._prune(candidates, numpy.array([40.0, 1.0, 20.0, 2.0])) is None
+    )
+
+
+def test_beam_pruning():
+    roads = make_roads()
+    df = make_noisy_track(1000)
+    expected, _stats = snap_to_loaded_roads(df, create_road_tree(roads))
+
+    result, stats = snap_to_loaded_roads(
+        df, create_road_tree(roads), beam_margin=1e9, cost_cutoff=1e9
+    )
+    assert stats.counts["pruned_candidates"] == 0
+    pandas.testing.assert_frame_equal(result, expected)
+
+    result, stats = snap_to_loaded_roads(
+        df, create_road_tree(roads), beam_margin=30, cost_cutoff=100
+    )
+    assert stats.counts["pruned_candidates"] > stats.counts["candidates"] / 4
+    assert (result["way_id"] == expected["way_id"]).mean() > 0.95
@@ -0,0 +1,107 @@
+import logging
+import secrets
+import time
+from datetime import datetime, timedelta
+
+from sanic.exceptions import Forbidden
+from sanic.response import text as text_response
+from sqlalchemy import text
+
+from obs.api.app import api
+from obs.api.metrics import (
+    DEFAULT_BUCKETS,
+    METRICS_CONTENT_TYPE,
+    get_bucket_thresholds,
+    get_metrics,
+    get_stage_metrics,
+)
+
+log = logging.getLogger(__name__)
+
+# Tracks processed within this time contribute to the stage histograms
+STAGE_METRICS_WINDOW = timedelta(hours=24)
+
+# The stage histograms are aggregated from the database at most this often (in
+# seconds), however often the metrics are scraped.
+STAGE_METRICS_CACHE_DURATION = 60
+
+# The processing stats are aggregated in the database, by stage and histogram
+# bucket, and by count, instead of loading the stats of every track.
+STAGE_BUCKETS = text(
+    """
+    SELECT timing.key AS stage,
+        :bucket_count - width_bucket(
+            -timing.value::float8, CAST(:thresholds AS float8[])
+        ) AS bucket,
+        count(*) AS count,
+        sum(timing.value::float8) AS sum
+    FROM track, jsonb_each_text(track.processing_stats -> 'timings') AS timing
+    WHERE track.processed_at > :since AND track.processing_stats IS NOT NULL
+    GROUP BY 1, 2
+    """
+)
+
+COUNT_TOTALS = text(
+    """
+    SELECT item.key AS name, sum(item.value::bigint)::bigint AS total
+    FROM track, jsonb_each_text(track.processing_stats -> 'counts') AS item
+    WHERE track.processed_at > :since AND track.processing_stats IS NOT NULL
+    GROUP BY 1
+    """
+)
+
+_stage_metrics = None
+
+
+async def get_cached_stage_metrics(session):
+    """
+    Returns the stage metrics of the tracks processed within the
+    `STAGE_METRICS_WINDOW`, as lines of the Prometheus text format, aggregated
+    again only if the cached ones are older
+    than `STAGE_METRICS_CACHE_DURATION`.
+    """
+    global _stage_metrics
+
+    now = time.monotonic()
+    if _stage_metrics is None or _stage_metrics[0] < now:
+        params = {
+            "since": datetime.utcnow() - STAGE_METRICS_WINDOW,
+            "bucket_count": len(DEFAULT_BUCKETS),
+            "thresholds": get_bucket_thresholds(),
+        }
+        stage_buckets = (await session.execute(STAGE_BUCKETS, params)).all()
+        count_totals = (await session.execute(COUNT_TOTALS, params)).all()
+        _stage_metrics = (
+            now + STAGE_METRICS_CACHE_DURATION,
+            get_stage_metrics(stage_buckets, count_totals),
+        )
+
+    return _stage_metrics[1]
+
+
+def check_metrics_token(req):
+    """
+    Only allows requests with the configured `METRICS_TOKEN` as bearer token.
+    Without a configured token, the metrics are not available.
+    """
+    token = req.app.config.METRICS_TOKEN
+    if not token or not isinstance(req.token, str):
+        raise Forbidden("Metrics require the METRICS_TOKEN")
+
+    if not secrets.compare_digest(req.token.encode(), token.encode()):
+        raise Forbidden("Metrics require the METRICS_TOKEN")
+
+
+@api.route("/metrics")
+async def metrics(req):
+    check_metrics_token(req)
+
+    lines = get_metrics()
+
+    # The stage timings are read from the database, so they include the tracks
+    # processed by dedicated workers.
+    lines.extend(await get_cached_stage_metrics(req.ctx.db))
+
+    return text_response(
+        "".join(f"{line}\n" for line in lines), content_type=METRICS_CONTENT_TYPE
+    )
@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+import pytest
+from sanic.exceptions import Forbidden
+
+from obs.api.routes.metrics import check_metrics_token
+
+
+def make_request(configured, token):
+    config = SimpleNamespace(METRICS_TOKEN=configured)
+    return SimpleNamespace(app=SimpleNamespace(config=config), token=token)
+
+
+def test_check_metrics_token():
+    check_metrics_token(make_request("secret", "secret"))
+
+    for configured, token in [
+        ("secret", None),
+        ("secret", "other"),
+        (None, None),
+        (None, "secret"),
+        ("", ""),
+    ]:
+        with pytest.raises(Forbidden):
+            check_metrics_token(make_request(configured, token))
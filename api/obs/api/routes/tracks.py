@@ -1,8 +1,10 @@
+import asyncio
 import logging
+import os
 import re
 from datetime import date
-from json import load as jsonload
-from os.path import join, exists, isfile
+from json import load as jsonload, loads as jsonloads
+from os.path import exists, isfile, dirname
 
 from sanic.exceptions import InvalidUsage, NotFound, Forbidden
 from sanic.response import file_stream, empty
@@ -11,12 +13,23 @@ from sqlalchemy import select, func, and_
 from sqlalchemy.orm import joinedload
 
 from obs.api.app import api, require_auth, read_api_key, json
-from obs.api.db import Track, Comment, DuplicateTrackFileError
+from obs.api.db import (
+    Track,
+    Comment,
+    DuplicateTrackFileError,
+    PROCESSING_PRIORITY_BULK,
+    TRACK_DATA_FILE,
+)
+from obs.api.upload import receive_body, receive_upload
 from obs.api.utils import tar_of_tracks
 
 log = logging.getLogger(__name__)
 
 
+# The largest JSON body accepted when updating a track, in bytes
+TRACK_UPDATE_MAX_SIZE = 1024 * 1024
+
+
 def normalize_user_agent(user_agent):
     if not user_agent:
         return None
@@ -151,14 +164,14 @@ async def tracks_bulk_action(req):
             await req.ctx.db.delete(track)
         elif action == "makePublic":
             if not track.public:
-                track.queue_processing()
+                track.queue_processing(PROCESSING_PRIORITY_BULK)
             track.public = True
         elif action == "makePrivate":
             if track.public:
-                track.queue_processing()
+                track.queue_processing(PROCESSING_PRIORITY_BULK)
             track.public = False
         elif action == "reprocess":
-            track.queue_processing()
+            track.queue_processing(PROCESSING_PRIORITY_BULK)
         elif action == "download":
             files.add(track.get_original_file_path(req.app.config))
 
@@ -175,45 +188,36 @@ async def tracks_bulk_action(req):
     return empty()
 
 
-@api.post("/tracks")
+@api.post("/tracks", stream=True)
 @read_api_key
 @require_auth
 async def post_track(req):
-    try:
-        file = req.files["body"][0]
-    except LookupError as e:
-        raise InvalidUsage(
-            'Track upload needs a single file in "body" multipart field'
-        ) from e
+    await _release_db_connection(req)
+    upload = await _receive_track_file(req)
+    if upload is None:
+        raise InvalidUsage('Track upload needs a single file in "body" multipart field')
 
     try:
-        body = req.json["track"]
-    except (LookupError, InvalidUsage):
-        body = {}
-
-    if len(file.body) == 0:
-        raise InvalidUsage("Track body can't be empty.")
+        if upload.size == 0:
+            raise InvalidUsage("Track body can't be empty.")
 
-    title = body.get("title")
-    public = body.get("public")
+        track = Track(
+            author=req.ctx.user,
+            author_id=req.ctx.user.id,
+            public=req.ctx.user.are_tracks_visible_for_all,
+        )
+        track.generate_slug()
+        try:
+            await track.prevent_duplicates(req.ctx.db, upload.hash)
+        except DuplicateTrackFileError:
+            raise InvalidUsage("Track file is not unique")
 
-    track = Track(
-        title=title,
-        customized_title=bool(title),
-        author=req.ctx.user,
-        public=public
-        if public is not None
-        else req.ctx.user.are_tracks_visible_for_all,
-    )
-    track.generate_slug()
-    try:
-        await track.prevent_duplicates(req.ctx.db, file.body)
-    except DuplicateTrackFileError:
-        raise InvalidUsage("Track file is not unique")
+        track.uploaded_by_user_agent = normalize_user_agent(req.headers["user-agent"])
+        track.original_file_name = upload.name
+        track.move_to_original_file(req.app.config, upload)
+    finally:
+        upload.discard()
 
-    track.uploaded_by_user_agent = normalize_user_agent(req.headers["user-agent"])
-    track.original_file_name = file.name
-    await track.write_to_original_file(req.app.config, file.body)
     track.queue_processing()
     track.auto_generate_title()
 
@@ -223,6 +227,27 @@ async def post_track(req):
     return await get_track(req, track.slug)
 
 
+async def _release_db_connection(req):
+    """
+    Ends the transaction of the request's session, which the authentication
+    has started, so its connection goes back to the pool while the body is
+    streamed, however long that takes. The loaded objects stay usable, as
+    sessions do not expire them on commit.
+    """
+    await req.ctx.db.commit()
+
+
+async def _receive_track_file(req):
+    """
+    Streams the file in the "body" field of a multipart upload into a
+    temporary file in the tracks directory, see `obs.api.upload`.
+    """
+    config = req.app.config
+    return await receive_upload(
+        req, "body", config.TRACKS_DIR, config.TRACK_UPLOAD_MAX_SIZE
+    )
+
+
 async def _load_track(req, slug, raise_not_found=True):
     track = (
         await req.ctx.db.execute(
@@ -263,10 +288,90 @@ async def delete_track(req, slug: str):
     return empty()
 
 
+def get_track_data_etag(track, encoding):
+    """
+    Returns a strong ETag for the data of the track in the given content
+    encoding. It is derived from the time the track was last processed, which
+    is when the track data changes, so it is known without reading the file.
+    """
+    if track.processed_at is None:
+        return None
+
+    version = track.processed_at.strftime("%Y%m%d%H%M%S%f")
+    suffix = f"-{encoding}" if encoding else ""
+    return f'"{track.id}-{version}{suffix}"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+
+    # If-None-Match uses the weak comparison, ignoring the W/ prefix
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+    return "*" in tags or etag in tags
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Returns whether an `Accept-Encoding` header allows a gzip response, i.e.
+    lists `gzip` (or `x-gzip`) or `*` with a quality above zero. An explicit
+    `gzip;q=0` is a refusal, even if `*` is accepted.
+    """
+    qualities = {}
+    for item in (accept_encoding or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        coding = coding.lower()
+        if coding == "x-gzip":
+            coding = "gzip"
+        qualities[coding] = max(quality, qualities.get(coding, 0.0))
+
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
 @api.get("/tracks/<slug:str>/data")
 async def get_track_data(req, slug: str):
     track = await _load_track(req, slug)
 
+    encoding = "gzip" if accepts_gzip(req.headers.get("accept-encoding")) else None
+    etag = get_track_data_etag(track, encoding)
+
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "private, no-cache"}
+    if etag:
+        headers["ETag"] = etag
+
+    if etag and etag_matches(req.headers.get("if-none-match"), etag):
+        return empty(status=304, headers=headers)
+
+    file_path = track.get_processing_output_path(req.app.config, TRACK_DATA_FILE)
+    if encoding:
+        file_path += ".gz"
+        headers["Content-Encoding"] = encoding
+
+    if not exists(file_path):
+        return await get_legacy_track_data(req, track, headers)
+
+    # The files contain the complete response, and are sent as-is
+    return await file_stream(file_path, mime_type="application/json", headers=headers)
+
+
+async def get_legacy_track_data(req, track, headers):
+    """
+    Serves the data of tracks that were processed before the track data was
+    combined into a single file, until they are processed again.
+    """
     FILE_BY_KEY = {
         "events": "events.json",
         "track": "track.json",
@@ -276,18 +381,15 @@ async def get_track_data(req, slug: str):
     result = {}
 
     for key, filename in FILE_BY_KEY.items():
-        file_path = join(
-            req.app.config.PROCESSING_OUTPUT_DIR, track.file_path, filename
-        )
+        file_path = track.get_processing_output_path(req.app.config, filename)
         if not exists(file_path) or not isfile(file_path):
             continue
 
         with open(file_path) as f:
             result[key] = jsonload(f)
 
-    return json(
-        result,
-    )
+    headers.pop("Content-Encoding", None)
+    return json(result, headers=headers)
 
 
 @api.get("/tracks/<slug:str>/download/original.csv")
@@ -311,9 +413,22 @@ async def download_track_gpx(req, slug: str):
     if not track.is_visible_to(req.ctx.user):
         raise Forbidden()
 
-    file_path = join(req.app.config.PROCESSING_OUTPUT_DIR, track.file_path, "track.gpx")
+    file_path = track.get_processing_output_path(req.app.config, "track.gpx")
     if not exists(file_path) or not isfile(file_path):
-        raise NotFound()
+        if track.processing_status != "complete":
+            raise NotFound()
+
+        # Generated on first download only, most tracks are never downloaded
+        from obs.api.process import export_gpx_from_file
+
+        os.makedirs(dirname(file_path), exist_ok=True)
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            export_gpx_from_file,
+            track.get_original_file_path(req.app.config),
+            file_path,
+            track.slug,
+        )
 
     return await file_stream(
         file_path,
@@ -322,7 +437,7 @@ async def download_track_gpx(req, slug: str):
     )
 
 
-@api.put("/tracks/<slug:str>")
+@api.put("/tracks/<slug:str>", stream=True)
 @require_auth
 async def put_track(req, slug: str):
     track = await _load_track(req, slug)
@@ -330,10 +445,19 @@ async def put_track(req, slug: str):
     if track.author_id != req.ctx.user.id:
         raise Forbidden()
 
-    try:
-        body = req.json["track"]
-    except BaseException:
+    await _release_db_connection(req)
+
+    # A new file is streamed like a new upload, any other update is JSON
+    upload = None
+    if req.headers.get("content-type", "").startswith("multipart/form-data"):
+        upload = await _receive_track_file(req)
         body = {}
+    else:
+        data = await receive_body(req, TRACK_UPDATE_MAX_SIZE)
+        try:
+            body = jsonloads(data)["track"]
+        except BaseException:
+            body = {}
 
     if "title" in body:
         track.title = (body["title"] or "").strip() or None
@@ -349,18 +473,20 @@ async def put_track(req, slug: str):
         process = process or (public != track.public)  # if changed
         track.public = public
 
-    if "body" in req.files:
+    if upload is not None:
         try:
-            file = req.files["body"][0]
-        except LookupError as e:
-            raise InvalidUsage(
-                'Track upload needs a single file in "body" multipart field'
-            ) from e
-
-        await track.prevent_duplicates(req.ctx.db, file.body)
-        track.uploaded_by_user_agent = normalize_user_agent(req.headers["user-agent"])
-        track.original_file_name = file.name or (track.slug + ".csv")
-        await track.write_to_original_file(req.app.config, file.body)
+            try:
+                await track.prevent_duplicates(req.ctx.db, upload.hash)
+            except DuplicateTrackFileError:
+                raise InvalidUsage("Track file is not unique")
+
+            track.uploaded_by_user_agent = normalize_user_agent(
+                req.headers["user-agent"]
+            )
+            track.original_file_name = upload.name or (track.slug + ".csv")
+            track.move_to_original_file(req.app.config, upload)
+        finally:
+            upload.discard()
         process = True
 
     if process:
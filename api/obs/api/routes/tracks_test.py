@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from obs.api.db import Track
+from obs.api.routes.tracks import accepts_gzip, etag_matches, get_track_data_etag
+
+
+def test_track_data_etag():
+    track = Track(id=12, processed_at=datetime(2023, 5, 1, 10, 0, 0, 250000))
+
+    assert get_track_data_etag(track, None) == '"12-20230501100000250000"'
+    assert get_track_data_etag(track, "gzip") == '"12-20230501100000250000-gzip"'
+
+    track.processed_at = None
+    assert get_track_data_etag(track, None) is None
+
+
+def test_etag_matches():
+    etag = '"12-20230501100000250000-gzip"'
+
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"12-20230501100000250000"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_accepts_gzip():
+    assert accepts_gzip("gzip")
+    assert accepts_gzip("gzip, deflate, br")
+    assert accepts_gzip("br;q=1.0, GZIP;q=0.5")
+    assert accepts_gzip("x-gzip")
+    assert accepts_gzip("*")
+    assert accepts_gzip("identity;q=0.5, *;q=0.1")
+
+    assert not accepts_gzip(None)
+    assert not accepts_gzip("")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("gzip; q=0.000, deflate")
+    assert not accepts_gzip("*, gzip;q=0")
+    assert not accepts_gzip("*;q=0")
+    assert not accepts_gzip("gzip;q=invalid")
@@ -0,0 +1,222 @@
+"""
+Receives track files uploaded as multipart form data by streaming the request
+body into a temporary file, hashing it on the way, instead of holding the whole
+body in memory. The temporary file is created in the directory the file is
+moved to later, so that moving it is an atomic rename.
+"""
+
+import hashlib
+import logging
+import os
+from os.path import dirname
+import tempfile
+
+import aiofiles
+from sanic.exceptions import InvalidUsage, PayloadTooLarge
+from sanic.headers import parse_content_header
+
+log = logging.getLogger(__name__)
+
+# Headers of a single part larger than this are rejected, so a malformed body
+# cannot fill the parser's buffer.
+MAX_PART_HEADER_SIZE = 16 * 1024
+
+
+class MultipartParser:
+    """
+    Splits a `multipart/form-data` body, fed chunk by chunk, into its parts.
+    Each call of `feed` returns the events found so far, as tuples of
+    `("part", headers)` when a part starts, with the lowercase header names,
+    and `("data", bytes)` for the content of the current part. Only the bytes
+    that could be the start of a boundary are kept between chunks.
+    """
+
+    def __init__(self, boundary: bytes):
+        self.delimiter = b"\r\n--" + boundary
+        # The body starts with the boundary, without the line break before it
+        self.buffer = bytearray(b"\r\n")
+        self.state = "preamble"
+
+    def feed(self, data):
+        self.buffer += data
+        events = []
+
+        while True:
+            if self.state in ("preamble", "data"):
+                pos = self.buffer.find(self.delimiter)
+                if pos == -1:
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        if self.state == "data":
+                            events.append(("data", bytes(self.buffer[:-keep])))
+                        del self.buffer[:-keep]
+                    break
+
+                if self.state == "data" and pos:
+                    events.append(("data", bytes(self.buffer[:pos])))
+                del self.buffer[: pos + len(self.delimiter)]
+                self.state = "boundary"
+
+            elif self.state == "boundary":
+                if len(self.buffer) < 2:
+                    break
+
+                if self.buffer[:2] == b"--":
+                    self.buffer.clear()
+                    self.state = "epilogue"
+                elif self.buffer[:2] == b"\r\n":
+                    del self.buffer[:2]
+                    self.state = "headers"
+                else:
+                    raise ValueError("invalid multipart boundary")
+
+            elif self.state == "headers":
+                if self.buffer[:2] == b"\r\n":
+                    end = 0
+                else:
+                    end = self.buffer.find(b"\r\n\r\n")
+                    if end == -1:
+                        if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                            raise ValueError("multipart headers too large")
+                        break
+
+                headers = {}
+                for line in self.buffer[:end].decode("utf-8").split("\r\n"):
+                    if line:
+                        name, _, value = line.partition(":")
+                        headers[name.strip().lower()] = value.strip()
+
+                del self.buffer[: end + 2 if end == 0 else end + 4]
+                events.append(("part", headers))
+                self.state = "data"
+
+            else:  # epilogue
+                self.buffer.clear()
+                break
+
+        return events
+
+    def finish(self):
+        if self.state != "epilogue":
+            raise ValueError("incomplete multipart body")
+
+
+class UploadedFile:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.size = 0
+        self.hash = None
+
+    def move_to(self, target):
+        os.makedirs(dirname(target), exist_ok=True)
+        os.replace(self.path, target)
+        self.path = None
+
+    def discard(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+def check_content_length(req, max_size):
+    """
+    Rejects a request whose announced body is larger than `max_size` bytes,
+    before reading any of it. Streamed routes are not limited by Sanic's
+    `REQUEST_MAX_SIZE`, so they check the size of their body themselves.
+    """
+    content_length = req.headers.get("content-length")
+    if content_length is None:
+        return
+
+    try:
+        content_length = int(content_length)
+    except ValueError:
+        raise InvalidUsage("Invalid Content-Length header")
+
+    if content_length > max_size:
+        raise PayloadTooLarge(f"Request body is larger than {max_size} bytes")
+
+
+async def receive_body(req, max_size):
+    """
+    Reads the whole body of a streamed request into memory, rejecting bodies
+    larger than `max_size` bytes, for small bodies such as JSON.
+    """
+    check_content_length(req, max_size)
+
+    body = bytearray()
+    async for chunk in req.stream:
+        body += chunk
+        if len(body) > max_size:
+            raise PayloadTooLarge(f"Request body is larger than {max_size} bytes")
+    return bytes(body)
+
+
+async def receive_upload(req, field, directory, max_size):
+    """
+    Reads the `multipart/form-data` body of a streamed request and writes the
+    file in the form field `field` to a temporary file in `directory`, with
+    its SHA-512 hash computed chunk by chunk. Returns it as an `UploadedFile`,
+    which the caller moves to its place or discards, or None if the field is
+    missing. Request bodies larger than `max_size` bytes are rejected, by their
+    announced length before reading anything if possible.
+    """
+    content_type, options = parse_content_header(req.headers.get("content-type", ""))
+    if content_type != "multipart/form-data" or not options.get("boundary"):
+        raise InvalidUsage(
+            f'Track upload needs a single file in "{field}" multipart field'
+        )
+
+    check_content_length(req, max_size)
+
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+    os.close(fd)
+
+    parser = MultipartParser(options["boundary"].encode("utf-8"))
+    upload = None
+    receiving = False
+    file_hash = hashlib.sha512()
+    size = 0
+
+    try:
+        async with aiofiles.open(path, "wb") as f:
+            async for chunk in req.stream:
+                size += len(chunk)
+                if size > max_size:
+                    raise PayloadTooLarge(
+                        f"Request body is larger than {max_size} bytes"
+                    )
+
+                for event, value in parser.feed(chunk):
+                    if event == "part":
+                        _, disposition = parse_content_header(
+                            value.get("content-disposition", "")
+                        )
+                        receiving = upload is None and disposition.get("name") == field
+                        if receiving:
+                            upload = UploadedFile(disposition.get("filename"), path)
+                    elif receiving:
+                        file_hash.update(value)
+                        upload.size += len(value)
+                        await f.write(value)
+
+        parser.finish()
+    except ValueError as e:
+        os.remove(path)
+        raise InvalidUsage(f"Invalid multipart body: {e}") from e
+    except BaseException:
+        os.remove(path)
+        raise
+
+    if upload is None:
+        os.remove(path)
+        return None
+
+    upload.hash = file_hash.hexdigest()
+    log.debug("Received upload of %s bytes in %s", upload.size, path)
+    return upload
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+from sanic.exceptions import InvalidUsage, PayloadTooLarge
+
+from obs.api.upload import MultipartParser, receive_body, receive_upload
+
+BOUNDARY = "----obsboundary"
+
+
+def make_body(fields):
+    body = b""
+    for name, filename, content in fields:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += (
+            f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n".encode()
+            + content
+            + b"\r\n"
+        )
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def make_request(body, chunk_size=7, content_length=True):
+    async def stream():
+        for i in range(0, len(body), chunk_size):
+            yield body[i : i + chunk_size]
+
+    headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+    if content_length:
+        headers["content-length"] = str(len(body))
+    return SimpleNamespace(headers=headers, stream=stream())
+
+
+def parse(body, chunk_size):
+    parser = MultipartParser(BOUNDARY.encode())
+    parts = []
+    for i in range(0, len(body), chunk_size):
+        for event, value in parser.feed(body[i : i + chunk_size]):
+            if event == "part":
+                parts.append([value, b""])
+            else:
+                parts[-1][1] += value
+    parser.finish()
+    return parts
+
+
+def test_parse_multipart_in_any_chunks():
+    content = b"Date;Time\r\n--" + BOUNDARY[:-2].encode() + b"\r\n" * 3
+    body = make_body([("title", None, b"a title"), ("body", "track.csv", content)])
+
+    for chunk_size in range(1, len(body) + 1):
+        (title_headers, title), (body_headers, data) = parse(body, chunk_size)
+        assert title_headers == {"content-disposition": 'form-data; name="title"'}
+        assert title == b"a title"
+        assert "track.csv" in body_headers["content-disposition"]
+        assert data == content
+
+
+def test_parse_incomplete_multipart():
+    body = make_body([("body", "track.csv", b"data")])
+
+    with pytest.raises(ValueError):
+        parse(body[:-10], 5)
+
+
+def test_receive_upload(tmp_path):
+    content = os.urandom(10000)
+    body = make_body([("title", None, b"ignored"), ("body", "track.csv", content)])
+
+    upload = asyncio.run(
+        receive_upload(make_request(body), "body", str(tmp_path), 100000)
+    )
+
+    assert upload.name == "track.csv"
+    assert upload.size == len(content)
+    assert upload.hash == hashlib.sha512(content).hexdigest()
+    with open(upload.path, "rb") as f:
+        assert f.read() == content
+
+    target = str(tmp_path / "user" / "original.csv")
+    upload.move_to(target)
+    upload.discard()
+    assert os.listdir(tmp_path) == ["user"]
+    assert os.path.getsize(target) == len(content)
+
+
+def test_receive_upload_without_file(tmp_path):
+    body = make_body([("title", None, b"a title")])
+
+    assert (
+        asyncio.run(receive_upload(make_request(body), "body", str(tmp_path), 1000))
+        is None
+    )
+    assert os.listdir(tmp_path) == []
+
+
+def test_receive_upload_too_large(tmp_path):
+    body = make_body([("body", "track.csv", b"x" * 2000)])
+
+    for content_length in (True, False):
+        with pytest.raises(PayloadTooLarge):
+            asyncio.run(
+                receive_upload(
+                    make_request(body, content_length=content_length),
+                    "body",
+                    str(tmp_path),
+                    1000,
+                )
+            )
+        assert os.listdir(tmp_path) == []
+
+
+def test_receive_upload_invalid(tmp_path):
+    body = make_body([("body", "track.csv", b"data")])
+
+    with pytest.raises(InvalidUsage):
+        asyncio.run(
+            receive_upload(make_request(body[:-5]), "body", str(tmp_path), 1000)
+        )
+    assert os.listdir(tmp_path) == []
+
+    request = make_request(body)
+    request.headers["content-type"] = "application/json"
+    with pytest.raises(InvalidUsage):
+        asyncio.run(receive_upload(request, "body", str(tmp_path), 1000))
+
+
+def test_receive_upload_invalid_content_length(tmp_path):
+    request = make_request(make_body([("body", "track.csv", b"data")]))
+    request.headers["content-length"] = "many"
+
+    with pytest.raises(InvalidUsage):
+        asyncio.run(receive_upload(request, "body", str(tmp_path), 1000))
+    assert os.listdir(tmp_path) == []
+
+
+def test_receive_body():
+    body = b'{"track": {"title": "a title"}}'
+
+    assert asyncio.run(receive_body(make_request(body), 100)) == body
+
+    for content_length in (True, False):
+        with pytest.raises(PayloadTooLarge):
+            asyncio.run(
+                receive_body(make_request(body, content_length=content_length), 20)
+            )
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks importing OpenBikeSensor CSV files, as done when processing a
+track, and reports the rows imported per second and the peak memory traced
+while importing. The file is generated, in the format 2 of the firmware with
+all 30 measurement columns, and gzipped like uploads of the app. Results can
+be saved with `--output` and compared to those of another version of the code
+with `--compare`, for example:
+
+    tools/benchmark_csv_import.py --output before.json
+    git checkout my-branch
+    tools/benchmark_csv_import.py --compare before.json
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy
+
+from obs.api.process.obs_csv import import_csv
+
+log = logging.getLogger(__name__)
+
+METADATA = (
+    "OBSDataFormat=2&OBSFirmwareVersion=v0.18.0&DeviceId=ffff&DataPerMeasurement=3"
+    "&MaximumMeasurementsPerLine=30&OffsetLeft=30&OffsetRight=30"
+    "&NumberOfDefinedPrivacyAreas=0&TrackId=benchmark"
+    "&PrivacyLevelApplied=AbsolutePrivacy"
+    "&MaximumValidFlightTimeMicroseconds=18560&BluetoothEnabled=0"
+    "&PresetId=default{time_zone}&DistanceSensorsUsed=HC-SR04/JSN-SR04T"
+)
+
+COLUMNS = [
+    "Date",
+    "Time",
+    "Millis",
+    "Comment",
+    "Latitude",
+    "Longitude",
+    "Altitude",
+    "Course",
+    "Speed",
+    "HDOP",
+    "Satellites",
+    "BatteryLevel",
+    "Left",
+    "Right",
+    "Confirmed",
+    "Marked",
+    "Invalid",
+    "InsidePrivacyArea",
+    "Factor",
+    "Measurements",
+    *(f"{name}{i}" for i in range(1, 31) for name in ("Tms", "Lus", "Rus")),
+]
+
+
+def write_csv(filename, rows, seed=1, gps_time=False):
+    """
+    Writes a gzipped CSV file of a ride with the given number of rows, one per
+    second, with random measurements, with times in GPS time, if `gps_time`
+    is set.
+    """
+    rng = numpy.random.default_rng(seed)
+    start = datetime(2023, 5, 1, 10, 0, 0)
+    latitude = 48.7 + numpy.cumsum(rng.normal(0, 0.00003, rows))
+    longitude = 9.1 + numpy.cumsum(rng.normal(0, 0.00004, rows))
+
+    with gzip.open(filename, "wt", encoding="utf-8") as f:
+        f.write(METADATA.format(time_zone="&TimeZone=GPS" if gps_time else "") + "\n")
+        f.write(";".join(COLUMNS) + "\n")
+        for i in range(rows):
+            t = start + timedelta(seconds=i)
+            left = rng.integers(50, 400) if rng.random() < 0.2 else ""
+            right = rng.integers(50, 300)
+            measurements = ";".join(
+                f"{j * 31};{rng.integers(2000, 20000)};" for j in range(20)
+            )
+            f.write(
+                f"{t:%d.%m.%Y};{t:%H:%M:%S};{i * 1000};;{latitude[i]:.6f};"
+                f"{longitude[i]:.6f};300;{rng.uniform(0, 360):.2f};"
+                f"{rng.uniform(10, 25):.2f};1.2;8;3.9;{left};{right};"
+                f"{int(rng.random() < 0.05)};0;0;0;58;20;{measurements}"
+                + ";" * 30
+                + "\n"
+            )
+
+
+def run_benchmark(filename, repeat):
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        df, _metadata = import_csv(filename)
+        seconds.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        import_csv(filename)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "rows": len(df),
+        "seconds": round(min(seconds), 6),
+        "rows_per_second": round(len(df) / min(seconds), 1),
+        "peak_memory": peak_memory,
+        "memory_usage": int(df.memory_usage(deep=True).sum()),
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="benchmarks importing a generated OpenBikeSensor CSV file"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=36000,
+        help="number of rows of the generated file (one per second)",
+    )
+    parser.add_argument(
+        "--gps-time",
+        action="store_true",
+        help="write times in GPS time, which are converted to UTC when importing",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs, the fastest one is reported",
+    )
+    parser.add_argument("--output", help="file to save the results to, as JSON")
+    parser.add_argument(
+        "--compare",
+        help="file with the saved results of an earlier run to compare with",
+    )
+
+    args = parser.parse_args()
+    config = {"rows": args.rows, "gps_time": args.gps_time, "seed": args.seed}
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "track.csv.gz")
+        write_csv(filename, args.rows, args.seed, args.gps_time)
+        log.info(
+            "Importing %d rows, %.1f MB gzipped",
+            args.rows,
+            os.path.getsize(filename) / 1024 / 1024,
+        )
+        result = run_benchmark(filename, args.repeat)
+
+    print(
+        f"{result['rows']} rows in {result['seconds']:.3f} s "
+        f"({result['rows_per_second']:.0f} rows/s), "
+        f"peak memory {result['peak_memory'] / 1024 / 1024:.1f} MB, "
+        f"dataframe {result['memory_usage'] / 1024 / 1024:.1f} MB"
+    )
+
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved["config"] != config:
+            log.warning(
+                "The compared results were made with a different configuration: %s",
+                saved["config"],
+            )
+        before = saved["result"]
+        print(
+            f"speed x{result['rows_per_second'] / before['rows_per_second']:.2f}, "
+            f"peak memory x{result['peak_memory'] / before['peak_memory']:.2f}, "
+            f"dataframe x{result['memory_usage'] / before['memory_usage']:.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "result": result}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks snapping tracks to roads on synthetic road networks, without a
+database, and reports the speed (points per second), the peak memory traced
+while snapping and the accuracy (share of points snapped to their true way).
+The scenarios are generated from a fixed random seed, so results can be saved
+with `--output` and compared to those of another version of the code with
+`--compare`, for example:
+
+    tools/benchmark_snapping.py --output before.json
+    git checkout my-branch
+    tools/benchmark_snapping.py --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import sys
+
+from obs.api.process.snapping_benchmark import SCENARIOS, make_scenario, run_scenario
+
+log = logging.getLogger(__name__)
+
+
+def print_results(results, baseline=None):
+    print(
+        f"{'scenario':<18} {'points':>7} {'points/s':>10} {'peak MB':>8} "
+        f"{'accuracy':>8} {'window':>7}"
+    )
+    for name, result in results.items():
+        line = (
+            f"{name:<18} {result['points']:>7} {result['points_per_second']:>10.0f} "
+            f"{result['peak_memory'] / 1024 / 1024:>8.1f} {result['accuracy']:>8.4f} "
+            f"{result['counts'].get('viterbi_max_window', 0):>7}"
+        )
+
+        if baseline and name in baseline:
+            before = baseline[name]
+            speedup = result["points_per_second"] / before["points_per_second"]
+            memory = result["peak_memory"] / max(before["peak_memory"], 1)
+            accuracy = result["accuracy"] - before["accuracy"]
+            line += (
+                f"   speed x{speedup:.2f}, memory x{memory:.2f}, "
+                f"accuracy {accuracy:+.4f}"
+            )
+        print(line)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    parser = argparse.ArgumentParser(
+        description="benchmarks snapping tracks on synthetic road networks"
+    )
+    parser.add_argument(
+        "--scenario",
+        choices=list(SCENARIOS),
+        action="append",
+        help="scenario to run, can be given multiple times (default: all)",
+    )
+    parser.add_argument(
+        "--length",
+        type=float,
+        default=10000.0,
+        help="length of the route of each scenario, in meters",
+    )
+    parser.add_argument(
+        "--noise",
+        type=float,
+        default=5.0,
+        help="standard deviation of the GPS noise, in meters",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="time between two track points, in seconds",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=5.0,
+        help="speed along the route, in meters per second",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs of each scenario, the fastest one is reported",
+    )
+    parser.add_argument(
+        "--buffer",
+        type=float,
+        default=120.0,
+        help="distance of the roads considered for each point, in meters",
+    )
+    parser.add_argument(
+        "--choice-count",
+        type=int,
+        default=10,
+        help="maximum number of candidates for each point",
+    )
+    parser.add_argument(
+        "--beam-margin",
+        type=float,
+        help="prune the candidates of points where the cheapest path is ahead "
+        "by this cost (default: no beam pruning)",
+    )
+    parser.add_argument(
+        "--cost-cutoff",
+        type=float,
+        help="drop candidates whose path costs this much more than the cheapest "
+        "one (default: no cutoff)",
+    )
+    parser.add_argument(
+        "--proximity-grid",
+        type=float,
+        help="approximate the distances between roads by road points in grid "
+        "cells of this many meters (default: exact distances)",
+    )
+    parser.add_argument("--output", help="file to save the results to, as JSON")
+    parser.add_argument(
+        "--compare",
+        help="file with the saved results of an earlier run to compare with",
+    )
+
+    args = parser.parse_args()
+
+    config = {
+        "length": args.length,
+        "noise": args.noise,
+        "interval": args.interval,
+        "speed": args.speed,
+        "seed": args.seed,
+        "buffer": args.buffer,
+        "choice_count": args.choice_count,
+        "beam_margin": args.beam_margin,
+        "cost_cutoff": args.cost_cutoff,
+        "proximity_grid": args.proximity_grid,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved["config"] != config:
+            log.warning(
+                "The compared results were made with a different configuration: %s",
+                saved["config"],
+            )
+        baseline = saved["results"]
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        scenario = make_scenario(
+            name,
+            length=args.length,
+            noise=args.noise,
+            interval=args.interval,
+            speed=args.speed,
+            seed=args.seed,
+        )
+        log.info("Running scenario %s with %d points", name, len(scenario.track))
+        results[name] = run_scenario(
+            scenario,
+            repeat=args.repeat,
+            buffer=args.buffer,
+            choice_count=args.choice_count,
+            beam_margin=args.beam_margin,
+            cost_cutoff=args.cost_cutoff,
+            proximity_grid=args.proximity_grid,
+        )
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
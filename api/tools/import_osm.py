@@ -91,6 +91,13 @@ async def import_osm(connection, filename, import_group=None):
                         )
                     )
 
+        # Invalidate results that depend on the previous road data
+        await cursor.execute(
+            "INSERT INTO road_import (import_group, imported_at) VALUES (%s, NOW()) "
+            "ON CONFLICT (import_group) DO UPDATE SET imported_at = NOW()",
+            (import_group,),
+        )
+
 
 async def main():
     logging.basicConfig(level=logging.DEBUG, format="%(levelname)s: %(message)s")
@@ -6,6 +6,7 @@ import asyncio
 from obs.api.db import connect_db, make_session
 from obs.api.app import app
 from obs.api.process import process_track_file, process_tracks, process_tracks_loop
+from obs.api.process.pool import run_processes, shutdown_pool
 
 log = logging.getLogger(__name__)
 
@@ -22,8 +23,17 @@ async def main():
         "--loop-delay",
         action="store",
         type=int,
-        default=10,
-        help="delay between loops, if no track was found in the queue (polling)",
+        default=60,
+        help="maximum delay between checks of the queue, if no notification about "
+        "a newly queued track was received (polling fallback)",
+    )
+
+    parser.add_argument(
+        "--workers",
+        action="store",
+        type=int,
+        default=1,
+        help="number of worker processes to run when processing the queue",
     )
 
     parser.add_argument(
@@ -40,18 +50,52 @@ async def main():
 
     args = parser.parse_args()
 
+    if not args.file and not args.tracks and args.workers > 1:
+        run_worker_processes(args.workers, args.loop_delay)
+        return
+
+    async with connect_db(
+        app.config.POSTGRES_URL,
+        app.config.POSTGRES_POOL_SIZE,
+        app.config.POSTGRES_MAX_OVERFLOW,
+    ):
+        try:
+            if args.file:
+                async with make_session() as session:
+                    df = await process_track_file(session, args.file)
+            elif args.tracks:
+                await process_tracks(args.tracks)
+            else:
+                await process_tracks_loop(args.loop_delay)
+        finally:
+            shutdown_pool()
+
+
+async def worker_main(loop_delay):
     async with connect_db(
         app.config.POSTGRES_URL,
         app.config.POSTGRES_POOL_SIZE,
         app.config.POSTGRES_MAX_OVERFLOW,
     ):
-        if args.file:
-            async with make_session() as session:
-                df = await process_track_file(session, args.file)
-        elif args.tracks:
-            await process_tracks(args.tracks)
-        else:
-            await process_tracks_loop(args.loop_delay)
+        try:
+            await process_tracks_loop(loop_delay)
+        finally:
+            shutdown_pool()
+
+
+def run_worker(loop_delay):
+    logging.basicConfig(level=logging.DEBUG, format="%(levelname)s: %(message)s")
+    asyncio.run(worker_main(loop_delay))
+
+
+def run_worker_processes(count, loop_delay):
+    """
+    Runs `count` queue workers in separate processes, each with its own
+    database connection and processing pool. They claim different tracks from
+    the queue.
+    """
+    # Spawn fresh interpreters, we are inside a running event loop here
+    run_processes(run_worker, (loop_delay,), count)
 
 
 if __name__ == "__main__":
@@ -1,30 +1,361 @@
 #!/usr/bin/env python3
-import logging
+
+"""
+Queues tracks for reprocessing. The tracks are queued with a low priority, so
+freshly uploaded tracks are processed first, and in batches, by default only
+when the queue has been worked off. Progress is saved in a state file, so an
+interrupted run can be continued by running the same command again.
+"""
+
+import argparse
 import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
 
-from sqlalchemy import text
+from sqlalchemy import func, select, update
 
 from obs.api.app import app
-from obs.api.db import connect_db, make_session
+from obs.api.db import (
+    PROCESSING_PRIORITY_BACKGROUND,
+    PROCESSING_PRIORITY_BULK,
+    PROCESSING_PRIORITY_INTERACTIVE,
+    Track,
+    User,
+    connect_db,
+    make_session,
+)
 
 log = logging.getLogger(__name__)
 
+# Tracks currently being processed are not requeued, the worker would
+# overwrite the new status when it is done.
+DEFAULT_STATUSES = ["created", "complete", "error"]
+
+PRIORITIES = {
+    "interactive": PROCESSING_PRIORITY_INTERACTIVE,
+    "bulk": PROCESSING_PRIORITY_BULK,
+    "background": PROCESSING_PRIORITY_BACKGROUND,
+}
+
+
 async def main():
     logging.basicConfig(level=logging.DEBUG, format="%(levelname)s: %(message)s")
-    await reimport_tracks()
 
+    parser = argparse.ArgumentParser(
+        description="queues tracks for reprocessing, in batches, at a limited rate"
+    )
+
+    parser.add_argument(
+        "--user",
+        dest="users",
+        action="append",
+        help="only tracks of the user with this name or ID, can be repeated",
+    )
+    parser.add_argument(
+        "--recorded-after",
+        type=datetime.fromisoformat,
+        help="only tracks recorded at or after this date (UTC, ISO format)",
+    )
+    parser.add_argument(
+        "--recorded-before",
+        type=datetime.fromisoformat,
+        help="only tracks recorded before this date (UTC, ISO format)",
+    )
+    parser.add_argument(
+        "--status",
+        dest="statuses",
+        action="append",
+        choices=["created", "queued", "complete", "error"],
+        help="only tracks with this processing status, can be repeated; tracks "
+        "being processed are never queued again "
+        f"(default: {', '.join(DEFAULT_STATUSES)})",
+    )
+    parser.add_argument(
+        "--bbox",
+        type=parse_bbox,
+        metavar="WEST,SOUTH,EAST,NORTH",
+        help="only tracks touching this bounding box (WGS84 degrees)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="number of tracks to queue at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="maximum number of tracks to queue per minute (default: unlimited)",
+    )
+    parser.add_argument(
+        "--priority",
+        choices=PRIORITIES.keys(),
+        default="background",
+        help="processing priority of the queued tracks (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        help="wait until fewer tracks than this are queued before queueing the "
+        "next batch (default: the batch size), 0 to never wait",
+    )
+    parser.add_argument(
+        "--state-file",
+        default="reimport-tracks.json",
+        help="file to store the progress in, to resume an interrupted run "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the progress in the state file and start from the beginning",
+    )
 
-async def reimport_tracks():
+    args = parser.parse_args()
+
+    selection = {
+        "users": args.users,
+        "recorded_after": args.recorded_after and args.recorded_after.isoformat(),
+        "recorded_before": args.recorded_before and args.recorded_before.isoformat(),
+        "statuses": args.statuses or DEFAULT_STATUSES,
+        "bbox": args.bbox,
+    }
+
+    max_queued = args.batch_size if args.max_queued is None else args.max_queued
 
     async with connect_db(
         app.config.POSTGRES_URL,
         app.config.POSTGRES_POOL_SIZE,
         app.config.POSTGRES_MAX_OVERFLOW,
     ):
+        await reimport_tracks(
+            selection,
+            batch_size=args.batch_size,
+            priority=PRIORITIES[args.priority],
+            rate=args.rate,
+            max_queued=max_queued or None,
+            state_file=args.state_file,
+            restart=args.restart,
+        )
+
+
+async def reimport_all_tracks():
+    """
+    Queues all tracks as fast as possible, used by the upgrade script while
+    the workers are stopped.
+    """
+    async with connect_db(
+        app.config.POSTGRES_URL,
+        app.config.POSTGRES_POOL_SIZE,
+        app.config.POSTGRES_MAX_OVERFLOW,
+    ):
+        await reimport_tracks({"statuses": DEFAULT_STATUSES}, batch_size=1000)
+
+
+def parse_bbox(value):
+    try:
+        west, south, east, north = map(float, value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected four comma-separated numbers")
+    return [west, south, east, north]
+
+
+def get_selection_conditions(selection):
+    conditions = []
+
+    if selection.get("users"):
+        ids = [int(user) for user in selection["users"] if user.isdigit()]
+        names = [user for user in selection["users"] if not user.isdigit()]
+        conditions.append(
+            Track.author_id.in_(
+                select(User.id).where(User.id.in_(ids) | User.username.in_(names))
+            )
+        )
+
+    if selection.get("recorded_after"):
+        conditions.append(
+            Track.recorded_at >= datetime.fromisoformat(selection["recorded_after"])
+        )
+
+    if selection.get("recorded_before"):
+        conditions.append(
+            Track.recorded_at < datetime.fromisoformat(selection["recorded_before"])
+        )
+
+    if selection.get("statuses"):
+        conditions.append(Track.processing_status.in_(selection["statuses"]))
+
+    if selection.get("bbox"):
+        conditions.append(
+            func.ST_Intersects(
+                Track.geometry,
+                func.ST_Transform(func.ST_MakeEnvelope(*selection["bbox"], 4326), 3857),
+            )
+        )
+
+    return conditions
+
+
+def load_state(state_file, selection):
+    if not state_file or not os.path.exists(state_file):
+        return None
+
+    with open(state_file) as f:
+        state = json.load(f)
+
+    if state["selection"] != selection:
+        raise ValueError(
+            f"The state file {state_file} belongs to a different selection of "
+            "tracks, pass --restart to start over, or use a different --state-file."
+        )
+
+    return state
+
+
+def save_state(state_file, state):
+    if not state_file:
+        return
+
+    tmp_file = f"{state_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+
+def format_progress(done, total, elapsed, queued_this_run):
+    per_minute = queued_this_run / elapsed * 60 if elapsed > 0 else 0
+    eta = (
+        str(timedelta(seconds=round((total - done) / per_minute * 60)))
+        if per_minute
+        else "unknown"
+    )
+    return (
+        f"Queued {done}/{total} tracks ({100 * done / max(total, 1):.1f}%), "
+        f"{per_minute:.1f} tracks/min, ETA {eta}"
+    )
+
+
+async def wait_for_queue(max_queued):
+    while True:
         async with make_session() as session:
-            await session.execute(text("UPDATE track SET processing_status = 'queued';"))
+            queued = await session.scalar(
+                select(func.count())
+                .select_from(Track)
+                .where(Track.processing_status == "queued")
+            )
+        if queued < max_queued:
+            return
+        log.debug("%s tracks queued, waiting for the workers", queued)
+        await asyncio.sleep(10)
+
+
+async def reimport_tracks(
+    selection,
+    *,
+    batch_size=100,
+    priority=PROCESSING_PRIORITY_BACKGROUND,
+    rate=None,
+    max_queued=None,
+    state_file=None,
+    restart=False,
+):
+    """
+    Queues the tracks matching the selection for processing with the given
+    priority, in batches of `batch_size` tracks, ordered by ID. At most `rate`
+    tracks are queued per minute, and a batch is only queued when fewer than
+    `max_queued` tracks are waiting in the queue. After each batch, the last
+    queued ID is written to the `state_file`, from which a later call with the
+    same selection resumes.
+
+    Tracks that are being processed are not queued again, even if a worker
+    claims them while their batch is queued, as that would reset the claim.
+    """
+    if "processing" in (selection.get("statuses") or []):
+        raise ValueError("Tracks that are being processed cannot be queued again.")
+
+    state = None if restart else load_state(state_file, selection)
+    if state:
+        log.info("Resuming after track ID %s", state["last_id"])
+    else:
+        state = {"selection": selection, "last_id": 0, "done": 0}
+
+    conditions = get_selection_conditions(selection)
+
+    async with make_session() as session:
+        remaining = await session.scalar(
+            select(func.count())
+            .select_from(Track)
+            .where(*conditions, Track.id > state["last_id"])
+        )
+
+    total = state["done"] + remaining
+    log.info("Reprocessing %s tracks, %s remaining", total, remaining)
+
+    start = time.monotonic()
+    queued_this_run = 0
+
+    while True:
+        if max_queued:
+            await wait_for_queue(max_queued)
+
+        async with make_session() as session:
+            ids = (
+                await session.scalars(
+                    select(Track.id)
+                    .where(*conditions, Track.id > state["last_id"])
+                    .order_by(Track.id)
+                    .limit(batch_size)
+                )
+            ).all()
+
+            if not ids:
+                break
+
+            # The conditions are checked again, as a worker may have claimed
+            # some of the tracks since they were selected.
+            result = await session.execute(
+                update(Track)
+                .where(
+                    *conditions,
+                    Track.id.in_(ids),
+                    Track.processing_status != "processing",
+                )
+                .values(
+                    processing_status="queued",
+                    processing_queued_at=datetime.utcnow(),
+                    processing_priority=priority,
+                    processing_worker=None,
+                    processing_lease_until=None,
+                )
+            )
             await session.commit()
 
+        if result.rowcount < len(ids):
+            log.info(
+                "Skipped %s tracks that were claimed by a worker meanwhile",
+                len(ids) - result.rowcount,
+            )
+
+        state["last_id"] = ids[-1]
+        state["done"] += len(ids)
+        queued_this_run += result.rowcount
+        save_state(state_file, state)
+
+        elapsed = time.monotonic() - start
+        log.info(format_progress(state["done"], total, elapsed, queued_this_run))
+
+        if rate:
+            # Sleep until the average rate of this run is back at the limit
+            await asyncio.sleep(max(0, queued_this_run / rate * 60 - elapsed))
+
+    log.info("Done, queued %s tracks.", state["done"])
+
+    if state_file and os.path.exists(state_file):
+        os.unlink(state_file)
+
 
 if __name__ == "__main__":
     asyncio.run(main())
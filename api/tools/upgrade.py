@@ -8,7 +8,7 @@ from prepare_sql_tiles import prepare_sql_tiles, _run
 
 from import_regions import main as import_nuts
 
-from reimport_tracks import main as reimport_tracks
+from reimport_tracks import reimport_all_tracks
 
 
 async def _migrate():
@@ -24,7 +24,7 @@ async def main():
     log.info("Importing nuts regions...")
     await import_nuts()
     log.info("Nuts regions imported, scheduling reimport of tracks")
-    await reimport_tracks()
+    await reimport_all_tracks()
 
 
 
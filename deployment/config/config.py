@@ -53,6 +53,7 @@ TILES_FILE = None
 # DATA_DIR = "??" # default: $API_ROOT_DIR/..
 # PROCESSING_DIR = "??" # default: DATA_DIR/processing
 # PROCESSING_OUTPUT_DIR = "??"  # default: DATA_DIR/processing-output
+# PROCESSING_CACHE_DIR = "??"  # default: DATA_DIR/processing-cache
 # TRACKS_DIR = "??" # default: DATA_DIR/tracks
 # OBS_FACE_CACHE_DIR = "??" # default: DATA_DIR/obs-face-cache
 